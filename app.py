@@ -1,12 +1,20 @@
 import streamlit as st
 import boto3
-import pandas as pd
 import json
 import time
+import codecs
 import os
-from io import StringIO
 from datetime import datetime
 import re
+import uuid
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import travel_data
+import segment_data
+from dataset_cache import is_missing_object
+from email_template_store import EmailTemplateStore
+from flight_index import FlightFacetIndex
 
 # Set up page config
 st.set_page_config(
@@ -204,6 +212,18 @@ if 'selected_flights' not in st.session_state:
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 
+# One agent session per browser session, so the agent keeps its memory across turns
+if 'agent_session_id' not in st.session_state:
+    st.session_state.agent_session_id = f"session-{uuid.uuid4().hex}"
+
+# Selected flights last described to the agent in this session
+if 'flight_context_signature' not in st.session_state:
+    st.session_state.flight_context_signature = None
+
+# When the agent last completed a turn in this session, to tell when the session has expired
+if 'agent_last_invoked_at' not in st.session_state:
+    st.session_state.agent_last_invoked_at = None
+
 if 'email_templates' not in st.session_state:
     st.session_state.email_templates = {}
 
@@ -229,6 +249,33 @@ USERS_CSV_PATH = 'data/travel_users.csv'
 SEGMENTS_OUTPUT_PATH = 'segments/batch_segment_input_ab3.json.out'
 EMAIL_TEMPLATES_PATH = 'email_templates/'
 
+# Data caching - ETags are re-checked with a HEAD after ETAG_CHECK_TTL_SECONDS;
+# parsed data is keyed by ETag and kept for DATA_CACHE_TTL_SECONDS
+ETAG_CHECK_TTL_SECONDS = 60
+DATA_CACHE_TTL_SECONDS = 3600
+DATA_CACHE_MAX_ENTRIES = 64
+# Lookups of up to this many segments read only their lines, by byte range through the offset index
+SEGMENT_RANGE_READ_MAX_LINES = 16
+
+# Bedrock agent client - connections kept open, and attempts per call with adaptive
+# (throttling-aware) backoff; agent turns that run several tools can take minutes
+AGENT_MAX_POOL_CONNECTIONS = 10
+AGENT_MAX_ATTEMPTS = 5
+AGENT_READ_TIMEOUT_SECONDS = 300
+# Have the agent stream its final answer in chunks instead of one chunk at the end of the turn;
+# with guardrails on the alias, they are applied every AGENT_GUARDRAIL_INTERVAL characters (0 = not set)
+AGENT_STREAM_FINAL_RESPONSE = True
+AGENT_GUARDRAIL_INTERVAL = int(os.environ.get('AGENT_GUARDRAIL_INTERVAL', '0'))
+# The agent forgets a session (and the flight context sent in it) after this long without a
+# turn; keep in line with the agent's idleSessionTTLInSeconds (Bedrock's default is 600)
+AGENT_IDLE_SESSION_TTL_SECONDS = int(os.environ.get('AGENT_IDLE_SESSION_TTL_SECONDS', '600'))
+
+# Chat history - at most CHAT_HISTORY_MAX_MESSAGES are kept; the newest CHAT_WINDOW_MESSAGES
+# are rendered in full and older ones are collapsed, truncated to CHAT_COLLAPSED_PREVIEW_CHARS
+CHAT_HISTORY_MAX_MESSAGES = 200
+CHAT_WINDOW_MESSAGES = 10
+CHAT_COLLAPSED_PREVIEW_CHARS = 200
+
 # Helper functions
 @st.cache_resource
 def get_aws_clients():
@@ -242,7 +289,13 @@ def get_aws_clients():
         
         bedrock_agent_client = boto3.client(
             'bedrock-agent-runtime',
-            region_name=bedrock_region
+            region_name=bedrock_region,
+            config=Config(
+                max_pool_connections=AGENT_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': AGENT_MAX_ATTEMPTS, 'mode': 'adaptive'},
+                read_timeout=AGENT_READ_TIMEOUT_SECONDS,
+                tcp_keepalive=True
+            )
         )
         
         return s3_client, bedrock_agent_client
@@ -250,55 +303,179 @@ def get_aws_clients():
         st.error(f"Error initializing AWS clients: {str(e)}")
         return None, None
 
-def read_s3_csv(bucket, key):
-    """Read CSV data from S3"""
+@st.cache_data(ttl=ETAG_CHECK_TTL_SECONDS, show_spinner=False)
+def get_s3_etag(bucket, key):
+    """Return the current ETag of an S3 object, or None if it does not exist"""
+    s3_client, _ = get_aws_clients()
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key).get('ETag')
+    except ClientError as e:
+        if is_missing_object(e):
+            return None
+        raise
+
+@st.cache_data(ttl=ETAG_CHECK_TTL_SECONDS, show_spinner=False)
+def get_s3_metadata(bucket, key):
+    """Return the ETag and user metadata of an S3 object, or (None, {}) if it does not exist"""
+    s3_client, _ = get_aws_clients()
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if is_missing_object(e):
+            return None, {}
+        raise
+    return response.get('ETag'), response.get('Metadata') or {}
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_dataset(bucket, key, etag, columns=None):
+    """Parse a snapshot or CSV object at a given ETag (part of the cache key, so changed objects are re-read)"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    if key.endswith('.parquet'):
+        return travel_data.parse_snapshot(response['Body'].read(), columns, dtypes=travel_data.dataset_dtypes(key))
+    return travel_data.parse_csv(response['Body'].read(), columns, travel_data.dataset_dtypes(key))
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segments(bucket, key, etag, item_ids=None):
+    """Parse the segment lines of a JSONL object at a given ETag, optionally only those for item_ids"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    if item_ids is None:
+        return list(segment_data.iter_segments(response['Body']))
+    # Stops reading the stream as soon as every requested segment is found
+    return list(segment_data.find_segments(response['Body'], item_ids))
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_item_ids(bucket, key, etag):
+    """List the flight IDs that have a segment in a JSONL object at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return list(segment_data.iter_segment_item_ids(response['Body']))
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_manifest(bucket, key, etag):
+    """Parse a segment manifest at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return segment_data.parse_segment_manifest(response['Body'].read())
+
+def current_dataset_object(bucket, key):
+    """Return the (key, ETag) to read a travel dataset from: its Parquet snapshot if built from the current CSV, else the CSV"""
+    csv_etag = get_s3_etag(bucket, key)
+    if travel_data.SNAPSHOTS_SUPPORTED:
+        snapshot_key = travel_data.snapshot_key(key)
+        snapshot_etag, snapshot_metadata = get_s3_metadata(bucket, snapshot_key)
+        if snapshot_etag and travel_data.snapshot_is_current(snapshot_metadata, csv_etag):
+            return snapshot_key, snapshot_etag
+    return key, csv_etag
+
+@st.cache_resource(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_flight_index(bucket, key, etag):
+    """Build the promotional-flight facet index of an items object at a given ETag"""
+    return FlightFacetIndex.build(load_s3_dataset(bucket, key, etag, travel_data.ITEM_COLUMNS))
+
+def read_flight_index(bucket, key):
+    """Read the promotional-flight facet index of the items table, rebuilt only when the table changes"""
     try:
         s3_client, _ = get_aws_clients()
         if not s3_client:
             return None
-            
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(content))
-        return df
+
+        object_key, etag = current_dataset_object(bucket, key)
+        if not etag:
+            st.error(f"Error reading CSV from S3: s3://{bucket}/{key} does not exist")
+            return None
+        return load_s3_flight_index(bucket, object_key, etag)
     except Exception as e:
         st.error(f"Error reading CSV from S3: {str(e)}")
         return None
 
-def read_s3_json(bucket, key):
-    """Read JSONL data from S3"""
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_offset_index(bucket, key, etag):
+    """Parse a segment offset index at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return segment_data.parse_segment_offset_index(response['Body'].read())
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_line(bucket, key, etag, item_id, span):
+    """Read one segment line by byte range from a JSONL object at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=segment_data.segment_line_range(span), IfMatch=etag)
+    return segment_data.parse_segment_line(response['Body'].read(), item_id)
+
+def clear_data_caches():
+    """Drop the cached S3 ETags and parsed data, leaving other cached functions alone"""
+    for loader in (get_s3_etag, get_s3_metadata, load_s3_dataset, load_s3_segments, load_s3_segment_item_ids,
+                   load_s3_segment_manifest, load_s3_flight_index, load_s3_segment_offset_index, load_s3_segment_line):
+        loader.clear()
+
+def read_indexed_segments(bucket, key, item_ids):
+    """Read the segments of item_ids with one ranged GET each, or None when the offset index cannot be used"""
+    index_key = segment_data.segment_offset_index_key(key)
+    index_etag = get_s3_etag(bucket, index_key)
+    if not index_etag:
+        return None
+    index = load_s3_segment_offset_index(bucket, index_key, index_etag)
+    if not segment_data.offset_index_is_fresh(index, lambda source: get_s3_etag(bucket, source)):
+        return None
+
+    etag = index['sources'][key]
+    try:
+        segments = [load_s3_segment_line(bucket, key, etag, item_id, tuple(index['lines'][item_id]))
+                    for item_id in dict.fromkeys(item_ids) if item_id in index['lines']]
+    except ClientError:
+        # The segment file changed since the HEAD; scan the new version instead
+        return None
+    return None if any(segment is None for segment in segments) else segments
+
+def read_s3_json(bucket, key, item_ids=None):
+    """Read JSONL segment data from S3 line by line, optionally only the lines for item_ids"""
     try:
         s3_client, _ = get_aws_clients()
         if not s3_client:
             return None
-            
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        json_objects = []
-        for line in content.strip().split('\n'):
-            if line:  # Skip empty lines
-                json_objects.append(json.loads(line))
-        return json_objects
+
+        # Small lookups fetch kilobytes through the offset index instead of scanning the file
+        if item_ids is not None and len(item_ids) <= SEGMENT_RANGE_READ_MAX_LINES:
+            segments = read_indexed_segments(bucket, key, item_ids)
+            if segments is not None:
+                return segments
+
+        etag = get_s3_etag(bucket, key)
+        if not etag:
+            return None
+        return load_s3_segments(bucket, key, etag, tuple(item_ids) if item_ids is not None else None)
     except Exception as e:
         st.error(f"Error reading JSON from S3: {str(e)}")
         return None
 
-def write_to_s3(bucket, key, content):
-    """Write content to S3"""
+def read_segment_item_ids(bucket, key):
+    """List the flight IDs that have a segment, without keeping the user lists"""
     try:
         s3_client, _ = get_aws_clients()
         if not s3_client:
-            return False
-            
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=content
-        )
-        return True
+            return []
+
+        # The manifest answers this without touching the segment file
+        manifest_key = segment_data.segment_manifest_key(key)
+        manifest_etag = get_s3_etag(bucket, manifest_key)
+        if manifest_etag:
+            try:
+                manifest = load_s3_segment_manifest(bucket, manifest_key, manifest_etag)
+                if segment_data.manifest_is_fresh(manifest, lambda source: get_s3_etag(bucket, source)):
+                    return list(manifest['flights'])
+            except segment_data.ARTIFACT_ERRORS:
+                # A corrupt manifest is ignored, and the IDs are read from the segment file
+                pass
+
+        etag = get_s3_etag(bucket, key)
+        if not etag:
+            return []
+        return load_s3_segment_item_ids(bucket, key, etag)
     except Exception as e:
-        st.error(f"Error writing to S3: {str(e)}")
-        return False
+        st.error(f"Error reading JSON from S3: {str(e)}")
+        return []
 
 def extract_email_content(response_text):
     """Extract email subject and body from agent response"""
@@ -341,10 +518,65 @@ def create_segment_json(flight_ids):
         lines.append(json.dumps({"itemId": flight_id}))
     return "\n".join(lines)
 
+def append_chat_message(role, content):
+    """Add a message to the chat history, dropping the oldest beyond CHAT_HISTORY_MAX_MESSAGES"""
+    history = st.session_state.chat_history
+    history.append({"role": role, "content": content})
+    del history[:-CHAT_HISTORY_MAX_MESSAGES]
+
+def chat_message_html(role, content):
+    """Render one chat message as the styled HTML bubble"""
+    avatar = "👤" if role == "user" else "🎯"
+    return f'<div class="chat-message {role}"><div class="avatar">{avatar}</div><div class="content">{content}</div></div>'
+
+def render_chat_history(history):
+    """Render the newest messages in full and collapse the older ones into a single element"""
+    older, recent = history[:-CHAT_WINDOW_MESSAGES], history[-CHAT_WINDOW_MESSAGES:]
+    
+    if older:
+        with st.expander(f"{len(older)} earlier messages"):
+            previews = []
+            for message in older:
+                speaker = "You" if message["role"] == "user" else "Assistant"
+                content = message["content"].strip()
+                if len(content) > CHAT_COLLAPSED_PREVIEW_CHARS:
+                    content = content[:CHAT_COLLAPSED_PREVIEW_CHARS] + "…"
+                previews.append(f"{speaker}: {content}")
+            st.text("\n\n".join(previews))
+    
+    for message in recent:
+        st.markdown(chat_message_html(message["role"], message["content"]), unsafe_allow_html=True)
+
+def build_flight_context(flights):
+    """Describe the selected flights compactly, one line each with the ID the agent's tools take"""
+    lines = ["Selected flights (flightId: route, airline, month, price):"]
+    for flight in flights:
+        lines.append(f"- {flight['ITEM_ID']}: {flight['SRC_CITY']} to {flight['DST_CITY']}, "
+                     f"{flight['AIRLINE']}, {flight['MONTH']}, ${flight['DYNAMIC_PRICE']}")
+    return "\n".join(lines)
+
+def build_agent_prompt(user_input, flights):
+    """Prefix the flight context only when the selection changed since it was last sent in this session.
+
+    The context is sent again once the agent session may have expired while idle.
+    Returns the prompt and the selection signature to record once the agent has answered.
+    """
+    last_invoked_at = st.session_state.agent_last_invoked_at
+    if last_invoked_at is not None and time.time() - last_invoked_at > AGENT_IDLE_SESSION_TTL_SECONDS:
+        st.session_state.flight_context_signature = None
+
+    signature = tuple(flight['ITEM_ID'] for flight in flights)
+    if signature == st.session_state.flight_context_signature:
+        return user_input, signature
+    return f"{build_flight_context(flights)}\n\nUser message: {user_input}", signature
+
 def invoke_agent(prompt, session_id=None):
-    """Invoke the Bedrock Agent with a prompt and return the response"""
-    if not session_id:
-        session_id = f"session-{int(time.time())}"
+    """Invoke the Bedrock Agent with a prompt and yield the response text as it streams in.
+
+    st.session_state.agent_last_invoked_at is updated only when the agent completes the turn.
+    """
+    # Reuse the browser session's agent session, so the agent remembers earlier turns and tool results
+    session_id = session_id or st.session_state.agent_session_id
     
     _, bedrock_agent_client = get_aws_clients()
     
@@ -355,7 +587,7 @@ def invoke_agent(prompt, session_id=None):
         
         # Simple mock response
         if "generate email" in prompt.lower() or "email template" in prompt.lower():
-            return """
+            yield """
 Based on the flight details:
 - Source: Singapore
 - Destination: Hong Kong
@@ -389,7 +621,7 @@ Best regards,
 The Wanderly Team
 """
         elif "list" in prompt.lower() and "flight" in prompt.lower():
-            return """
+            yield """
 Here are the promotional flights available:
 
 1. Singapore to Hong Kong (PandaPaw Express, October, $5,200)
@@ -407,81 +639,97 @@ Here are the promotional flights available:
 To generate an email template for any of these flights, just ask me!
 """
         else:
-            return "I'll help you with that. What specific information are you looking for about the flights or email templates?"
+            yield "I'll help you with that. What specific information are you looking for about the flights or email templates?"
+        st.session_state.agent_last_invoked_at = time.time()
+        return
     
     try:
+        streaming_configurations = {'streamFinalResponse': AGENT_STREAM_FINAL_RESPONSE}
+        if AGENT_GUARDRAIL_INTERVAL:
+            streaming_configurations['applyGuardrailInterval'] = AGENT_GUARDRAIL_INTERVAL
+        
         # Make the actual call to Bedrock Agent
         response = bedrock_agent_client.invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
             sessionId=session_id,
             inputText=prompt,
-            enableTrace=True
+            enableTrace=True,
+            streamingConfigurations=streaming_configurations
         )
         
         # Process the response
         if 'completion' in response:
             event_stream = response['completion']
-            full_response = ""
+            # One decoder for the whole stream, so a character split across chunks is not garbled
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
             
-            # Extract content from event stream
+            # Hand each chunk to the caller as soon as it arrives
             for event in event_stream:
                 if 'chunk' in event and 'bytes' in event['chunk']:
-                    try:
-                        content_bytes = event['chunk']['bytes']
-                        if isinstance(content_bytes, bytes):
-                            decoded = content_bytes.decode('utf-8')
-                            full_response += decoded
-                    except Exception as e:
-                        pass
-            
-            return full_response
+                    content_bytes = event['chunk']['bytes']
+                    if isinstance(content_bytes, bytes):
+                        text = decoder.decode(content_bytes)
+                        if text:
+                            yield text
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+            st.session_state.agent_last_invoked_at = time.time()
         else:
-            return "Sorry, I couldn't generate a response. Please try again."
+            yield "Sorry, I couldn't generate a response. Please try again."
     except Exception as e:
-        return f"Error connecting to Bedrock Agent: {str(e)}"
+        yield f"Error connecting to Bedrock Agent: {str(e)}"
 
-def upload_template_to_s3(flight_id, email_subject, email_body):
-    """Upload email template to S3"""
+def upload_templates_to_s3(templates):
+    """Upload {flight_id: {"subject", "body"}} templates in one concurrent batch, skipping unchanged ones"""
     try:
-        # Format flight ID for filename
-        short_id = flight_id[-5:] if flight_id else "default"
-        
-        # Format timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Create filename
-        filename = f"email_template_{short_id}_{timestamp}.txt"
-        
-        # Format email content
-        email_content = f"Subject: {email_subject}\n\n{email_body}"
-        
-        # Save to S3
-        s3_path = f"{EMAIL_TEMPLATES_PATH}{filename}"
-        success = write_to_s3(BUCKET_NAME, s3_path, email_content)
-        
-        if success:
-            return {
-                "success": True,
-                "filename": filename,
-                "s3_path": s3_path,
-                "url": f"s3://{BUCKET_NAME}/{s3_path}"
-            }
-        else:
+        s3_client, _ = get_aws_clients()
+        if not s3_client:
             return {
                 "success": False,
-                "error": "Failed to write to S3"
+                "error": "S3 client is not available"
             }
+        
+        store = EmailTemplateStore(s3_client, BUCKET_NAME, EMAIL_TEMPLATES_PATH)
+        results = store.save_many([
+            (flight_id, content['subject'], content['body'])
+            for flight_id, content in templates.items()
+        ])
+        for result in results:
+            result['url'] = f"s3://{BUCKET_NAME}/{result['key']}"
+        
+        return {
+            "success": True,
+            "results": results,
+            "uploaded": sum(1 for result in results if result['uploaded']),
+            "unchanged": sum(1 for result in results if not result['uploaded'])
+        }
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
+def upload_template_to_s3(flight_id, email_subject, email_body):
+    """Upload one email template to S3, skipping the PUT when it is unchanged"""
+    batch = upload_templates_to_s3({flight_id: {"subject": email_subject, "body": email_body}})
+    if not batch['success']:
+        return batch
+    
+    result = batch['results'][0]
+    return {
+        "success": True,
+        "uploaded": result['uploaded'],
+        "filename": result['key'].rsplit('/', 1)[-1],
+        "s3_path": result['key'],
+        "url": result['url']
+    }
+
 def get_segment_users(flight_id):
     """Get segment users for a flight"""
     try:
-        segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH)
+        segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH, [flight_id])
         if not segments:
             return []
             
@@ -534,9 +782,35 @@ with st.sidebar:
     
     if st.session_state.email_templates:
         st.markdown(f"**Email Templates:** {len(st.session_state.email_templates)}")
+        
+        # One concurrent batch for the whole campaign; unchanged templates are not re-uploaded
+        if st.button("Upload All Templates to S3", key="upload_all_templates"):
+            with st.spinner("Uploading templates to S3..."):
+                batch = upload_templates_to_s3(st.session_state.email_templates)
+            if batch['success']:
+                st.success(f"Uploaded {batch['uploaded']} templates ({batch['unchanged']} unchanged)")
+            else:
+                st.error(f"Failed to upload templates: {batch.get('error', 'Unknown error')}")
     else:
         st.markdown("No email templates generated yet")
     
+    # Cached data is refreshed on its own once S3 changes; this forces it right away
+    if st.button("🔄 Refresh Data",
+                key="refresh_data",
+                help="Reload flights and segments from S3"):
+        clear_data_caches()
+        st.experimental_rerun()
+    
+    # The agent remembers earlier turns of its session; a new session starts from scratch
+    if st.button("🆕 New Agent Session",
+                key="new_agent_session",
+                help="Start a new conversation with the agent"):
+        st.session_state.agent_session_id = f"session-{uuid.uuid4().hex}"
+        st.session_state.chat_history = []
+        st.session_state.flight_context_signature = None
+        st.session_state.agent_last_invoked_at = None
+        st.experimental_rerun()
+    
     st.markdown("---")
     
     # Help section
@@ -559,14 +833,13 @@ st.markdown("# Email Marketing Campaign Generator")
 if st.session_state.active_section == "flights":
     st.markdown("## Select Promotional Flights")
     
-    # Load flight data
-    flight_df = read_s3_csv(BUCKET_NAME, ITEMS_CSV_PATH)
+    # Load the flight facet index (promotional, unexpired flights and per-value bitmaps)
+    flight_index = read_flight_index(BUCKET_NAME, ITEMS_CSV_PATH)
     
-    if flight_df is not None:
-        # Filter to show promotional flights
-        promo_flights = flight_df[(flight_df['PROMOTION'] == 'Yes') & (flight_df['EXPIRED'] != 'Yes')]
+    if flight_index is not None:
+        promo_mask = flight_index.select()
         
-        if promo_flights.empty:
+        if flight_index.count(promo_mask) == 0:
             st.warning("No promotional flights found.")
         else:
             # Display info message
@@ -575,19 +848,20 @@ if st.session_state.active_section == "flights":
             # Add filters in two columns
             col1, col2 = st.columns(2)
             with col1:
-                month_options = ["All"] + sorted(promo_flights['MONTH'].unique().tolist())
-                selected_month = st.selectbox("Filter by Month", month_options)
+                month_counts = flight_index.facet_counts('month', promo_mask)
+                selected_month = st.selectbox("Filter by Month", ["All"] + list(month_counts),
+                                              format_func=lambda m: m if m == "All" else f"{m} ({month_counts[m]})")
                 
             with col2:
-                dest_options = ["All"] + sorted(promo_flights['DST_CITY'].unique().tolist())
-                selected_dest = st.selectbox("Filter by Destination", dest_options)
+                dest_counts = flight_index.facet_counts('destination', promo_mask)
+                selected_dest = st.selectbox("Filter by Destination", ["All"] + list(dest_counts),
+                                             format_func=lambda d: d if d == "All" else f"{d} ({dest_counts[d]})")
             
-            # Apply filters
-            filtered_flights = promo_flights.copy()
-            if selected_month != "All":
-                filtered_flights = filtered_flights[filtered_flights['MONTH'] == selected_month]
-            if selected_dest != "All":
-                filtered_flights = filtered_flights[filtered_flights['DST_CITY'] == selected_dest]
+            # Apply filters as a bitmap AND, then materialize only the matching rows
+            filtered_flights = flight_index.rows(flight_index.select(
+                month=None if selected_month == "All" else selected_month,
+                destination=None if selected_dest == "All" else selected_dest
+            ))
             
             # Display flights in a table
             st.markdown("### Available Promotional Flights")
@@ -694,14 +968,8 @@ elif st.session_state.active_section == "emails":
             st.markdown("### Chat with 1Shot Assistant")
             
             # Check if segments exist
-            segments_exist = False
-            segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH)
-            if segments:
-                flight_ids = [flight['ITEM_ID'] for flight in st.session_state.selected_flights]
-                for segment in segments:
-                    if segment.get('input', {}).get('itemId') in flight_ids:
-                        segments_exist = True
-                        break
+            segmented_ids = set(read_segment_item_ids(BUCKET_NAME, SEGMENTS_OUTPUT_PATH))
+            segments_exist = any(flight['ITEM_ID'] in segmented_ids for flight in st.session_state.selected_flights)
             
             if not segments_exist:
                 st.markdown('<div class="warning-box">No segment data is available yet. The assistant can still generate emails, but they won\'t be personalized based on segment analysis.</div>', unsafe_allow_html=True)
@@ -714,12 +982,8 @@ elif st.session_state.active_section == "emails":
             with chat_container:
                 st.markdown('<div class="chat-container" id="chat-container">', unsafe_allow_html=True)
                 
-                # Display chat history
-                for message in st.session_state.chat_history:
-                    if message["role"] == "user":
-                        st.markdown(f'<div class="chat-message user"><div class="avatar">👤</div><div class="content">{message["content"]}</div></div>', unsafe_allow_html=True)
-                    else:
-                        st.markdown(f'<div class="chat-message assistant"><div class="avatar">🎯</div><div class="content">{message["content"]}</div></div>', unsafe_allow_html=True)
+                # Display the recent chat history; older messages are collapsed
+                render_chat_history(st.session_state.chat_history)
                 
                 st.markdown('</div>', unsafe_allow_html=True)
             
@@ -755,32 +1019,39 @@ elif st.session_state.active_section == "emails":
             
             if send_button and user_input:
                 # Add user message to chat history
-                st.session_state.chat_history.append({"role": "user", "content": user_input})
+                append_chat_message("user", user_input)
                 
-                # Add context about selected flights to the prompt
-                flight_context = "Selected flights:\n"
-                for i, flight in enumerate(st.session_state.selected_flights):
-                    flight_context += f"{i+1}. {flight['SRC_CITY']} to {flight['DST_CITY']} ({flight['AIRLINE']}, {flight['MONTH']}, ${flight['DYNAMIC_PRICE']})\n"
+                # The agent session remembers the flight context, so it is only sent when the selection changes
+                full_prompt, flight_signature = build_agent_prompt(user_input, st.session_state.selected_flights)
                 
-                # Construct the full prompt
-                full_prompt = f"{flight_context}\n\nUser message: {user_input}"
+                # Render the response as it streams in
+                with chat_container:
+                    response_placeholder = st.empty()
+                response_parts = []
+                previous_invoked_at = st.session_state.agent_last_invoked_at
                 
                 with st.spinner("Generating response..."):
-                    # Get response from agent
-                    assistant_response = invoke_agent(full_prompt)
-                    
-                    # Add assistant message to chat history
-                    st.session_state.chat_history.append({"role": "assistant", "content": assistant_response})
+                    for chunk in invoke_agent(full_prompt, st.session_state.agent_session_id):
+                        response_parts.append(chunk)
+                        response_placeholder.markdown(chat_message_html("assistant", "".join(response_parts)), unsafe_allow_html=True)
+                
+                assistant_response = "".join(response_parts)
+                # Only a completed turn is known to have given the agent the flight context
+                if st.session_state.agent_last_invoked_at != previous_invoked_at:
+                    st.session_state.flight_context_signature = flight_signature
+                
+                # Add assistant message to chat history
+                append_chat_message("assistant", assistant_response)
+                
+                # Check if this looks like an email template, now that the full response is in
+                if "Subject:" in assistant_response or "subject:" in assistant_response.lower():
+                    email_content = extract_email_content(assistant_response)
                     
-                    # Check if this looks like an email template
-                    if "Subject:" in assistant_response or "subject:" in assistant_response.lower():
-                        email_content = extract_email_content(assistant_response)
-                        
-                        # Store in session state for preview
-                        if email_content["subject"] and email_content["body"]:
-                            if len(st.session_state.selected_flights) > 0:
-                                flight_id = st.session_state.selected_flights[0]["ITEM_ID"]
-                                st.session_state.email_templates[flight_id] = email_content
+                    # Store in session state for preview
+                    if email_content["subject"] and email_content["body"]:
+                        if len(st.session_state.selected_flights) > 0:
+                            flight_id = st.session_state.selected_flights[0]["ITEM_ID"]
+                            st.session_state.email_templates[flight_id] = email_content
                 
                 # Clear the input but don't directly modify session state
                 st.experimental_rerun()
@@ -788,6 +1059,8 @@ elif st.session_state.active_section == "emails":
             # Clear chat button
             if st.button("Clear Chat"):
                 st.session_state.chat_history = []
+                # Describe the selection again with the next message
+                st.session_state.flight_context_signature = None
                 st.experimental_rerun()
         
         with preview_col:
@@ -880,7 +1153,10 @@ elif st.session_state.active_section == "emails":
                             if result['success']:
                                 st.session_state.template_uploaded = True
                                 st.session_state.template_upload_result = result
-                                st.success(f"Template uploaded successfully: {result['url']}")
+                                if result['uploaded']:
+                                    st.success(f"Template uploaded successfully: {result['url']}")
+                                else:
+                                    st.info(f"Template unchanged, already stored at {result['url']}")
                             else:
                                 st.error(f"Failed to upload template: {result.get('error', 'Unknown error')}")
                 
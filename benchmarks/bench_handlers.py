@@ -0,0 +1,365 @@
+"""Benchmark both Lambda handlers against synthetic data served from an in-process S3.
+
+Replays Bedrock action-group events for every apiPath in flight.yml and
+email.yml and reports p50/p95/p99 latency, peak memory and S3 calls per
+endpoint (rss +MB is how far resident memory rose above where it stood when
+the endpoint's timed calls began, sampled from /proc on Linux):
+
+    python benchmarks/bench_handlers.py --interactions 1000000 --iterations 30
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+
+import numpy as np
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import dataset_cache  # noqa: E402
+from index_bundle import BundleLoader  # noqa: E402
+from fake_s3 import FakeS3  # noqa: E402
+from synthetic_data import AIRLINES, generate_datasets  # noqa: E402
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# The handlers hard-code this bucket
+BUCKET_NAME = 'knowledgebase-bedrock-agent-ab3'
+
+# OpenAPI schema -> handler module serving it
+ACTION_GROUPS = [
+    ('FlightManagement', 'flight.yml', 'lambda_flight_management'),
+    ('EmailGeneration', 'email.yml', 'lambda_email_generation')
+]
+
+# Chance that an optional parameter is sent with a replayed event
+OPTIONAL_PARAMETER_RATE = 0.5
+
+# How often resident memory is sampled while an endpoint is benchmarked
+RSS_SAMPLE_INTERVAL_SECONDS = 0.001
+# ============= END CONFIGURATION =============
+
+
+def format_list(values):
+    """Format an array parameter the way Bedrock passes it to the Lambda"""
+    return '[' + ', '.join(values) + ']'
+
+
+# Parameter name -> sampler(rng, datasets) returning the string value Bedrock would send
+PARAMETER_SAMPLERS = {
+    'month': lambda rng, data: rng.choice(data.promo_months),
+    'destination': lambda rng, data: rng.choice(data.promo_destinations),
+    'airline': lambda rng, data: rng.choice(AIRLINES),
+    'minPrice': lambda rng, data: str(rng.choice([150, 500, 1000])),
+    'maxPrice': lambda rng, data: str(rng.choice([1000, 3000, 9000])),
+    'minDuration': lambda rng, data: str(rng.choice([2, 5, 7])),
+    'maxDuration': lambda rng, data: str(rng.choice([7, 10, 14, 21])),
+    'limit': lambda rng, data: str(rng.choice([10, 25, 50, 100])),
+    'cursor': lambda rng, data: str(rng.choice([0, 25, 50])),
+    'fields': lambda rng, data: rng.choice(['itemId,price,hasSegment', 'itemId,source,destination,month']),
+    'sortBy': lambda rng, data: rng.choice(['price', 'duration', 'month', 'destination']),
+    'sortOrder': lambda rng, data: rng.choice(['asc', 'desc']),
+    'flightId': lambda rng, data: rng.choice(data.segmented_ids),
+    'flightIds': lambda rng, data: format_list(rng.sample(data.segmented_ids, min(len(data.segmented_ids), rng.randint(2, 15)))),
+    'minFlights': lambda rng, data: str(rng.choice([2, 3])),
+    'emailSubject': lambda rng, data: "Exclusive Deal: fly this season!",
+    'emailBody': lambda rng, data: "Dear Valued Traveler,\n\nHere is an offer picked for you.\n\nThe Wanderly Team"
+}
+
+
+def load_endpoints(schema_path):
+    """List (apiPath, parameter specs) for every operation in an OpenAPI schema"""
+    with open(schema_path) as schema_file:
+        schema = yaml.safe_load(schema_file)
+    endpoints = []
+    for api_path, operations in schema.get('paths', {}).items():
+        for http_method, operation in operations.items():
+            endpoints.append((api_path, http_method.upper(), operation.get('parameters', [])))
+    return endpoints
+
+
+def build_event(rng, datasets, action_group, api_path, http_method, parameter_specs):
+    """Build a Bedrock action-group event with sampled parameter values"""
+    parameters = []
+    for spec in parameter_specs:
+        name = spec['name']
+        if not spec.get('required') and rng.random() >= OPTIONAL_PARAMETER_RATE:
+            continue
+        if name not in PARAMETER_SAMPLERS:
+            if spec.get('required'):
+                raise KeyError(f"No sampler for required parameter {name} of {api_path}")
+            continue
+        parameters.append({
+            'name': name,
+            'type': spec.get('schema', {}).get('type', 'string'),
+            'value': PARAMETER_SAMPLERS[name](rng, datasets)
+        })
+    return {
+        'messageVersion': '1.0',
+        'agent': {'name': 'benchmark', 'id': 'BENCH', 'alias': 'TSTALIASID', 'version': 'DRAFT'},
+        'sessionId': f"bench-{rng.randint(0, 10 ** 9)}",
+        'inputText': f"benchmark request for {api_path}",
+        'actionGroup': action_group,
+        'apiPath': api_path,
+        'httpMethod': http_method,
+        'parameters': parameters
+    }
+
+
+def current_rss_bytes():
+    """Resident set size of this process right now, or None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """Track how far resident memory rises above its starting point while a block runs.
+
+    ru_maxrss is a process-wide high-water mark, so once one endpoint has set
+    it every later endpoint would report the same figure; sampling the current
+    RSS from a background thread attributes the growth to the endpoint running.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.baseline = current_rss_bytes()
+        self.peak = self.baseline
+        if self.baseline is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.baseline is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+    def growth_mb(self):
+        """Peak RSS above the starting RSS, or None where it cannot be measured"""
+        if self.baseline is None:
+            return None
+        return round((self.peak - self.baseline) / (1024 * 1024), 1)
+
+
+def build_artifacts(s3):
+    """Run the ingest pipeline so the handlers read snapshots, partitions, segment artifacts and the index bundle"""
+    import travel_data
+    import lambda_data_ingest
+
+    if travel_data.SNAPSHOTS_SUPPORTED:
+        for csv_key in lambda_data_ingest.DATASET_CSV_PATHS:
+            lambda_data_ingest.build_snapshot(BUCKET_NAME, csv_key)
+    else:
+        logger.warning("pyarrow is not installed; benchmarking the CSV path")
+    lambda_data_ingest.build_interaction_partitions(BUCKET_NAME)
+    lambda_data_ingest.build_segment_artifacts(BUCKET_NAME, lambda_data_ingest.SEGMENT_OUTPUT_PATH)
+    lambda_data_ingest.build_index_bundle(BUCKET_NAME)
+    s3.reset_counters()
+
+
+def reset_container_state(module, bundle_dir):
+    """Put a handler module back in the state of a fresh container with nothing in /tmp"""
+    module.dataset_cache.clear()
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    # The benchmark ships no Lambda layer, so a cold container downloads the index bundle
+    module.index_bundles = BundleLoader(search_dirs=[bundle_dir], download_dir=bundle_dir)
+
+
+def bench_endpoint(s3, module, make_event, iterations, warmup, cold, bundle_dir):
+    """Invoke one endpoint repeatedly and collect latency, memory and S3 call counts"""
+    metric_records = []
+
+    def invoke():
+        if cold:
+            reset_container_state(module, bundle_dir)
+        # The handlers print one metrics record per call on stdout; collect it instead
+        output = StringIO()
+        with redirect_stdout(output):
+            response = module.lambda_handler(make_event(), None)
+        records = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+        metric_records.extend(records)
+        return response
+
+    for _ in range(warmup):
+        invoke()
+    metric_records.clear()
+
+    latencies = []
+    s3_calls = []
+    status_codes = {}
+    with RssSampler() as rss:
+        for _ in range(iterations):
+            s3.reset_counters()
+            start = time.perf_counter()
+            response = invoke()
+            latencies.append((time.perf_counter() - start) * 1000)
+            s3_calls.append(dict(s3.counters))
+            code = response['response']['httpStatusCode']
+            status_codes[code] = status_codes.get(code, 0) + 1
+
+    # Mean time per phase, as reported by the handlers themselves
+    phase_totals = {}
+    for record in metric_records:
+        for name, value in record.items():
+            if name.endswith('Ms') and name != 'totalMs':
+                phase_totals[name] = phase_totals.get(name, 0.0) + value
+    phases = {name: round(total / max(len(metric_records), 1), 2) for name, total in sorted(phase_totals.items())}
+
+    # One traced run for the Python heap peak; tracing slows calls down, so it is not timed
+    tracemalloc.start()
+    invoke()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    def mean_of(counter):
+        return round(sum(calls.get(counter, 0) for calls in s3_calls) / len(s3_calls), 2)
+
+    return {
+        "iterations": iterations,
+        "p50Ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95Ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99Ms": round(float(np.percentile(latencies, 99)), 2),
+        "maxMs": round(max(latencies), 2),
+        "heapPeakMb": round(traced_peak / (1024 * 1024), 2),
+        "rssGrowthMb": rss.growth_mb(),
+        "s3GetsPerCall": mean_of('get'),
+        "s3NotModifiedPerCall": mean_of('get_not_modified'),
+        "s3HeadsPerCall": mean_of('head'),
+        "s3PutsPerCall": mean_of('put'),
+        "s3BytesPerCall": mean_of('get_bytes'),
+        "statusCodes": status_codes,
+        "phases": phases
+    }
+
+
+def print_report(results):
+    """Print one line per endpoint"""
+    header = f"{'endpoint':<36}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'heap MB':>10}{'rss +MB':>10}{'GETs':>8}{'304s':>8}{'HEADs':>8}{'MB read':>10}"
+    print(header)
+    print('-' * len(header))
+    for endpoint, result in results.items():
+        print(f"{endpoint:<36}{result['p50Ms']:>10}{result['p95Ms']:>10}{result['p99Ms']:>10}"
+              f"{result['heapPeakMb']:>10}{str(result['rssGrowthMb'] if result['rssGrowthMb'] is not None else '-'):>10}{result['s3GetsPerCall']:>8}"
+              f"{result['s3NotModifiedPerCall']:>8}{result['s3HeadsPerCall']:>8}"
+              f"{round(result['s3BytesPerCall'] / (1024 * 1024), 2):>10}")
+    print()
+    print("Mean phase time (ms) per call")
+    for endpoint, result in results.items():
+        print(f"{endpoint:<36}" + '  '.join(f"{name[:-2]}={value}" for name, value in result['phases'].items()))
+
+
+def main(argv=None):
+    """Generate data, serve it from a fake S3 and benchmark every endpoint"""
+    parser = argparse.ArgumentParser(description="Benchmark the Lambda handlers against synthetic data")
+    parser.add_argument('--interactions', type=int, default=100_000, help="Rows in travel_interactions (10k to 10M)")
+    parser.add_argument('--items', type=int, help="Rows in travel_items (scaled from --interactions by default)")
+    parser.add_argument('--users', type=int, help="Rows in travel_users (scaled from --interactions by default)")
+    parser.add_argument('--segments', type=int, help="Flights in the segment output file")
+    parser.add_argument('--segment-users', type=int, help="Users per segment")
+    parser.add_argument('--iterations', type=int, default=20, help="Timed invocations per endpoint")
+    parser.add_argument('--warmup', type=int, default=2, help="Untimed invocations per endpoint before timing")
+    parser.add_argument('--no-artifacts', action='store_true', help="Skip snapshots, partitions and segment artifacts (the raw-file path)")
+    parser.add_argument('--cold', action='store_true', help="Clear the dataset cache and the downloaded index bundle before every invocation")
+    parser.add_argument('--endpoint', action='append', help="Only benchmark apiPaths containing this text (repeatable)")
+    parser.add_argument('--s3-latency-ms', type=float, default=0, help="Simulated round trip per S3 call")
+    parser.add_argument('--s3-bandwidth-mbps', type=float, help="Simulated S3 transfer rate in megabits per second")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for data generation and event sampling")
+    parser.add_argument('--json-out', help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    # The handlers log at INFO; keep building those records, as Lambda does, but only print warnings
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    logger.addHandler(console)
+
+    print(f"Generating {args.interactions} interactions...", file=sys.stderr)
+    datasets = generate_datasets(args.interactions, args.items, args.users, args.segments,
+                                 args.segment_users, seed=args.seed)
+
+    s3 = FakeS3()
+    for key, body in datasets.objects.items():
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=body)
+    # Every handler gets its client from dataset_cache, so this routes all S3 traffic to the fake
+    dataset_cache._s3_client = s3
+
+    if not args.no_artifacts:
+        print("Building snapshots, partitions and segment artifacts...", file=sys.stderr)
+        build_artifacts(s3)
+
+    # Simulated network costs only apply to the handlers, not to data setup
+    s3.latency_ms = args.s3_latency_ms
+    s3.bandwidth_mbps = args.s3_bandwidth_mbps
+
+    # The handlers' bundle loaders use a scratch directory, not a layer or /tmp/index_bundle left by other runs
+    bundle_dir = tempfile.mkdtemp(prefix='bench-index-bundle-')
+
+    rng = random.Random(args.seed)
+    results = {}
+    for action_group, schema_file, module_name in ACTION_GROUPS:
+        module = __import__(module_name)
+        reset_container_state(module, bundle_dir)
+        for api_path, http_method, parameter_specs in load_endpoints(os.path.join(REPO_ROOT, schema_file)):
+            if args.endpoint and not any(text in api_path for text in args.endpoint):
+                continue
+            print(f"Benchmarking {api_path}...", file=sys.stderr)
+            results[api_path] = bench_endpoint(
+                s3,
+                module,
+                lambda: build_event(rng, datasets, action_group, api_path, http_method, parameter_specs),
+                args.iterations,
+                args.warmup,
+                args.cold,
+                bundle_dir
+            )
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+
+    print_report(results)
+    if args.json_out:
+        with open(args.json_out, 'w') as json_file:
+            json.dump({
+                "scale": {
+                    "interactions": args.interactions,
+                    "items": len(datasets.item_ids),
+                    "segments": len(datasets.segmented_ids),
+                    "objectBytes": {key: len(body) for key, body in datasets.objects.items()}
+                },
+                "artifacts": not args.no_artifacts,
+                "cold": args.cold,
+                "results": results
+            }, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
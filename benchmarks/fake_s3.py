@@ -0,0 +1,117 @@
+import io
+import time
+import hashlib
+import threading
+from collections import Counter
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+
+def client_error(code, status, operation):
+    """Build the ClientError boto3 raises for a failed S3 call"""
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+        operation
+    )
+
+
+class FakeS3:
+    """In-process stand-in for the boto3 S3 client calls the handlers make.
+
+    Objects live in memory and ETags are the MD5 of the body, as for
+    single-part uploads. Conditional (IfNoneMatch / IfMatch) and ranged GETs
+    behave like S3 so the dataset cache takes the same paths it does in
+    Lambda. Every call is counted so a benchmark can report S3 traffic per
+    request. latency_ms and bandwidth_mbps add a simulated round trip and
+    transfer time to each call, so concurrent fetches overlap as they would
+    against S3.
+    """
+
+    def __init__(self, latency_ms=0, bandwidth_mbps=None):
+        self.latency_ms = latency_ms
+        self.bandwidth_mbps = bandwidth_mbps
+        self.objects = {}
+        self.metadata = {}
+        self.etags = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def reset_counters(self):
+        """Zero the call counters"""
+        with self._lock:
+            self.counters.clear()
+
+    def _count(self, **increments):
+        with self._lock:
+            self.counters.update(increments)
+
+    def _wait(self, transferred=0):
+        """Sleep for the simulated round trip and transfer time"""
+        delay = self.latency_ms / 1000
+        if self.bandwidth_mbps:
+            delay += transferred * 8 / (self.bandwidth_mbps * 1_000_000)
+        if delay:
+            time.sleep(delay)
+
+    def _object(self, bucket, key, operation):
+        if (bucket, key) not in self.objects:
+            raise client_error('NoSuchKey' if operation == 'GetObject' else '404', 404, operation)
+        return self.objects[(bucket, key)]
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        self._count(put=1, put_bytes=len(Body))
+        self._wait(len(Body))
+        with self._lock:
+            self.objects[(Bucket, Key)] = Body
+            self.metadata[(Bucket, Key)] = dict(Metadata or {})
+            # Hashed once here so HEADs and conditional GETs cost what they do against S3
+            self.etags[(Bucket, Key)] = f'"{hashlib.md5(Body).hexdigest()}"'
+        return {'ETag': self.etags[(Bucket, Key)]}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count(delete=1)
+        self._wait()
+        with self._lock:
+            for store in (self.objects, self.metadata, self.etags):
+                store.pop((Bucket, Key), None)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count(head=1)
+        self._wait()
+        body = self._object(Bucket, Key, 'HeadObject')
+        return {
+            'ETag': self.etags[(Bucket, Key)],
+            'ContentLength': len(body),
+            'Metadata': self.metadata.get((Bucket, Key), {})
+        }
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfMatch=None, Range=None, **kwargs):
+        self._wait()
+        body = self._object(Bucket, Key, 'GetObject')
+        etag = self.etags[(Bucket, Key)]
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            self._count(get_not_modified=1)
+            raise client_error('304', 304, 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            self._count(get_precondition_failed=1)
+            raise client_error('PreconditionFailed', 412, 'GetObject')
+
+        if Range:
+            start, end = Range.split('=', 1)[1].split('-')
+            body = body[int(start):int(end) + 1 if end else None]
+
+        self._count(get=1, get_bytes=len(body))
+        if self.bandwidth_mbps:
+            time.sleep(len(body) * 8 / (self.bandwidth_mbps * 1_000_000))
+        return {
+            'Body': StreamingBody(io.BytesIO(body), len(body)),
+            'ETag': etag,
+            'ContentLength': len(body),
+            'Metadata': self.metadata.get((Bucket, Key), {})
+        }
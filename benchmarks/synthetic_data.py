@@ -0,0 +1,138 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+# ============= CONFIGURATION CONSTANTS =============
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June',
+          'July', 'August', 'September', 'October', 'November', 'December']
+CITIES = ['Singapore', 'Hong Kong', 'Tokyo', 'Paris', 'London', 'Sydney',
+          'New York', 'Bangkok', 'Seoul', 'Dubai', 'Bali', 'Kuala Lumpur']
+AIRLINES = ['PandaPaw Express', 'KoalaHug Express', 'ButterflyWing Express',
+            'DolphinLeap Airways', 'FoxTail Airlines']
+MEMBER_TIERS = ['Bronze', 'Silver', 'Gold', 'Platinum']
+CABIN_TYPES = ['Economy', 'Premium Economy', 'Business', 'First']
+
+# Share of flights flagged as promotional / expired
+PROMOTION_RATE = 0.3
+EXPIRED_RATE = 0.2
+# ============= END CONFIGURATION =============
+
+
+class SyntheticDatasets:
+    """Generated dataset bodies keyed by S3 key, plus the IDs needed to build requests"""
+
+    def __init__(self, objects, item_ids, segmented_ids, promo_months, promo_destinations):
+        self.objects = objects
+        self.item_ids = item_ids
+        self.segmented_ids = segmented_ids
+        self.promo_months = promo_months
+        self.promo_destinations = promo_destinations
+
+
+def default_scale(interactions):
+    """Derive item, user and segment counts that keep the datasets' proportions at any interaction count"""
+    users = int(np.clip(interactions // 20, 500, 500_000))
+    return {
+        'items': int(np.clip(interactions // 1000, 200, 20_000)),
+        'users': users,
+        'segments': 50,
+        'segment_users': int(np.clip(users // 100, 150, 5_000))
+    }
+
+
+def to_csv_bytes(df):
+    """Serialize a DataFrame the way the datasets are uploaded"""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False)
+    return buffer.getvalue().encode('utf-8')
+
+
+def generate_items(rng, count):
+    """Generate the travel_items table"""
+    item_ids = [f"{i:08x}-{rng_part:04x}-4000-8000-{i:012x}"
+                for i, rng_part in enumerate(rng.integers(0, 0xFFFF, size=count))]
+    return pd.DataFrame({
+        'ITEM_ID': item_ids,
+        'SRC_CITY': rng.choice(CITIES, size=count),
+        'DST_CITY': rng.choice(CITIES, size=count),
+        'AIRLINE': rng.choice(AIRLINES, size=count),
+        'MONTH': rng.choice(MONTHS, size=count),
+        'DYNAMIC_PRICE': rng.integers(150, 9000, size=count),
+        'DURATION_DAYS': rng.integers(2, 21, size=count),
+        'PROMOTION': np.where(rng.random(count) < PROMOTION_RATE, 'Yes', 'No'),
+        'EXPIRED': np.where(rng.random(count) < EXPIRED_RATE, 'Yes', 'No'),
+        'CREATION_TIMESTAMP': rng.integers(1_600_000_000, 1_700_000_000, size=count)
+    })
+
+
+def generate_users(rng, count):
+    """Generate the travel_users table"""
+    return pd.DataFrame({
+        'USER_ID': [str(100000 + i) for i in range(count)],
+        'MEMBER_TIER': rng.choice(MEMBER_TIERS, size=count, p=[0.5, 0.3, 0.15, 0.05]),
+        'AGE': rng.integers(18, 80, size=count),
+        'GENDER': rng.choice(['F', 'M'], size=count)
+    })
+
+
+def generate_interactions(rng, count, item_ids, user_ids):
+    """Generate the travel_interactions table with a long tail of flight popularity"""
+    popularity = 1.0 / (np.arange(len(item_ids)) + 10.0)
+    popularity /= popularity.sum()
+    return pd.DataFrame({
+        'USER_ID': np.asarray(user_ids)[rng.integers(0, len(user_ids), size=count)],
+        'ITEM_ID': np.asarray(item_ids)[rng.choice(len(item_ids), size=count, p=popularity)],
+        'EVENT_TYPE': 'RATING',
+        'EVENT_VALUE': rng.integers(1, 11, size=count),
+        'CABIN_TYPE': rng.choice(CABIN_TYPES, size=count, p=[0.6, 0.2, 0.15, 0.05]),
+        'TIMESTAMP': rng.integers(1_600_000_000, 1_700_000_000, size=count)
+    })
+
+
+def generate_segments(rng, segment_item_ids, user_ids, segment_users):
+    """Generate batch segment job output, one JSON line per flight"""
+    lines = []
+    for item_id in segment_item_ids:
+        members = np.asarray(user_ids)[rng.choice(len(user_ids), size=min(segment_users, len(user_ids)), replace=False)]
+        lines.append(json.dumps({
+            'input': {'itemId': item_id},
+            'output': {'usersList': members.tolist()}
+        }))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def generate_datasets(interactions, items=None, users=None, segments=None, segment_users=None, seed=0,
+                      items_key='data/travel_items.csv', users_key='data/travel_users.csv',
+                      interactions_key='data/travel_interactions.csv',
+                      segment_key='segments/batch_segment_input_ab3.json.out'):
+    """Generate every dataset the handlers read, at the given interaction count"""
+    scale = default_scale(interactions)
+    items = items or scale['items']
+    users = users or scale['users']
+    segments = segments or scale['segments']
+    segment_users = segment_users or scale['segment_users']
+
+    rng = np.random.default_rng(seed)
+    items_df = generate_items(rng, items)
+    users_df = generate_users(rng, users)
+    interactions_df = generate_interactions(rng, interactions, items_df['ITEM_ID'].tolist(), users_df['USER_ID'].tolist())
+
+    # Segments are requested for promotional flights, as the app does
+    promo = items_df[(items_df['PROMOTION'] == 'Yes') & (items_df['EXPIRED'] != 'Yes')]
+    segmented_ids = promo['ITEM_ID'].head(segments).tolist()
+
+    objects = {
+        items_key: to_csv_bytes(items_df),
+        users_key: to_csv_bytes(users_df),
+        interactions_key: to_csv_bytes(interactions_df),
+        segment_key: generate_segments(rng, segmented_ids, users_df['USER_ID'].tolist(), segment_users)
+    }
+    return SyntheticDatasets(
+        objects,
+        items_df['ITEM_ID'].tolist(),
+        segmented_ids,
+        sorted(promo['MONTH'].unique().tolist()),
+        sorted(promo['DST_CITY'].unique().tolist())
+    )
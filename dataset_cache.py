@@ -0,0 +1,320 @@
+import os
+import sys
+import types
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import request_metrics
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# Memory ceiling for parsed datasets kept alive in a warm container
+DATASET_CACHE_MAX_MB = int(os.environ.get('DATASET_CACHE_MAX_MB', '256'))
+
+# Independent S3 objects are fetched concurrently by up to this many threads
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '8'))
+# HTTP connections kept open to S3; at least one per fetch thread so none waits for a socket
+S3_MAX_POOL_CONNECTIONS = max(int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '16')), FETCH_WORKERS)
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', '3'))
+# Containers with more items than this are sized from an even sample of them
+SIZE_SAMPLE_ITEMS = 1000
+# ============= END CONFIGURATION =============
+
+_s3_client = None
+_client_lock = threading.Lock()
+_fetch_pool = None
+
+FETCH_THREAD_PREFIX = 's3-fetch'
+
+
+def get_s3_client():
+    """Return the S3 client shared by every invocation and fetch thread in this container"""
+    global _s3_client
+    if _s3_client is None:
+        # boto3 client creation is not thread-safe, and fetch threads may race to it
+        with _client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3', config=Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+                    tcp_keepalive=True
+                ))
+    return _s3_client
+
+
+def fetch_all(*calls):
+    """Run independent zero-argument fetches concurrently and return their results in order.
+
+    Exceptions are re-raised from the first failing call. Calls made from a
+    fetch thread run inline, so nested fetches cannot exhaust the pool.
+    """
+    global _fetch_pool
+    if len(calls) < 2 or threading.current_thread().name.startswith(FETCH_THREAD_PREFIX):
+        return [call() for call in calls]
+    with _client_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix=FETCH_THREAD_PREFIX)
+    # Create the shared client before the threads need it
+    get_s3_client()
+    futures = [_fetch_pool.submit(call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def is_not_modified(error):
+    """Check whether a ClientError is the 304 answer to a conditional GET"""
+    code = str(error.response.get('Error', {}).get('Code', ''))
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in ('304', 'NotModified') or status == 304
+
+
+def is_missing_object(error):
+    """Check whether a ClientError means the object does not exist (or is not readable)"""
+    code = str(error.response.get('Error', {}).get('Code', ''))
+    return code in ('NoSuchKey', '404', 'NotFound', 'AccessDenied', '403')
+
+
+# Shared by every value, so never counted towards one
+_UNSIZED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def _sampled(items, length):
+    """Return (items to size, how many items each stands for) for a container of the given length"""
+    if length <= SIZE_SAMPLE_ITEMS:
+        return items, 1.0
+    step = -(-length // SIZE_SAMPLE_ITEMS)
+    # Lists, tuples and arrays slice directly; dict views and sets are walked
+    sample = items[::step] if hasattr(items, '__getitem__') else list(itertools.islice(items, 0, None, step))
+    return sample, length / len(sample)
+
+
+def estimate_size(value, raw_size, counted=()):
+    """Estimate the resident size of a cached value in bytes, or raw_size if it cannot be measured.
+
+    pandas objects report their deep memory usage and arrays their buffers;
+    dicts, sequences and other objects are followed through their items,
+    __dict__ and __slots__. Containers longer than SIZE_SAMPLE_ITEMS are sized
+    from an even sample. Objects in counted (e.g. the frame a view was built
+    from) are already paid for and are skipped.
+    """
+    seen = {id(obj) for obj in counted}
+    total = 0.0
+    # (object, weight): an item of a sampled container stands in for weight items
+    stack = [(value, 1.0)]
+    try:
+        while stack:
+            obj, weight = stack.pop()
+            if id(obj) in seen or isinstance(obj, _UNSIZED_TYPES):
+                continue
+            seen.add(id(obj))
+
+            memory_usage = getattr(obj, 'memory_usage', None)
+            if callable(memory_usage):
+                # DataFrame gives a per-column Series, Series and Index an int
+                usage = memory_usage(deep=True)
+                total += weight * int(usage.sum() if hasattr(usage, 'sum') else usage)
+                continue
+            nbytes = getattr(obj, 'nbytes', None)
+            if isinstance(nbytes, int):
+                total += weight * max(sys.getsizeof(obj), nbytes)
+                # Object arrays hold pointers; the objects they point to are sized too
+                if getattr(getattr(obj, 'dtype', None), 'hasobject', False):
+                    items, item_weight = _sampled(obj.reshape(-1), obj.size)
+                    stack.extend((item, weight * item_weight) for item in items)
+                continue
+
+            total += weight * sys.getsizeof(obj)
+            if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+                continue
+            if isinstance(obj, dict):
+                items, item_weight = _sampled(obj.items(), len(obj))
+                for key, item in items:
+                    stack.append((key, weight * item_weight))
+                    stack.append((item, weight * item_weight))
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                items, item_weight = _sampled(obj, len(obj))
+                stack.extend((item, weight * item_weight) for item in items)
+            else:
+                if hasattr(obj, '__dict__'):
+                    stack.append((vars(obj), weight))
+                for slot in getattr(type(obj), '__slots__', ()):
+                    if hasattr(obj, slot):
+                        stack.append((getattr(obj, slot), weight))
+    except Exception as e:
+        logger.warning(f"Could not size a cached {type(value).__name__}: {str(e)}")
+        return raw_size
+    return int(total)
+
+
+class CacheEntry:
+    """A parsed S3 object together with the ETag (and user metadata) it was parsed from"""
+
+    __slots__ = ('value', 'etag', 'metadata', 'size', 'generation', 'derived')
+
+    def __init__(self, value, etag, size, generation, metadata=None):
+        self.value = value
+        self.etag = etag
+        self.metadata = metadata or {}
+        self.size = size
+        self.generation = generation
+        # Views built from value (indexes, lookups), dropped with the entry
+        self.derived = {}
+
+
+class DatasetCache:
+    """Module-level cache of parsed S3 objects that survives warm invocations.
+
+    Entries are revalidated with a conditional GET (If-None-Match) the first
+    time they are used in an invocation, so an unchanged object costs one 304
+    round trip instead of a download and a re-parse. Least recently used
+    entries are evicted once the estimated size passes max_bytes.
+    """
+
+    def __init__(self, max_bytes=DATASET_CACHE_MAX_MB * 1024 * 1024, client_factory=get_s3_client):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._client_factory = client_factory
+        self._entries = OrderedDict()
+        # Objects found missing in the current invocation, so fallbacks do not re-probe them
+        self._missing = {}
+        # (ETag, user metadata) looked up with HEAD in the current invocation
+        self._heads = {}
+        self._lock = threading.RLock()
+        self._generation = 0
+
+    def begin_request(self):
+        """Mark the start of an invocation so entries are revalidated on next use"""
+        with self._lock:
+            self._generation += 1
+            self._missing.clear()
+            self._heads.clear()
+
+    def clear(self):
+        """Drop every cached entry"""
+        with self._lock:
+            self._entries.clear()
+            self._missing.clear()
+            self._heads.clear()
+            self.current_bytes = 0
+
+    def get(self, bucket, key, parser, kind='raw'):
+        """Return parser(body) for s3://bucket/key, reusing the cached value while the ETag matches"""
+        cache_key = (bucket, key, kind)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry.generation == self._generation:
+                self._entries.move_to_end(cache_key)
+                return entry.value
+            if (bucket, key) in self._missing:
+                raise self._missing[(bucket, key)]
+
+        request = {'Bucket': bucket, 'Key': key}
+        if entry is not None:
+            request['IfNoneMatch'] = entry.etag
+
+        try:
+            with request_metrics.phase('s3'):
+                response = self._client_factory().get_object(**request)
+                body = response['Body'].read()
+        except ClientError as e:
+            if entry is not None and is_not_modified(e):
+                request_metrics.add('s3NotModified')
+                logger.info(f"Cache hit for s3://{bucket}/{key} ({kind})")
+                with self._lock:
+                    entry.generation = self._generation
+                    if cache_key in self._entries:
+                        self._entries.move_to_end(cache_key)
+                return entry.value
+            if is_missing_object(e):
+                with self._lock:
+                    self._missing[(bucket, key)] = e
+                    self._drop(bucket, key)
+            raise
+
+        request_metrics.add('s3Gets')
+        request_metrics.add('s3Bytes', len(body))
+        with request_metrics.phase('parse'):
+            value = parser(body)
+        self._store(cache_key, CacheEntry(value, response.get('ETag'), estimate_size(value, len(body)),
+                                          self._generation, response.get('Metadata')))
+        return value
+
+    def etag(self, bucket, key):
+        """Return the current ETag of an object, checked at most once per invocation"""
+        return self._head(bucket, key)[0]
+
+    def metadata(self, bucket, key):
+        """Return the user metadata (x-amz-meta-*) of an object, checked at most once per invocation"""
+        return self._head(bucket, key)[1]
+
+    def _head(self, bucket, key):
+        """Return (ETag, user metadata) from an entry revalidated in this invocation, else from one HEAD"""
+        with self._lock:
+            for (entry_bucket, entry_key, _), entry in self._entries.items():
+                if (entry_bucket, entry_key) == (bucket, key) and entry.generation == self._generation:
+                    return entry.etag, entry.metadata
+            if (bucket, key) in self._heads:
+                return self._heads[(bucket, key)]
+
+        with request_metrics.phase('s3'):
+            response = self._client_factory().head_object(Bucket=bucket, Key=key)
+        request_metrics.add('s3Heads')
+        head = (response.get('ETag'), response.get('Metadata') or {})
+        with self._lock:
+            self._heads[(bucket, key)] = head
+        return head
+
+    def get_derived(self, bucket, key, parser, kind, name, builder):
+        """Return builder(value) for a cached object, built once per ETag"""
+        value = self.get(bucket, key, parser, kind)
+        with self._lock:
+            entry = self._entries.get((bucket, key, kind))
+            if entry is None or entry.value is not value:
+                # The object was too large to cache, so its views are not cached either
+                with request_metrics.phase('parse'):
+                    return builder(value)
+            if name not in entry.derived:
+                with request_metrics.phase('parse'):
+                    derived = builder(value)
+                entry.derived[name] = derived
+                derived_size = estimate_size(derived, entry.size, counted=(value,))
+                entry.size += derived_size
+                self.current_bytes += derived_size
+                self._evict_over_ceiling()
+            return entry.derived[name]
+
+    def _store(self, cache_key, entry):
+        """Insert an entry and evict the least recently used ones above the ceiling"""
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self.current_bytes -= previous.size
+
+            if entry.size > self.max_bytes:
+                logger.warning(f"Not caching s3://{cache_key[0]}/{cache_key[1]}: {entry.size} bytes exceeds the cache ceiling")
+                return
+
+            self._entries[cache_key] = entry
+            self.current_bytes += entry.size
+            self._evict_over_ceiling()
+
+    def _drop(self, bucket, key):
+        """Remove every cached parse of an object that no longer exists"""
+        with self._lock:
+            for cache_key in [k for k in self._entries if k[:2] == (bucket, key)]:
+                self.current_bytes -= self._entries.pop(cache_key).size
+
+    def _evict_over_ceiling(self):
+        """Evict least recently used entries until the cache fits under max_bytes"""
+        with self._lock:
+            while self.current_bytes > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.size
+                logger.info(f"Evicted s3://{evicted_key[0]}/{evicted_key[1]} ({evicted_key[2]}) from dataset cache")
@@ -0,0 +1,126 @@
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+import request_metrics
+from dataset_cache import fetch_all, is_missing_object
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+TEMPLATE_PREFIX = 'email_templates/'
+TEMPLATE_INDEX_NAME = 'index.json'
+TEMPLATE_INDEX_VERSION = 1
+# Versions listed per flight in the index; older template objects stay in S3
+MAX_VERSIONS_PER_FLIGHT = 20
+# Hex digits of the content hash used in template keys
+TEMPLATE_KEY_DIGEST_LENGTH = 16
+# ============= END CONFIGURATION =============
+
+
+def format_template(subject, body):
+    """Render a template as the text file stored in S3"""
+    return f"Subject: {subject}\n\n{body}"
+
+
+def template_digest(subject, body):
+    """SHA-256 of a template's rendered content"""
+    return hashlib.sha256(format_template(subject, body).encode('utf-8')).hexdigest()
+
+
+class EmailTemplateStore:
+    """Content-addressed email templates under one S3 prefix.
+
+    Each template is stored at <prefix><flightId>/<content hash>.txt, so a
+    template whose subject and body are unchanged maps to an object that
+    already exists and is not uploaded again. <prefix>index.json lists the
+    stored versions of every flight, newest last; saving content that is
+    already stored moves its version to the end again.
+    """
+
+    def __init__(self, s3_client, bucket, prefix=TEMPLATE_PREFIX):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @property
+    def index_key(self):
+        return f"{self.prefix}{TEMPLATE_INDEX_NAME}"
+
+    def template_key(self, flight_id, digest):
+        """S3 key of one template version"""
+        return f"{self.prefix}{flight_id}/{digest[:TEMPLATE_KEY_DIGEST_LENGTH]}.txt"
+
+    def load_index(self):
+        """Read the version index, or an empty one when none has been written"""
+        try:
+            with request_metrics.phase('s3'):
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.index_key)
+                index = json.loads(response['Body'].read())
+            request_metrics.add('s3Gets')
+        except ClientError as e:
+            if not is_missing_object(e):
+                raise
+            index = {}
+        if index.get('version') != TEMPLATE_INDEX_VERSION:
+            index = {"version": TEMPLATE_INDEX_VERSION, "flights": {}}
+        return index
+
+    def _put(self, key, body, content_type):
+        with request_metrics.phase('s3'):
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type)
+        request_metrics.add('s3Puts')
+
+    def save_many(self, templates):
+        """Store (flight_id, subject, body) templates, uploading only content not stored yet.
+
+        New template objects are uploaded concurrently, then the index is
+        rewritten once if any flight's newest version changed. Returns one
+        result per template, in order, with uploaded=False for templates
+        whose content was already stored.
+        """
+        index = self.load_index()
+        saved_at = datetime.now(timezone.utc).isoformat()
+
+        results = []
+        uploads = {}
+        index_changed = False
+        for flight_id, subject, body in templates:
+            digest = template_digest(subject, body)
+            key = self.template_key(flight_id, digest)
+            versions = index['flights'].setdefault(flight_id, [])
+            stored = next((version for version in versions if version['sha256'] == digest), None)
+            if stored is None:
+                if key not in uploads:
+                    uploads[key] = format_template(subject, body).encode('utf-8')
+                versions.append({"sha256": digest, "key": key, "subject": subject, "savedAt": saved_at})
+                del versions[:-MAX_VERSIONS_PER_FLIGHT]
+                index_changed = True
+            elif stored is not versions[-1]:
+                # Reverting to an earlier template makes it the newest version again, without re-uploading it
+                versions.remove(stored)
+                stored['savedAt'] = saved_at
+                versions.append(stored)
+                index_changed = True
+            results.append({"flightId": flight_id, "key": key, "sha256": digest, "uploaded": stored is None})
+
+        if uploads:
+            fetch_all(*[lambda key=key, body=body: self._put(key, body, 'text/plain; charset=utf-8')
+                        for key, body in uploads.items()])
+        if index_changed:
+            index['updatedAt'] = saved_at
+            # Read-modify-write: a concurrent save can drop the other's index entry, never its template object
+            self._put(self.index_key, json.dumps(index).encode('utf-8'), 'application/json')
+        logger.info(f"Stored {len(uploads)} new of {len(results)} email templates under s3://{self.bucket}/{self.prefix}")
+        return results
+
+    def save(self, flight_id, subject, body):
+        """Store one template; see save_many"""
+        return self.save_many([(flight_id, subject, body)])[0]
+
+    def versions(self, flight_id):
+        """Stored versions of a flight's template, oldest first"""
+        return self.load_index()['flights'].get(flight_id, [])
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+# ============= CONFIGURATION CONSTANTS =============
+# Facets answered by bitmaps: request name -> items column
+FACET_COLUMNS = {
+    'month': 'MONTH',
+    'destination': 'DST_CITY',
+    'airline': 'AIRLINE'
+}
+# Numeric ranges answered by sorted indexes: request name -> items column
+RANGE_COLUMNS = {
+    'price': 'DYNAMIC_PRICE',
+    'duration': 'DURATION_DAYS'
+}
+# ============= END CONFIGURATION =============
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(bitmaps):
+        """Number of set bits in each byte"""
+        return np.bitwise_count(bitmaps)
+else:  # numpy < 2.0
+    _BYTE_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def popcount(bitmaps):
+        """Number of set bits in each byte"""
+        return _BYTE_POPCOUNT[bitmaps]
+
+
+def pack(flags):
+    """Pack a boolean row mask into a bitmap, 8 rows per byte"""
+    return np.packbits(np.asarray(flags, dtype=bool))
+
+
+class Facet:
+    """Bitmaps over the items rows for every value of one column.
+
+    Values are matched case-insensitively; values holds the first spelling
+    seen of each, sorted, and bitmaps[i] marks the rows holding values[i].
+    """
+
+    def __init__(self, values, bitmaps):
+        self.values = values
+        self.bitmaps = bitmaps
+        self._positions = {value.lower(): i for i, value in enumerate(values)}
+
+    @classmethod
+    def build(cls, column):
+        """Build a facet from an items column"""
+        # Lowercase each distinct value once rather than every row
+        raw_codes, raw_values = pd.factorize(column)
+        value_codes, keys = pd.factorize(pd.Index(raw_values).astype(str).str.lower(), sort=True)
+        codes = np.where(raw_codes >= 0, value_codes[raw_codes], -1) if len(raw_values) else raw_codes
+        # Display each value as it is first spelled in the data (factorize keeps first-seen order)
+        first_seen = np.unique(value_codes, return_index=True)[1]
+        values = [str(raw_values[position]) for position in first_seen]
+        bitmaps = np.stack([pack(codes == code) for code in range(len(keys))]) if len(keys) else \
+            np.zeros((0, (len(column) + 7) // 8), dtype=np.uint8)
+        return cls(values, bitmaps)
+
+    def bitmap(self, value):
+        """Bitmap of the rows holding value (any case), or None when no row does"""
+        position = self._positions.get(str(value).lower())
+        return None if position is None else self.bitmaps[position]
+
+    def counts(self, mask):
+        """Rows of each value within mask, for the values present in it"""
+        counts = popcount(self.bitmaps & mask).sum(axis=1, dtype=np.int64)
+        return {value: int(count) for value, count in zip(self.values, counts) if count}
+
+
+class RangeIndex:
+    """Row positions of one numeric column sorted by value, for range queries.
+
+    values is the sorted column with missing values dropped and order the
+    row position of each; a [low, high] range is two binary searches and
+    the rows between them, with no scan of the column.
+    """
+
+    def __init__(self, values, order, row_count):
+        self.values = values
+        self.order = order
+        self.row_count = row_count
+
+    @classmethod
+    def build(cls, column):
+        """Build a range index from an items column"""
+        values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+        present = np.flatnonzero(~np.isnan(values))
+        order = present[np.argsort(values[present], kind='stable')]
+        return cls(values[order], order, len(column))
+
+    def bitmap(self, low=None, high=None):
+        """Bitmap of the rows with low <= value <= high (None bounds are open)"""
+        start = 0 if low is None else np.searchsorted(self.values, low, side='left')
+        end = len(self.values) if high is None else np.searchsorted(self.values, high, side='right')
+        flags = np.zeros(self.row_count, dtype=bool)
+        flags[self.order[start:end]] = True
+        return pack(flags)
+
+
+class FlightFacetIndex:
+    """Facet bitmaps over the items table for promotional-flight queries.
+
+    Each row of the items table is one bit. active marks the promotional,
+    unexpired flights; each facet has a bitmap per value, and price and
+    duration ranges become bitmaps through sorted range indexes. A query is
+    a bitwise AND of packed bitmaps (n / 8 bytes each), and facet counts are
+    popcounts, so neither scans strings or builds DataFrames.
+    """
+
+    def __init__(self, items_df, active, facets, ranges):
+        self.items_df = items_df
+        self.active = active
+        self.facets = facets
+        self.ranges = ranges
+
+    @classmethod
+    def build(cls, items_df):
+        """Build the index from the items table (ITEM_COLUMNS)"""
+        items_df = items_df.reset_index(drop=True)
+        promotion = items_df['PROMOTION'].astype(str) == 'Yes'
+        expired = items_df['EXPIRED'].astype(str) == 'Yes'
+        facets = {name: Facet.build(items_df[column]) for name, column in FACET_COLUMNS.items()}
+        ranges = {name: RangeIndex.build(items_df[column]) for name, column in RANGE_COLUMNS.items()}
+        return cls(items_df, pack(promotion & ~expired), facets, ranges)
+
+    def select(self, **filters):
+        """Bitmap of the active flights matching every given filter (None values are ignored).
+
+        Facet filters take a value; range filters take a (low, high) pair
+        whose None bounds are open.
+        """
+        mask = self.active
+        for name, value in filters.items():
+            if value is None or value == '':
+                continue
+            if name in self.ranges:
+                low, high = value
+                if low is None and high is None:
+                    continue
+                mask = mask & self.ranges[name].bitmap(low, high)
+                continue
+            bitmap = self.facets[name].bitmap(value)
+            if bitmap is None:
+                return np.zeros_like(self.active)
+            mask = mask & bitmap
+        return mask
+
+    def count(self, mask):
+        """Number of rows in a bitmap"""
+        return int(popcount(mask).sum(dtype=np.int64))
+
+    def facet_counts(self, name, mask):
+        """Value -> row count of one facet within a bitmap, sorted by value"""
+        return self.facets[name].counts(mask)
+
+    def positions(self, mask):
+        """Row positions in a bitmap, ascending"""
+        return np.flatnonzero(np.unpackbits(mask, count=len(self.items_df)))
+
+    def rows(self, mask):
+        """The items rows in a bitmap"""
+        return self.items_df.iloc[self.positions(mask)]
@@ -0,0 +1,370 @@
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+import travel_data
+import segment_data
+import request_metrics
+from dataset_cache import get_s3_client, is_missing_object
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# Pointer object naming the current bundle; bundles are stored under BUNDLE_PREFIX by version
+BUNDLE_POINTER_KEY = 'indexes/CURRENT.json'
+BUNDLE_PREFIX = 'indexes/bundles/'
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_MAGIC = b'TRVLIDX\x00'
+# Sections start on this boundary so arrays can be mapped in place
+BUNDLE_ALIGNMENT = 64
+# A Lambda layer holding index_bundle/CURRENT.json and index_bundle/<version>.bin is mounted here
+BUNDLE_LAYER_DIR = os.environ.get('INDEX_BUNDLE_DIR', '/opt/index_bundle')
+# Newer versions than the layer's are downloaded here, once per container
+BUNDLE_DOWNLOAD_DIR = '/tmp/index_bundle'
+# Larger bundles are not downloaded (Lambda's /tmp is 512 MB by default); handlers read S3 instead
+BUNDLE_DOWNLOAD_MAX_BYTES = 256 * 1024 * 1024
+# ============= END CONFIGURATION =============
+
+_PREAMBLE = struct.Struct('<8sQ')
+
+
+def bundle_key(version):
+    """S3 key of one bundle version"""
+    return f"{BUNDLE_PREFIX}{version}.bin"
+
+
+def bundle_version(sources, sections):
+    """Version of a bundle; the same sources and sections always give the same version"""
+    digest = hashlib.sha256(json.dumps(
+        {"format": BUNDLE_FORMAT_VERSION, "sources": sources, "sections": sorted(sections)}, sort_keys=True
+    ).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _aligned(offset):
+    return -(-offset // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+
+def pack_bundle(sections, sources, datasets, meta):
+    """Serialize named sections (bytes or numpy arrays) into a bundle; returns (version, body).
+
+    Layout: magic, header length, JSON header, then each section at an
+    aligned offset. The header records every section's offset and length,
+    and the dtype and shape of arrays, so readers can map them without copying.
+    """
+    version = bundle_version(sources, sections)
+    entries = {}
+    chunks = []
+    offset = 0
+    for name, value in sections.items():
+        if isinstance(value, np.ndarray):
+            array = np.ascontiguousarray(value)
+            entry = {"dtype": array.dtype.str, "shape": list(array.shape)}
+            data = array.tobytes()
+        else:
+            entry = {}
+            data = bytes(value)
+        padding = _aligned(offset) - offset
+        chunks.append(b'\x00' * padding)
+        offset += padding
+        entries[name] = dict(entry, offset=offset, length=len(data))
+        chunks.append(data)
+        offset += len(data)
+
+    header = json.dumps({
+        "formatVersion": BUNDLE_FORMAT_VERSION,
+        "version": version,
+        "builtAt": datetime.now(timezone.utc).isoformat(),
+        "sources": sources,
+        "datasets": datasets,
+        "meta": meta,
+        "sections": entries
+    }).encode('utf-8')
+    preamble = _PREAMBLE.pack(BUNDLE_MAGIC, len(header)) + header
+    preamble += b'\x00' * (_aligned(len(preamble)) - len(preamble))
+    return version, preamble + b''.join(chunks)
+
+
+def build_bundle(items_key, items_df, sources, segment_key=None, manifest=None, stats=None, membership=None):
+    """Bundle the item table, its flight facet index and, when given, a segment file's artifacts.
+
+    items_df holds ITEM_COLUMNS in the order the handlers read them;
+    sources maps every dataset key the indexes were built from to its ETag.
+    Returns (version, body).
+    """
+    from flight_index import FlightFacetIndex
+
+    flight_index = FlightFacetIndex.build(items_df)
+    sections = {
+        'items': flight_index.items_df.to_csv(index=False).encode('utf-8'),
+        'flights.active': flight_index.active
+    }
+    for name, facet in flight_index.facets.items():
+        sections[f'flights.facet.{name}'] = facet.bitmaps
+    for name, range_index in flight_index.ranges.items():
+        sections[f'flights.range.{name}.values'] = range_index.values
+        sections[f'flights.range.{name}.order'] = range_index.order
+    datasets = {"items": items_key}
+    meta = {"facets": {name: facet.values for name, facet in flight_index.facets.items()},
+            "ranges": list(flight_index.ranges)}
+
+    if segment_key and (manifest or stats or membership is not None):
+        datasets["segments"] = segment_key
+    if manifest:
+        sections['segments.manifest'] = json.dumps(manifest).encode('utf-8')
+    if stats:
+        sections['segments.stats'] = json.dumps(stats).encode('utf-8')
+    if membership is not None:
+        sections['membership.user_ids'] = '\n'.join(membership.user_ids).encode('utf-8')
+        for name in ('flight_offsets', 'flight_members', 'user_offsets', 'user_flights'):
+            sections[f'membership.{name}'] = getattr(membership, name)
+        if membership.user_tiers is not None:
+            sections['membership.user_tiers'] = membership.user_tiers
+        meta["membership"] = {"itemIds": membership.item_ids, "sources": membership.sources, "tiers": membership.tiers}
+
+    return pack_bundle(sections, sources, datasets, meta)
+
+
+def build_bundle_pointer(version, key, size):
+    """Build the pointer object naming the current bundle"""
+    return {
+        "formatVersion": BUNDLE_FORMAT_VERSION,
+        "version": version,
+        "key": key,
+        "bytes": size,
+        "updatedAt": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def parse_bundle_pointer(body):
+    """Parse a bundle pointer"""
+    return json.loads(body)
+
+
+def write_local_bundle(directory, pointer, body):
+    """Write a bundle and its pointer into a directory laid out for a Lambda layer (index_bundle/)"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{pointer['version']}.bin"), 'wb') as bundle_file:
+        bundle_file.write(body)
+    with open(os.path.join(directory, 'CURRENT.json'), 'w') as pointer_file:
+        json.dump(pointer, pointer_file)
+
+
+class IndexBundle:
+    """A bundle mapped into memory, with its indexes built lazily from the mapped sections.
+
+    Arrays are read-only views of the mapping, so a bundle costs page cache
+    rather than heap, and only the sections a request touches are paged in.
+    Every accessor takes the dataset key it is asked for and returns None
+    when the bundle does not hold that dataset. The bundle does not check
+    its own freshness: callers use a section only while the ETags it was
+    built from are current (is_current, or the sources recorded in segment
+    artifacts), as for the same artifacts read from S3.
+    """
+
+    def __init__(self, buffer):
+        magic, header_length = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError("Not an index bundle")
+        self.header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+        if self.header.get('formatVersion') != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index bundle format {self.header.get('formatVersion')}")
+        self._buffer = buffer
+        self._data_start = _aligned(_PREAMBLE.size + header_length)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        """Map a bundle file read-only"""
+        with open(path, 'rb') as bundle_file:
+            return cls(mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @property
+    def version(self):
+        return self.header['version']
+
+    @property
+    def sources(self):
+        return self.header['sources']
+
+    def has(self, name):
+        return name in self.header['sections']
+
+    def is_current(self, key, current_etag):
+        """Check that the bundle was built from the current version of a dataset"""
+        return key in self.sources and segment_data.sources_are_fresh({key: self.sources[key]}, current_etag)
+
+    def section_bytes(self, name):
+        """Copy of a bytes section"""
+        entry = self.header['sections'][name]
+        start = self._data_start + entry['offset']
+        return bytes(self._buffer[start:start + entry['length']])
+
+    def array(self, name):
+        """Read-only array view of an array section"""
+        entry = self.header['sections'][name]
+        dtype = np.dtype(entry['dtype'])
+        count = entry['length'] // dtype.itemsize
+        if not count:
+            return np.zeros(entry['shape'], dtype=dtype)
+        return np.frombuffer(self._buffer, dtype=dtype, count=count,
+                             offset=self._data_start + entry['offset']).reshape(entry['shape'])
+
+    def _view(self, name, builder):
+        with self._lock:
+            if name not in self._views:
+                self._views[name] = builder()
+            return self._views[name]
+
+    def item_records(self, key):
+        """ITEM_ID -> row dicts of the items table, parsed without pandas"""
+        if self.header['datasets'].get('items') != key:
+            return None
+        return self._view('item_records', lambda: travel_data.parse_records(
+            self.section_bytes('items'), 'ITEM_ID', travel_data.ITEM_COLUMNS))
+
+    def flight_index(self, key):
+        """The promotional-flight facet index of the items table"""
+        if self.header['datasets'].get('items') != key:
+            return None
+
+        def build():
+            from flight_index import Facet, FlightFacetIndex, RangeIndex
+
+            items_df = travel_data.parse_csv(self.section_bytes('items'), travel_data.ITEM_COLUMNS,
+                                             travel_data.dataset_dtypes(key))
+            meta = self.header['meta']
+            facets = {name: Facet(values, self.array(f'flights.facet.{name}'))
+                      for name, values in meta['facets'].items()}
+            ranges = {name: RangeIndex(self.array(f'flights.range.{name}.values'),
+                                       self.array(f'flights.range.{name}.order'), len(items_df))
+                      for name in meta['ranges']}
+            return FlightFacetIndex(items_df, self.array('flights.active'), facets, ranges)
+
+        return self._view('flight_index', build)
+
+    def _segment_section(self, segment_key, name):
+        return self.header['datasets'].get('segments') == segment_key and self.has(name)
+
+    def segment_manifest(self, segment_key):
+        """The segment manifest of a segment output file"""
+        if not self._segment_section(segment_key, 'segments.manifest'):
+            return None
+        return self._view('segment_manifest', lambda: segment_data.parse_segment_manifest(
+            self.section_bytes('segments.manifest')))
+
+    def segment_stats(self, segment_key):
+        """The per-flight segment statistics of a segment output file"""
+        if not self._segment_section(segment_key, 'segments.stats'):
+            return None
+        return self._view('segment_stats', lambda: segment_data.parse_segment_stats(
+            self.section_bytes('segments.stats')))
+
+    def segment_membership(self, segment_key):
+        """The segment membership index of a segment output file, with member tiers when they were attached"""
+        if not self._segment_section(segment_key, 'membership.user_ids'):
+            return None
+
+        def build():
+            meta = self.header['meta']['membership']
+            user_ids = self.section_bytes('membership.user_ids').decode('utf-8')
+            return segment_data.SegmentMembershipIndex(
+                user_ids.split('\n') if user_ids else [], meta['itemIds'],
+                self.array('membership.flight_offsets'), self.array('membership.flight_members'),
+                self.array('membership.user_offsets'), self.array('membership.user_flights'),
+                meta['sources'], meta['tiers'],
+                self.array('membership.user_tiers') if self.has('membership.user_tiers') else None
+            )
+
+        return self._view('segment_membership', build)
+
+
+class BundleLoader:
+    """The index bundle of this container, mapped at init and kept at the version the S3 pointer names.
+
+    At init the bundle shipped in the Lambda layer (or left in /tmp by an
+    earlier container) is mapped without any S3 call. current() checks the
+    pointer once per invocation through the dataset cache (a 304 while it is
+    unchanged) and, when it names another version, maps that version from
+    disk or downloads it to /tmp once.
+    """
+
+    def __init__(self, search_dirs=None, download_dir=BUNDLE_DOWNLOAD_DIR):
+        self.search_dirs = list(search_dirs or [BUNDLE_LAYER_DIR, download_dir])
+        self.download_dir = download_dir
+        self._lock = threading.Lock()
+        self.bundle = self._open_local()
+
+    def _open_local(self, version=None):
+        """Map a bundle version from the search directories, or the one their CURRENT.json names"""
+        for directory in self.search_dirs:
+            try:
+                if version is None:
+                    with open(os.path.join(directory, 'CURRENT.json')) as pointer_file:
+                        local_version = parse_bundle_pointer(pointer_file.read())['version']
+                else:
+                    local_version = version
+                path = os.path.join(directory, f"{local_version}.bin")
+                if os.path.exists(path):
+                    bundle = IndexBundle.open(path)
+                    logger.info(f"Mapped index bundle {bundle.version} from {path}")
+                    return bundle
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring index bundle in {directory}: {str(e)}")
+        return None
+
+    def _download(self, bucket, pointer):
+        """Download a bundle version to /tmp and map it; older downloads are removed"""
+        if pointer.get('bytes', 0) > BUNDLE_DOWNLOAD_MAX_BYTES:
+            logger.warning(f"Index bundle {pointer['version']} is too large to download ({pointer['bytes']} bytes)")
+            return None
+        os.makedirs(self.download_dir, exist_ok=True)
+        filename = f"{pointer['version']}.bin"
+        path = os.path.join(self.download_dir, filename)
+        partial = f"{path}.part"
+        with request_metrics.phase('s3'):
+            response = get_s3_client().get_object(Bucket=bucket, Key=pointer['key'])
+            with open(partial, 'wb') as bundle_file:
+                shutil.copyfileobj(response['Body'], bundle_file)
+        request_metrics.add('s3Gets')
+        request_metrics.add('s3Bytes', os.path.getsize(partial))
+        os.replace(partial, path)
+
+        # A mapped file stays readable after it is unlinked, so older versions can go
+        for name in os.listdir(self.download_dir):
+            if name.endswith('.bin') and name != filename:
+                os.remove(os.path.join(self.download_dir, name))
+        logger.info(f"Downloaded index bundle {pointer['version']} to {path}")
+        return IndexBundle.open(path)
+
+    def current(self, cache, bucket):
+        """Return the bundle the S3 pointer names, or None when there is no pointer or it cannot be used"""
+        try:
+            pointer = cache.get(bucket, BUNDLE_POINTER_KEY, parse_bundle_pointer, 'json')
+        except ClientError as e:
+            if is_missing_object(e):
+                return None
+            raise
+        if pointer.get('formatVersion') != BUNDLE_FORMAT_VERSION:
+            return None
+
+        bundle = self.bundle
+        if bundle is not None and bundle.version == pointer['version']:
+            return bundle
+        with self._lock:
+            if self.bundle is None or self.bundle.version != pointer['version']:
+                self.bundle = self._open_local(pointer['version']) or self._download(bucket, pointer)
+            bundle = self.bundle
+        return bundle if bundle is not None and bundle.version == pointer['version'] else None
@@ -0,0 +1,173 @@
+import io
+import json
+import zlib
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import travel_data
+import segment_data
+from dataset_cache import fetch_all, is_missing_object
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# Interactions are hash-bucketed by ITEM_ID into this many partition objects,
+# so one flight's analysis reads about 1/PARTITION_COUNT of the dataset
+PARTITION_COUNT = 256
+PARTITION_PREFIX = 'data/partitions/'
+PARTITION_FORMAT_VERSION = 1
+# ============= END CONFIGURATION =============
+
+
+def partition_of(item_id, partition_count=PARTITION_COUNT):
+    """Return the partition holding an ITEM_ID's interactions (CRC32, so stable across processes)"""
+    return zlib.crc32(str(item_id).encode('utf-8')) % partition_count
+
+
+def partition_base(csv_key):
+    """Map data/travel_interactions.csv to data/partitions/travel_interactions"""
+    filename = csv_key.rsplit('/', 1)[-1]
+    if filename.endswith('.csv'):
+        filename = filename[:-len('.csv')]
+    return f"{PARTITION_PREFIX}{filename}"
+
+
+def partition_manifest_key(csv_key):
+    """Map data/travel_interactions.csv to data/partitions/travel_interactions.manifest.json"""
+    return f"{partition_base(csv_key)}.manifest.json"
+
+
+def partition_key(csv_key, partition, partition_format):
+    """Map data/travel_interactions.csv to data/partitions/travel_interactions.p007.parquet"""
+    extension = 'parquet' if partition_format == 'parquet' else 'csv'
+    return f"{partition_base(csv_key)}.p{partition:03d}.{extension}"
+
+
+def partition_format():
+    """Write partitions as Parquet when pyarrow is available, CSV otherwise"""
+    return 'parquet' if travel_data.SNAPSHOTS_SUPPORTED else 'csv'
+
+
+def split_partitions(df, partition_count=PARTITION_COUNT):
+    """Yield (partition, rows) for every non-empty partition, rows sorted by ITEM_ID"""
+    item_ids = df['ITEM_ID'].astype('category')
+    # Hash each distinct ID once rather than once per row
+    partition_codes = np.array([partition_of(item_id, partition_count) for item_id in item_ids.cat.categories],
+                               dtype=np.int32)
+    partitions = partition_codes[item_ids.cat.codes.to_numpy()] if len(partition_codes) else np.zeros(0, np.int32)
+
+    for partition, rows in df.groupby(partitions, sort=True):
+        rows = rows.sort_values('ITEM_ID', kind='stable').reset_index(drop=True)
+        # Drop categories of other partitions so each object only carries its own IDs
+        for column in rows.columns:
+            if isinstance(rows[column].dtype, pd.CategoricalDtype):
+                rows[column] = rows[column].cat.remove_unused_categories()
+        yield int(partition), rows
+
+
+def partition_digest(rows):
+    """Hash the content of a partition, independent of how it is serialized"""
+    digest = hashlib.sha256(','.join(rows.columns).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def serialize_partition(rows, partition_format):
+    """Serialize a partition as Parquet or CSV bytes"""
+    if partition_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink, compression='zstd')
+        return sink.getvalue().to_pybytes()
+    buffer = io.StringIO()
+    rows.to_csv(buffer, index=False)
+    return buffer.getvalue().encode('utf-8')
+
+
+def build_partition_manifest(partitions, sources, partition_count, partition_format):
+    """Build the manifest; partitions maps each partition number to its key, ETag, row count and digest"""
+    return {
+        "version": PARTITION_FORMAT_VERSION,
+        "builtAt": datetime.now(timezone.utc).isoformat(),
+        "sources": sources,
+        "partitionCount": partition_count,
+        "format": partition_format,
+        "partitions": {str(partition): entry for partition, entry in sorted(partitions.items())}
+    }
+
+
+def parse_partition_manifest(body):
+    """Parse a partition manifest"""
+    return json.loads(body)
+
+
+def partitions_are_fresh(manifest, current_etag):
+    """Check that a partition manifest is current for the CSV it was built from"""
+    if not manifest or manifest.get('version') != PARTITION_FORMAT_VERSION:
+        return False
+    return segment_data.sources_are_fresh(manifest.get('sources', {}), current_etag)
+
+
+def partition_entries(manifest, item_ids):
+    """Return the manifest entries of the partitions holding item_ids; empty partitions have none"""
+    partition_count = manifest['partitionCount']
+    partitions = sorted({partition_of(item_id, partition_count) for item_id in item_ids})
+    return [manifest['partitions'][str(partition)] for partition in partitions
+            if str(partition) in manifest['partitions']]
+
+
+def parse_partition(body, key, columns=None, dtypes=None):
+    """Parse a partition object body, by the format its key names"""
+    if key.endswith('.parquet'):
+        return travel_data.parse_snapshot(body, columns, dtypes=dtypes)
+    return travel_data.parse_csv(body, columns, dtypes)
+
+
+def combine_partitions(frames, item_ids, columns=None, filters=None, dtypes=None):
+    """Concatenate partition frames and keep only the rows of item_ids that pass filters"""
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+    # Each partition has its own categories, which concat would widen to object
+    df = travel_data.apply_schema(pd.concat(frames, ignore_index=True), dtypes)
+    return travel_data.apply_filters(df, [('ITEM_ID', 'in', list(item_ids))] + list(filters or [])).reset_index(drop=True)
+
+
+def read_item_interactions(cache, bucket, csv_key, item_ids, columns=None, filters=None):
+    """Read the interactions of item_ids through a DatasetCache, fetching only their partitions.
+
+    Returns None when the partition store is missing or older than the CSV,
+    so callers can fall back to reading the whole dataset.
+    """
+    manifest_key = partition_manifest_key(csv_key)
+    try:
+        manifest = cache.get(bucket, manifest_key, parse_partition_manifest, 'json')
+    except ClientError as e:
+        if is_missing_object(e):
+            return None
+        raise
+
+    if not partitions_are_fresh(manifest, lambda key: cache.etag(bucket, key)):
+        logger.warning(f"Ignoring stale interaction partitions s3://{bucket}/{manifest_key}")
+        return None
+    if manifest.get('format') == 'parquet' and not travel_data.SNAPSHOTS_SUPPORTED:
+        return None
+
+    projection = ','.join(columns) if columns else '*'
+    dtypes = travel_data.dataset_dtypes(csv_key)
+
+    def read_partition(entry):
+        return cache.get(bucket, entry['key'], lambda body: parse_partition(body, entry['key'], columns, dtypes),
+                         f'partition:{projection}')
+
+    entries = partition_entries(manifest, item_ids)
+    frames = fetch_all(*[lambda entry=entry: read_partition(entry) for entry in entries])
+    return combine_partitions(frames, item_ids, columns, filters, dtypes)
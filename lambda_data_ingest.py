@@ -0,0 +1,343 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+
+import travel_data
+import index_bundle
+import segment_data
+import interaction_partitions
+from dataset_cache import DatasetCache, get_s3_client, is_missing_object
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# ============= CONFIGURATION CONSTANTS =============
+# S3 bucket configuration
+BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'knowledgebase-bedrock-agent-ab3')
+
+# Raw datasets that get a typed Parquet snapshot
+DATASET_CSV_PATHS = [
+    'data/travel_items.csv',
+    'data/travel_users.csv',
+    'data/travel_interactions.csv'
+]
+ITEMS_CSV_PATH = 'data/travel_items.csv'
+USERS_CSV_PATH = 'data/travel_users.csv'
+INTERACTIONS_CSV_PATH = 'data/travel_interactions.csv'
+
+# Batch segment job output that gets precomputed statistics and indexes
+SEGMENT_OUTPUT_PATH = 'segments/batch_segment_input_ab3.json.out'
+# ============= END CONFIGURATION =============
+
+
+def build_snapshot(bucket, csv_key):
+    """Convert one travel CSV into its typed Parquet snapshot"""
+    if not travel_data.SNAPSHOTS_SUPPORTED:
+        raise RuntimeError("pyarrow is required to build snapshots")
+
+    s3_client = get_s3_client()
+    logger.info(f"Building snapshot for s3://{bucket}/{csv_key}")
+    response = s3_client.get_object(Bucket=bucket, Key=csv_key)
+    csv_body = response['Body'].read()
+
+    snapshot_body = travel_data.csv_to_snapshot(
+        csv_body,
+        sort_by=travel_data.SNAPSHOT_SORT_COLUMNS.get(csv_key),
+        dtypes=travel_data.dataset_dtypes(csv_key)
+    )
+    snapshot_key = travel_data.snapshot_key(csv_key)
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=snapshot_key,
+        Body=snapshot_body,
+        Metadata={travel_data.SNAPSHOT_SOURCE_METADATA: response.get('ETag', '').strip('"')}
+    )
+
+    logger.info(f"Wrote s3://{bucket}/{snapshot_key} ({len(csv_body)} -> {len(snapshot_body)} bytes)")
+    return {
+        "source": csv_key,
+        "artifact": snapshot_key,
+        "sourceBytes": len(csv_body),
+        "artifactBytes": len(snapshot_body)
+    }
+
+
+def build_interaction_partitions(bucket, csv_key=INTERACTIONS_CSV_PATH):
+    """Split the interactions CSV into ITEM_ID partitions, rewriting only the partitions whose content changed"""
+    s3_client = get_s3_client()
+    logger.info(f"Building interaction partitions for s3://{bucket}/{csv_key}")
+    response = s3_client.get_object(Bucket=bucket, Key=csv_key)
+    csv_body = response['Body'].read()
+    interactions_df = travel_data.parse_csv(csv_body, dtypes=travel_data.dataset_dtypes(csv_key))
+
+    partition_count = interaction_partitions.PARTITION_COUNT
+    partition_format = interaction_partitions.partition_format()
+    manifest_key = interaction_partitions.partition_manifest_key(csv_key)
+
+    # Partitions of a compatible previous build are kept when their content is unchanged
+    previous = {}
+    try:
+        previous_manifest = interaction_partitions.parse_partition_manifest(
+            s3_client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+        if (previous_manifest.get('version') == interaction_partitions.PARTITION_FORMAT_VERSION
+                and previous_manifest.get('partitionCount') == partition_count
+                and previous_manifest.get('format') == partition_format):
+            previous = previous_manifest['partitions']
+    except ClientError as e:
+        if not is_missing_object(e):
+            raise
+
+    partitions = {}
+    written = 0
+    written_bytes = 0
+    for partition, rows in interaction_partitions.split_partitions(interactions_df, partition_count):
+        digest = interaction_partitions.partition_digest(rows)
+        if previous.get(str(partition), {}).get('sha256') == digest:
+            partitions[partition] = previous[str(partition)]
+            continue
+
+        key = interaction_partitions.partition_key(csv_key, partition, partition_format)
+        body = interaction_partitions.serialize_partition(rows, partition_format)
+        put_response = s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        written += 1
+        written_bytes += len(body)
+        partitions[partition] = {
+            "key": key,
+            "etag": put_response.get('ETag'),
+            "rows": len(rows),
+            "sha256": digest
+        }
+
+    manifest = interaction_partitions.build_partition_manifest(
+        partitions, {csv_key: response.get('ETag')}, partition_count, partition_format)
+    manifest_body = json.dumps(manifest).encode('utf-8')
+    # The manifest goes last, so readers never see it point at partitions that are not written yet
+    s3_client.put_object(Bucket=bucket, Key=manifest_key, Body=manifest_body, ContentType='application/json')
+
+    # Partitions that are now empty are no longer in the manifest
+    for partition, entry in previous.items():
+        if int(partition) not in partitions:
+            s3_client.delete_object(Bucket=bucket, Key=entry['key'])
+
+    logger.info(f"Wrote {written} of {len(partitions)} partitions and s3://{bucket}/{manifest_key}")
+    return {
+        "source": csv_key,
+        "artifact": manifest_key,
+        "partitionCount": len(partitions),
+        "partitionsWritten": written,
+        "artifactBytes": written_bytes + len(manifest_body)
+    }
+
+
+def build_segment_artifacts(bucket, segment_key):
+    """Precompute the manifest, offset index, per-flight statistics and membership index for one batch segment output file"""
+    s3_client = get_s3_client()
+    logger.info(f"Building segment artifacts for s3://{bucket}/{segment_key}")
+
+    sources = {}
+
+    def open_source(key):
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        sources[key] = response.get('ETag')
+        return response['Body']
+
+    # One pass over the file both parses the segments and records where each line starts
+    spans = list(segment_data.iter_segment_spans(open_source(segment_key)))
+    segments = [json.loads(line) for _, line in spans]
+    segment_sources = dict(sources)
+
+    manifest = segment_data.build_segment_manifest(segments, segment_sources)
+    manifest_key = segment_data.segment_manifest_key(segment_key)
+    manifest_body = json.dumps(manifest).encode('utf-8')
+    s3_client.put_object(Bucket=bucket, Key=manifest_key, Body=manifest_body, ContentType='application/json')
+    logger.info(f"Wrote s3://{bucket}/{manifest_key} for {len(manifest['flights'])} flights")
+
+    offset_index = segment_data.build_segment_offset_index(spans, segment_sources)
+    del spans
+    offset_index_key = segment_data.segment_offset_index_key(segment_key)
+    offset_index_body = json.dumps(offset_index).encode('utf-8')
+    s3_client.put_object(Bucket=bucket, Key=offset_index_key, Body=offset_index_body, ContentType='application/json')
+    logger.info(f"Wrote s3://{bucket}/{offset_index_key} for {len(offset_index['lines'])} flights")
+
+    interactions_df = travel_data.parse_csv(open_source(INTERACTIONS_CSV_PATH).read(), travel_data.INTERACTION_COLUMNS,
+                                            travel_data.dataset_dtypes(INTERACTIONS_CSV_PATH))
+    users_df = travel_data.parse_csv(open_source(USERS_CSV_PATH).read(), travel_data.USER_COLUMNS,
+                                     travel_data.dataset_dtypes(USERS_CSV_PATH))
+
+    stats = segment_data.build_segment_stats(segments, interactions_df, users_df, sources)
+    stats_key = segment_data.segment_stats_key(segment_key)
+    stats_body = json.dumps(stats).encode('utf-8')
+    s3_client.put_object(Bucket=bucket, Key=stats_key, Body=stats_body, ContentType='application/json')
+    logger.info(f"Wrote s3://{bucket}/{stats_key} for {len(stats['flights'])} flights")
+
+    membership = segment_data.SegmentMembershipIndex.build(segments, segment_sources)
+    membership.attach_tiers(users_df, {USERS_CSV_PATH: sources[USERS_CSV_PATH]})
+    membership_key = segment_data.segment_membership_key(segment_key)
+    membership_body = membership.to_bytes()
+    s3_client.put_object(Bucket=bucket, Key=membership_key, Body=membership_body)
+    logger.info(f"Wrote s3://{bucket}/{membership_key} for {len(membership.user_ids)} users")
+
+    return [
+        {
+            "source": segment_key,
+            "artifact": manifest_key,
+            "flightCount": len(manifest['flights']),
+            "artifactBytes": len(manifest_body)
+        },
+        {
+            "source": segment_key,
+            "artifact": offset_index_key,
+            "flightCount": len(offset_index['lines']),
+            "artifactBytes": len(offset_index_body)
+        },
+        {
+            "source": segment_key,
+            "artifact": stats_key,
+            "flightCount": len(stats['flights']),
+            "artifactBytes": len(stats_body)
+        },
+        {
+            "source": segment_key,
+            "artifact": membership_key,
+            "userCount": len(membership.user_ids),
+            "artifactBytes": len(membership_body)
+        }
+    ]
+
+
+def build_index_bundle(bucket, segment_key=SEGMENT_OUTPUT_PATH, output_dir=None):
+    """Bundle the item, facet and segment indexes into one versioned file and point the handlers at it.
+
+    Segment artifacts are bundled only while they are current for their
+    sources. The bundle is uploaded before indexes/CURRENT.json is rewritten,
+    so handlers never see a pointer to a missing bundle. output_dir also
+    writes the bundle and its pointer locally, for packaging as a layer.
+    """
+    s3_client = get_s3_client()
+    cache = DatasetCache()
+    logger.info(f"Building index bundle for s3://{bucket}")
+
+    # The items exactly as the handlers read them, so row positions match
+    items_df = travel_data.read_dataset(cache, bucket, ITEMS_CSV_PATH, travel_data.ITEM_COLUMNS)
+    sources = {ITEMS_CSV_PATH: cache.etag(bucket, ITEMS_CSV_PATH)}
+
+    def current_etag(key):
+        return cache.etag(bucket, key)
+
+    def read_artifact(key, parser, kind):
+        try:
+            return cache.get(bucket, key, parser, kind)
+        except ClientError as e:
+            if not is_missing_object(e):
+                raise
+            logger.warning(f"No s3://{bucket}/{key} to bundle")
+            return None
+
+    manifest = read_artifact(segment_data.segment_manifest_key(segment_key), segment_data.parse_segment_manifest, 'json')
+    if manifest and not segment_data.manifest_is_fresh(manifest, current_etag):
+        manifest = None
+    stats = read_artifact(segment_data.segment_stats_key(segment_key), segment_data.parse_segment_stats, 'json')
+    if stats and not segment_data.stats_are_fresh(stats, current_etag):
+        stats = None
+    membership = read_artifact(segment_data.segment_membership_key(segment_key),
+                               segment_data.SegmentMembershipIndex.load, 'membership')
+    if membership is not None and not segment_data.sources_are_fresh(membership.sources, current_etag):
+        membership = None
+    for artifact in (manifest, stats):
+        if artifact:
+            sources.update(artifact['sources'])
+    if membership is not None:
+        sources.update(membership.sources)
+
+    version, body = index_bundle.build_bundle(ITEMS_CSV_PATH, items_df, sources, segment_key, manifest, stats, membership)
+    key = index_bundle.bundle_key(version)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    pointer = index_bundle.build_bundle_pointer(version, key, len(body))
+    s3_client.put_object(Bucket=bucket, Key=index_bundle.BUNDLE_POINTER_KEY, Body=json.dumps(pointer).encode('utf-8'),
+                         ContentType='application/json')
+    logger.info(f"Wrote s3://{bucket}/{key} and pointed s3://{bucket}/{index_bundle.BUNDLE_POINTER_KEY} at it")
+    if output_dir:
+        index_bundle.write_local_bundle(output_dir, pointer, body)
+        logger.info(f"Wrote index bundle {version} to {output_dir}")
+
+    return {
+        "source": ITEMS_CSV_PATH,
+        "artifact": key,
+        "version": version,
+        "sections": sorted(index_bundle.IndexBundle(body).header['sections']),
+        "artifactBytes": len(body)
+    }
+
+
+def lambda_handler(event, context):
+    """Rebuild derived artifacts for the objects named in an S3 ObjectCreated event"""
+    artifacts = []
+    changed_buckets = set()
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+
+        if key in DATASET_CSV_PATHS:
+            artifacts.append(build_snapshot(bucket, key))
+            if key == INTERACTIONS_CSV_PATH:
+                artifacts.append(build_interaction_partitions(bucket, key))
+            # Segment statistics join users and interactions, so they go stale with them
+            if key in (USERS_CSV_PATH, INTERACTIONS_CSV_PATH):
+                artifacts.extend(build_segment_artifacts(bucket, SEGMENT_OUTPUT_PATH))
+        elif key.startswith('segments/') and key.endswith('.json.out'):
+            artifacts.extend(build_segment_artifacts(bucket, key))
+        else:
+            logger.info(f"Ignoring s3://{bucket}/{key}")
+            continue
+        changed_buckets.add(bucket)
+
+    # The bundle is rebuilt last, from the artifacts above
+    for bucket in changed_buckets:
+        try:
+            artifacts.append(build_index_bundle(bucket))
+        except Exception:
+            # Without a pointer the handlers read (and freshness-check) S3 instead of serving an outdated bundle
+            get_s3_client().delete_object(Bucket=bucket, Key=index_bundle.BUNDLE_POINTER_KEY)
+            raise
+
+    return {
+        "status": "success",
+        "artifacts": artifacts
+    }
+
+
+def main(argv=None):
+    """Build derived artifacts offline, e.g. after a manual data upload"""
+    parser = argparse.ArgumentParser(description="Build derived artifacts for the travel datasets")
+    parser.add_argument('--bucket', default=BUCKET_NAME, help="S3 bucket holding the datasets")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('snapshots', help="Convert data/travel_*.csv into typed Parquet snapshots")
+    subparsers.add_parser('partitions', help="Split the interactions CSV into ITEM_ID partitions")
+    segments_parser = subparsers.add_parser('segments', help="Precompute the manifest, offset index, statistics and membership index for a segment output file")
+    segments_parser.add_argument('--segment-key', default=SEGMENT_OUTPUT_PATH, help="Batch segment output key")
+    bundle_parser = subparsers.add_parser('bundle', help="Bundle the item, facet and segment indexes and update indexes/CURRENT.json")
+    bundle_parser.add_argument('--segment-key', default=SEGMENT_OUTPUT_PATH, help="Batch segment output key")
+    bundle_parser.add_argument('--output-dir', help="Also write the bundle here, e.g. layer/index_bundle for a Lambda layer mounted at /opt")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'snapshots':
+        for csv_key in DATASET_CSV_PATHS:
+            print(json.dumps(build_snapshot(args.bucket, csv_key)))
+    elif args.command == 'partitions':
+        print(json.dumps(build_interaction_partitions(args.bucket)))
+    elif args.command == 'segments':
+        for artifact in build_segment_artifacts(args.bucket, args.segment_key):
+            print(json.dumps(artifact))
+    elif args.command == 'bundle':
+        print(json.dumps(build_index_bundle(args.bucket, args.segment_key, args.output_dir)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
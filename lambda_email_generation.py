@@ -1,13 +1,213 @@
 import json
-import boto3
-import pandas as pd
-from io import StringIO
 import logging
 from datetime import datetime
 
+import travel_data
+import segment_data
+import request_metrics
+from botocore.exceptions import ClientError
+from index_bundle import BundleLoader
+from dataset_cache import DatasetCache, fetch_all, get_s3_client, is_missing_object
+from email_template_store import EmailTemplateStore
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# ============= CONFIGURATION CONSTANTS =============
+# Up to this many segment lines are fetched with ranged GETs through the offset index;
+# larger lookups stream the segment file once instead
+SEGMENT_RANGE_READ_MAX_LINES = 16
+# ============= END CONFIGURATION =============
+
+# Parsed datasets kept across warm invocations of this container
+dataset_cache = DatasetCache()
+# Prebuilt indexes, mapped at init from a Lambda layer or /tmp
+index_bundles = BundleLoader()
+
+
+class InvalidParameterError(Exception):
+    """A request parameter the caller has to fix, answered with a 400"""
+
+
+def read_index_bundle(bucket):
+    """Return the prebuilt index bundle when it is the version the S3 pointer names, else None"""
+    try:
+        return index_bundles.current(dataset_cache, bucket)
+    except Exception as e:
+        logger.error(f"Error reading index bundle: {str(e)}")
+        return None
+
+
+def read_s3_csv(bucket, key, columns=None, filters=None):
+    """Read a travel dataset from S3, preferring its Parquet snapshot over the CSV"""
+    try:
+        logger.info(f"Reading dataset s3://{bucket}/{key}")
+        df = travel_data.read_dataset(dataset_cache, bucket, key, columns, filters)
+        logger.info(f"Successfully read dataset with {len(df)} rows")
+        return df
+    except Exception as e:
+        logger.error(f"Error reading CSV from S3: {str(e)}")
+        return None
+
+
+def read_flight_interactions(bucket, key, item_ids, filters=None):
+    """Read the interactions of item_ids from their ITEM_ID partitions, falling back to the whole dataset"""
+    # Imported here: it loads pandas, which only the analytical endpoints need
+    import interaction_partitions
+
+    try:
+        df = interaction_partitions.read_item_interactions(dataset_cache, bucket, key, item_ids,
+                                                           travel_data.INTERACTION_COLUMNS, filters)
+        if df is not None:
+            logger.info(f"Read {len(df)} interactions from the partitions of {len(item_ids)} flights")
+            return df
+    except Exception as e:
+        logger.error(f"Error reading interaction partitions: {str(e)}")
+    return read_s3_csv(bucket, key, travel_data.INTERACTION_COLUMNS,
+                       [('ITEM_ID', 'in', list(item_ids))] + list(filters or []))
+
+
+def stream_segments(bucket, key, item_ids=None):
+    """Stream segment lines from S3 one at a time, optionally only the ones for item_ids"""
+    logger.info(f"Streaming segments from s3://{bucket}/{key}")
+    with request_metrics.phase('s3'):
+        response = get_s3_client().get_object(Bucket=bucket, Key=key)
+    request_metrics.add('s3Gets')
+    if item_ids is None:
+        return segment_data.iter_segments(response['Body'])
+    return segment_data.find_segments(response['Body'], item_ids)
+
+
+def read_segment_offset_index(bucket, segment_key):
+    """Read the itemId -> byte span index of a segment file, or None when missing or stale"""
+    index_key = segment_data.segment_offset_index_key(segment_key)
+    try:
+        index = dataset_cache.get(bucket, index_key, segment_data.parse_segment_offset_index, 'json')
+    except ClientError as e:
+        if not is_missing_object(e):
+            logger.error(f"Error reading segment offset index: {str(e)}")
+        return None
+
+    if not segment_data.offset_index_is_fresh(index, lambda key: dataset_cache.etag(bucket, key)):
+        logger.warning(f"Ignoring stale segment offset index s3://{bucket}/{index_key}")
+        return None
+    return index
+
+
+def read_segment_line(bucket, key, item_id, span, etag):
+    """Read one segment line with a ranged GET, pinned to the file version the offset index was built from"""
+    with request_metrics.phase('s3'):
+        response = get_s3_client().get_object(Bucket=bucket, Key=key, Range=segment_data.segment_line_range(span),
+                                              IfMatch=etag)
+        body = response['Body'].read()
+    request_metrics.add('s3Gets')
+    request_metrics.add('s3Bytes', len(body))
+    return segment_data.parse_segment_line(body, item_id)
+
+
+def read_indexed_segments(bucket, key, item_ids):
+    """Read the segments of item_ids with one ranged GET each, or None when the offset index cannot be used"""
+    item_ids = list(dict.fromkeys(item_ids))
+    if len(item_ids) > SEGMENT_RANGE_READ_MAX_LINES:
+        return None
+    index = read_segment_offset_index(bucket, key)
+    if index is None:
+        return None
+
+    etag = index['sources'].get(key)
+    spans = [(item_id, index['lines'][item_id]) for item_id in item_ids if item_id in index['lines']]
+    try:
+        segments = fetch_all(*[lambda item_id=item_id, span=span: read_segment_line(bucket, key, item_id, span, etag)
+                               for item_id, span in spans])
+    except ClientError as e:
+        logger.warning(f"Ranged segment read failed, streaming instead: {str(e)}")
+        return None
+    if any(segment is None for segment in segments):
+        logger.warning(f"Segment offset index does not match s3://{bucket}/{key}, streaming instead")
+        return None
+    return segments
+
+
+def parse_list_parameter(value):
+    """Parse an array parameter, which Bedrock may pass as a list, a JSON string or "[a, b]" text"""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    value = str(value).strip()
+    try:
+        parsed = json.loads(value)
+        if isinstance(parsed, list):
+            return [str(item) for item in parsed]
+    except ValueError:
+        pass
+    return [item.strip().strip('"\'') for item in value.strip('[]').split(',') if item.strip()]
+
+
+def read_item_index(bucket, key):
+    """Read the ITEM_ID -> row index, parsed once per version of the items CSV with the csv module (no pandas)"""
+    try:
+        bundle = read_index_bundle(bucket)
+        if bundle and bundle.is_current(key, lambda source: dataset_cache.etag(bucket, source)):
+            item_index = bundle.item_records(key)
+            if item_index is not None:
+                return item_index
+        return travel_data.read_records(dataset_cache, bucket, key, 'ITEM_ID', travel_data.ITEM_COLUMNS)
+    except Exception as e:
+        logger.error(f"Error building item index: {str(e)}")
+        return None
+
+
+def read_segment_stats(bucket, segment_key):
+    """Read the precomputed per-flight segment statistics, or None when missing or stale"""
+    bundle = read_index_bundle(bucket)
+    stats = bundle.segment_stats(segment_key) if bundle else None
+    if stats is not None and segment_data.stats_are_fresh(stats, lambda key: dataset_cache.etag(bucket, key)):
+        return stats
+
+    stats_key = segment_data.segment_stats_key(segment_key)
+    try:
+        stats = dataset_cache.get(bucket, stats_key, segment_data.parse_segment_stats, 'json')
+        fresh = segment_data.stats_are_fresh(stats, lambda key: dataset_cache.etag(bucket, key))
+    except ClientError as e:
+        if not is_missing_object(e):
+            logger.error(f"Error reading segment statistics: {str(e)}")
+        return None
+    except segment_data.ARTIFACT_ERRORS as e:
+        logger.error(f"Ignoring unreadable segment statistics s3://{bucket}/{stats_key}: {str(e)}")
+        return None
+
+    if not fresh:
+        logger.warning(f"Ignoring stale segment statistics s3://{bucket}/{stats_key}")
+        return None
+    return stats
+
+
+def read_segment_manifest(bucket, segment_key):
+    """Read the segmented flight -> user count manifest, or None when missing or stale"""
+    bundle = read_index_bundle(bucket)
+    manifest = bundle.segment_manifest(segment_key) if bundle else None
+    if manifest is not None and segment_data.manifest_is_fresh(manifest, lambda key: dataset_cache.etag(bucket, key)):
+        return manifest
+
+    manifest_key = segment_data.segment_manifest_key(segment_key)
+    try:
+        manifest = dataset_cache.get(bucket, manifest_key, segment_data.parse_segment_manifest, 'json')
+        fresh = segment_data.manifest_is_fresh(manifest, lambda key: dataset_cache.etag(bucket, key))
+    except ClientError as e:
+        if not is_missing_object(e):
+            logger.error(f"Error reading segment manifest: {str(e)}")
+        return None
+    except segment_data.ARTIFACT_ERRORS as e:
+        logger.error(f"Ignoring unreadable segment manifest s3://{bucket}/{manifest_key}: {str(e)}")
+        return None
+
+    if not fresh:
+        logger.warning(f"Ignoring stale segment manifest s3://{bucket}/{manifest_key}")
+        return None
+    return manifest
+
+
 def lambda_handler(event, context):
     # ============= CONFIGURATION CONSTANTS =============
     # S3 bucket configuration
@@ -25,10 +225,12 @@ def lambda_handler(event, context):
     EMAIL_TEMPLATE_PATH = 'email_templates/'
     # ============= END CONFIGURATION =============
     
-    logger.info(f"Event received: {json.dumps(event)}")
+    request_metrics.begin('EmailGeneration', event.get('apiPath', ''))
+    if request_metrics.payload_sampled():
+        logger.info(f"Event received: {json.dumps(event)}")
 
-    # Initialize S3 client
-    s3_client = boto3.client('s3')
+    # Revalidate cached datasets once for this invocation
+    dataset_cache.begin_request()
     
     def get_named_parameter(event, name, default=None):
         """Safely get a named parameter from the event"""
@@ -38,89 +240,102 @@ def lambda_handler(event, context):
         except (KeyError, StopIteration):
             logger.warning(f"Parameter {name} not found in event")
             return default
-
-    def read_s3_json(bucket, key):
-        """Read JSONL data from S3"""
-        try:
-            logger.info(f"Reading JSON from s3://{bucket}/{key}")
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            content = response['Body'].read().decode('utf-8')
-            # Split content by lines and parse each line as separate JSON
-            json_objects = []
-            for line in content.strip().split('\n'):
-                if line:  # Skip empty lines
-                    json_objects.append(json.loads(line))
-            logger.info(f"Successfully read {len(json_objects)} JSON objects")
-            return json_objects
-        except Exception as e:
-            logger.error(f"Error reading JSON from S3: {str(e)}")
-            return None
-
-    def read_s3_csv(bucket, key):
-        """Read CSV data from S3"""
-        try:
-            logger.info(f"Reading CSV from s3://{bucket}/{key}")
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            content = response['Body'].read().decode('utf-8')
-            df = pd.read_csv(StringIO(content))
-            logger.info(f"Successfully read CSV with {len(df)} rows")
-            return df
-        except Exception as e:
-            logger.error(f"Error reading CSV from S3: {str(e)}")
-            return None
     
-    def write_to_s3(bucket, key, content):
-        """Write content to S3"""
+    def get_segment_output(bucket, item_ids):
+        """Get the segment lines for item_ids, by byte range when indexed, else stopping the S3 stream once all are found"""
+        segments = read_indexed_segments(bucket, SEGMENT_OUTPUT_PATH, item_ids)
+        if segments is not None:
+            return segments
         try:
-            logger.info(f"Writing to s3://{bucket}/{key}")
-            s3_client.put_object(
-                Bucket=bucket,
-                Key=key,
-                Body=content
-            )
-            return True
+            with request_metrics.phase('stream'):
+                return list(stream_segments(bucket, SEGMENT_OUTPUT_PATH, item_ids))
         except Exception as e:
-            logger.error(f"Error writing to S3: {str(e)}")
-            return False
+            logger.error(f"Error getting segment output: {str(e)}")
+            return None
     
-    def get_segment_output(bucket):
-        """Get segment output files from S3"""
+    def get_segment_sizes(bucket):
+        """Get the user count of every segment without holding the user lists in memory"""
+        manifest = read_segment_manifest(bucket, SEGMENT_OUTPUT_PATH)
+        if manifest:
+            return list(manifest['flights'].items())
         try:
-            return read_s3_json(bucket, SEGMENT_OUTPUT_PATH)
+            return [
+                (segment_data.segment_item_id(segment), len(segment_data.segment_users(segment)))
+                for segment in stream_segments(bucket, SEGMENT_OUTPUT_PATH)
+            ]
         except Exception as e:
             logger.error(f"Error getting segment output: {str(e)}")
             return None
     
     def get_flight_details(item_id):
-        """Get flight details from items data"""
-        items_df = read_s3_csv(BUCKET_NAME, ITEMS_CSV_PATH)
-        if items_df is None:
+        """Get flight details from the shared item index"""
+        item_index = read_item_index(BUCKET_NAME, ITEMS_CSV_PATH)
+        if item_index is None:
             logger.error("Failed to read items CSV")
             return None
 
-        flight = items_df[items_df['ITEM_ID'] == item_id]
-        if flight.empty:
+        flight = item_index.get(item_id)
+        if flight is None:
             logger.warning(f"No flight found with ITEM_ID: {item_id}")
             return None
 
-        return flight.iloc[0].to_dict()
+        return flight
+    
+    def get_segment_membership(flight_ids):
+        """Get the persisted segment membership index, or build one for flight_ids when it is missing or stale"""
+        bundle = read_index_bundle(BUCKET_NAME)
+        membership = bundle.segment_membership(SEGMENT_OUTPUT_PATH) if bundle else None
+        if (membership is not None
+                and membership.sources.get(SEGMENT_OUTPUT_PATH) == dataset_cache.etag(BUCKET_NAME, SEGMENT_OUTPUT_PATH)):
+            return membership
+        
+        membership_key = segment_data.segment_membership_key(SEGMENT_OUTPUT_PATH)
+        try:
+            membership = dataset_cache.get(BUCKET_NAME, membership_key,
+                                           segment_data.SegmentMembershipIndex.load, 'membership')
+            if membership.sources.get(SEGMENT_OUTPUT_PATH) == dataset_cache.etag(BUCKET_NAME, SEGMENT_OUTPUT_PATH):
+                return membership
+            logger.warning(f"Ignoring stale segment membership index s3://{BUCKET_NAME}/{membership_key}")
+        except ClientError as e:
+            if not is_missing_object(e):
+                logger.error(f"Error reading segment membership index: {str(e)}")
+        
+        segments = get_segment_output(BUCKET_NAME, flight_ids)
+        if segments is None:
+            return None
+        return segment_data.SegmentMembershipIndex.build(segments)
+    
+    def get_tier_distribution(membership, codes):
+        """Count member tiers of indexed user codes, from the tiers stored in the index while the users table is unchanged"""
+        if (membership.user_tiers is not None
+                and membership.sources.get(USERS_CSV_PATH) == dataset_cache.etag(BUCKET_NAME, USERS_CSV_PATH)):
+            return membership.tier_distribution(codes)
+        
+        users_df = read_s3_csv(BUCKET_NAME, USERS_CSV_PATH, travel_data.USER_COLUMNS)
+        if users_df is None:
+            return {}
+        tiers, user_tiers = segment_data.encode_user_tiers(membership.user_ids, users_df)
+        return segment_data.count_tiers(tiers, user_tiers, codes)
     
     def list_available_segments(event):
         """List all available segments from the batch output file"""
-        segments = get_segment_output(BUCKET_NAME)
+        segment_sizes, item_index = fetch_all(
+            lambda: get_segment_sizes(BUCKET_NAME),
+            lambda: read_item_index(BUCKET_NAME, ITEMS_CSV_PATH)
+        )
         
-        if not segments:
+        if not segment_sizes:
             return {
                 "status": "warning",
                 "message": "No segment data available"
             }
         
+        # Resolve every segment against one item index instead of a lookup per segment
+        item_index = item_index or {}
+        
         segment_info = []
-        for segment in segments:
-            item_id = segment.get('input', {}).get('itemId')
-            users = segment.get('output', {}).get('usersList', [])
-            
-            flight_details = get_flight_details(item_id)
+        for item_id, user_count in segment_sizes:
+            flight_details = item_index.get(item_id)
             if flight_details:
                 segment_info.append({
                     "flightId": item_id,
@@ -128,7 +343,7 @@ def lambda_handler(event, context):
                     "destination": flight_details.get('DST_CITY'),
                     "airline": flight_details.get('AIRLINE'),
                     "month": flight_details.get('MONTH'),
-                    "userCount": len(users)
+                    "userCount": user_count
                 })
         
         return {
@@ -137,19 +352,18 @@ def lambda_handler(event, context):
             "totalSegments": len(segment_info)
         }
     
-    def analyze_interaction_data(flight_id, user_ids=None):
+    def analyze_interaction_data(flight_id, user_ids=None, flight_interactions=None):
         """Analyze interaction data for insights about the segment"""
-        interactions_df = read_s3_csv(BUCKET_NAME, INTERACTIONS_CSV_PATH)
-        if interactions_df is None:
+        if flight_interactions is None:
+            # Read only this flight's partition, filtered to the users if provided
+            filters = [('USER_ID', 'in', list(user_ids))] if user_ids else None
+            flight_interactions = read_flight_interactions(BUCKET_NAME, INTERACTIONS_CSV_PATH, [flight_id], filters)
+        elif user_ids:
+            flight_interactions = flight_interactions[flight_interactions['USER_ID'].isin(user_ids)]
+        
+        if flight_interactions is None:
             logger.error("Failed to read interactions CSV")
             return None
-            
-        # Filter interactions for the specified flight
-        flight_interactions = interactions_df[interactions_df['ITEM_ID'] == flight_id]
-        
-        # If user_ids provided, filter further
-        if user_ids:
-            flight_interactions = flight_interactions[flight_interactions['USER_ID'].isin(user_ids)]
         
         if flight_interactions.empty:
             return None
@@ -158,7 +372,7 @@ def lambda_handler(event, context):
         avg_rating = flight_interactions['EVENT_VALUE'].mean()
         
         # Count ratings by cabin type
-        cabin_counts = flight_interactions.groupby('CABIN_TYPE').size().to_dict()
+        cabin_counts = flight_interactions.groupby('CABIN_TYPE', observed=True).size().to_dict()
         
         # Get distribution of ratings
         rating_distribution = flight_interactions['EVENT_VALUE'].value_counts().sort_index().to_dict()
@@ -180,8 +394,11 @@ def lambda_handler(event, context):
                 "message": "Missing required parameter: flightId"
             }
         
-        # Get flight details
-        flight_details = get_flight_details(flight_id)
+        # Get flight details and the precomputed statistics at the same time
+        flight_details, segment_stats = fetch_all(
+            lambda: get_flight_details(flight_id),
+            lambda: read_segment_stats(BUCKET_NAME, SEGMENT_OUTPUT_PATH)
+        )
         
         if not flight_details:
             return {
@@ -189,28 +406,49 @@ def lambda_handler(event, context):
                 "message": f"No flight found with ID: {flight_id}"
             }
         
-        # Get user segment for this flight
-        segments = get_segment_output(BUCKET_NAME)
-        segment_users = []
-        
-        if segments:
-            for segment in segments:
-                if segment.get('input', {}).get('itemId') == flight_id:
-                    segment_users = segment.get('output', {}).get('usersList', [])
-                    break
-        
-        # Get user tier distribution
-        users_df = read_s3_csv(BUCKET_NAME, USERS_CSV_PATH)
-        tier_distribution = {}
+        # Serve segment details from the precomputed statistics when they are current
+        flight_stats = segment_stats['flights'].get(flight_id) if segment_stats else None
         
-        if users_df is not None and segment_users:
-            segment_users_df = users_df[users_df['USER_ID'].isin(segment_users)]
-            tier_distribution = segment_users_df['MEMBER_TIER'].value_counts().to_dict()
-        
-        # Get interaction insights
-        interaction_insights = analyze_interaction_data(flight_id, segment_users)
+        if flight_stats:
+            user_count = flight_stats['userCount']
+            user_sample = flight_stats['userSample']
+            tier_distribution = flight_stats['tierDistribution']
+            interaction_insights = flight_stats['interactionInsights']
+        else:
+            # The segment, the users and the flight's interactions do not depend on each other
+            segments, users_df, flight_interactions = fetch_all(
+                lambda: get_segment_output(BUCKET_NAME, [flight_id]),
+                lambda: read_s3_csv(BUCKET_NAME, USERS_CSV_PATH, travel_data.USER_COLUMNS),
+                lambda: read_flight_interactions(BUCKET_NAME, INTERACTIONS_CSV_PATH, [flight_id])
+            )
+            
+            # Get user segment for this flight
+            segment_users = []
+            
+            if segments:
+                for segment in segments:
+                    if segment.get('input', {}).get('itemId') == flight_id:
+                        segment_users = segment.get('output', {}).get('usersList', [])
+                        break
+            
+            # Get user tier distribution
+            tier_distribution = {}
+            
+            if users_df is not None and segment_users:
+                # Each segment user is looked up once; tiers are then counted on int codes
+                tiers, user_tiers = segment_data.encode_user_tiers(list(dict.fromkeys(segment_users)), users_df)
+                tier_distribution = segment_data.count_tiers(tiers, user_tiers)
+            
+            # Get interaction insights
+            interaction_insights = analyze_interaction_data(flight_id, segment_users, flight_interactions)
+            user_count = len(segment_users)
+            user_sample = segment_users[:5] if segment_users else []
         
-        # Build email content context
+        return build_email_content(flight_id, flight_details, user_count, user_sample,
+                                   tier_distribution, interaction_insights)
+    
+    def build_email_content(flight_id, flight_details, user_count, user_sample, tier_distribution, interaction_insights):
+        """Assemble the email content context for one flight"""
         promotion_code = flight_id[-5:]  # Last 5 chars of flight ID
         
         return {
@@ -226,8 +464,8 @@ def lambda_handler(event, context):
                 "promotionCode": promotion_code
             },
             "segmentDetails": {
-                "userCount": len(segment_users),
-                "userSample": segment_users[:5] if segment_users else [],
+                "userCount": user_count,
+                "userSample": user_sample,
                 "tierDistribution": tier_distribution
             },
             "interactionInsights": interaction_insights,
@@ -242,9 +480,84 @@ def lambda_handler(event, context):
             }
         }
     
+    def compute_flight_stats(flight_ids):
+        """Compute segment statistics for many flights with one concurrent read of each dataset"""
+        segments, interactions_df, users_df = fetch_all(
+            lambda: get_segment_output(BUCKET_NAME, flight_ids),
+            lambda: read_flight_interactions(BUCKET_NAME, INTERACTIONS_CSV_PATH, flight_ids),
+            lambda: read_s3_csv(BUCKET_NAME, USERS_CSV_PATH, travel_data.USER_COLUMNS)
+        )
+        segments = segments or []
+        if interactions_df is None:
+            import pandas as pd
+            interactions_df = pd.DataFrame(columns=travel_data.INTERACTION_COLUMNS)
+        
+        flight_stats = segment_data.compute_segment_stats(segments, interactions_df, users_df)
+        
+        # Flights without a segment get insights over all of their interactions, as in generateEmailContent
+        unsegmented = [flight_id for flight_id in flight_ids if flight_id not in flight_stats]
+        if unsegmented:
+            insights = segment_data.compute_interaction_insights(
+                interactions_df[interactions_df['ITEM_ID'].isin(unsegmented)])
+            for flight_id in unsegmented:
+                flight_stats[flight_id] = {
+                    "userCount": 0,
+                    "userSample": [],
+                    "tierDistribution": {},
+                    "interactionInsights": insights.get(flight_id, {}).get("interactionInsights")
+                }
+        return flight_stats
+    
+    def generate_email_content_batch(event):
+        """Generate email content for many flights in one call"""
+        flight_ids = parse_list_parameter(get_named_parameter(event, 'flightIds', []))
+        
+        if not flight_ids:
+            return {
+                "status": "error",
+                "message": "Missing required parameter: flightIds"
+            }
+        flight_ids = list(dict.fromkeys(flight_ids))
+        
+        item_index, segment_stats = fetch_all(
+            lambda: read_item_index(BUCKET_NAME, ITEMS_CSV_PATH),
+            lambda: read_segment_stats(BUCKET_NAME, SEGMENT_OUTPUT_PATH)
+        )
+        item_index = item_index or {}
+        found_ids = [flight_id for flight_id in flight_ids if flight_id in item_index]
+        missing_ids = [flight_id for flight_id in flight_ids if flight_id not in item_index]
+        
+        # Serve what we can from the precomputed statistics and compute the rest together
+        flight_stats = {}
+        if segment_stats:
+            flight_stats = {flight_id: segment_stats['flights'][flight_id]
+                            for flight_id in found_ids if flight_id in segment_stats['flights']}
+        live_ids = [flight_id for flight_id in found_ids if flight_id not in flight_stats]
+        if live_ids:
+            flight_stats.update(compute_flight_stats(live_ids))
+        
+        results = []
+        for flight_id in found_ids:
+            stats = flight_stats[flight_id]
+            results.append(build_email_content(
+                flight_id,
+                item_index[flight_id],
+                stats['userCount'],
+                stats['userSample'],
+                stats['tierDistribution'],
+                stats['interactionInsights']
+            ))
+        
+        return {
+            "status": "success" if results else "error",
+            "flights": results,
+            "flightCount": len(results),
+            "missingFlightIds": missing_ids
+        }
+    
     def generate_multi_flight_email(event):
         """Generate email content for users in multiple segments"""
-        flight_ids = get_named_parameter(event, 'flightIds', [])
+        flight_ids = parse_list_parameter(get_named_parameter(event, 'flightIds', []))
         
         if not flight_ids:
             return {
@@ -252,34 +565,31 @@ def lambda_handler(event, context):
                 "message": "Missing required parameter: flightIds"
             }
         
-        # Get segment data
-        segments = get_segment_output(BUCKET_NAME)
-        if not segments:
+        # Invalid minFlights is a bad request (400), not an empty result
+        try:
+            min_flights = int(get_named_parameter(event, 'minFlights', 2))
+        except (TypeError, ValueError):
+            raise InvalidParameterError("Parameter minFlights must be an integer")
+        if min_flights < 1:
+            raise InvalidParameterError("Parameter minFlights must be at least 1")
+        
+        # Get segment membership and flight details, and check the users table version, at the same time
+        membership, item_index, _ = fetch_all(
+            lambda: get_segment_membership(flight_ids),
+            lambda: read_item_index(BUCKET_NAME, ITEMS_CSV_PATH),
+            lambda: dataset_cache.etag(BUCKET_NAME, USERS_CSV_PATH)
+        )
+        if membership is None or not any(len(membership.flight_codes(flight_id)) for flight_id in flight_ids):
             return {
                 "status": "warning",
                 "message": "No segment data available",
                 "flightCount": len(flight_ids)
             }
         
-        # Map flight IDs to user lists
-        flight_users = {}
-        for segment in segments:
-            item_id = segment.get('input', {}).get('itemId')
-            if item_id in flight_ids:
-                users = segment.get('output', {}).get('usersList', [])
-                flight_users[item_id] = users
-        
-        # Find overlapping users
-        all_users = {}
-        for flight_id, users in flight_users.items():
-            for user in users:
-                if user not in all_users:
-                    all_users[user] = []
-                all_users[user].append(flight_id)
-        
-        overlapping_users = {user: flights for user, flights in all_users.items() if len(flights) > 1}
-        
-        if not overlapping_users:
+        # Find users in at least min_flights of the selected segments, as user codes
+        overlapping_codes = membership.at_least(flight_ids, min_flights)
+        
+        if not len(overlapping_codes):
             return {
                 "status": "warning",
                 "message": "No overlapping users found in the selected flight segments",
@@ -287,9 +597,10 @@ def lambda_handler(event, context):
             }
         
         # Get flight details
+        item_index = item_index or {}
         flight_details = []
         for flight_id in flight_ids:
-            flight = get_flight_details(flight_id)
+            flight = item_index.get(flight_id)
             if flight:
                 flight_details.append({
                     "flightId": flight_id,
@@ -302,19 +613,14 @@ def lambda_handler(event, context):
                     "promotionCode": flight_id[-5:]  # Last 5 chars of flight ID
                 })
         
-        # Get user tier distribution
-        users_df = read_s3_csv(BUCKET_NAME, USERS_CSV_PATH)
-        tier_distribution = {}
-        
-        if users_df is not None:
-            overlapping_user_ids = list(overlapping_users.keys())
-            overlap_users_df = users_df[users_df['USER_ID'].isin(overlapping_user_ids)]
-            tier_distribution = overlap_users_df['MEMBER_TIER'].value_counts().to_dict()
+        # Get user tier distribution by tier code, without decoding the overlapping users
+        tier_distribution = get_tier_distribution(membership, overlapping_codes)
         
         return {
             "status": "success",
-            "overlappingUsers": len(overlapping_users),
-            "userSample": list(overlapping_users.keys())[:5],
+            "overlappingUsers": len(overlapping_codes),
+            # Codes follow sorted user IDs, so the sample is the lowest IDs rather than the first seen in the segments
+            "userSample": membership.decode(overlapping_codes[:5]),
             "flights": flight_details,
             "tierDistribution": tier_distribution,
             "emailSuggestions": {
@@ -336,36 +642,20 @@ def lambda_handler(event, context):
             }
         
         try:
-            # Get flight details for filename
-            flight_details = get_flight_details(flight_id)
-            
-            if flight_details:
-                src = flight_details.get('SRC_CITY', '').replace(' ', '_').lower()
-                dst = flight_details.get('DST_CITY', '').replace(' ', '_').lower()
-                filename = f"email_template_{src}_to_{dst}_{flight_id[-5:]}.txt"
-            else:
-                filename = f"email_template_{flight_id[-5:]}.txt"
-            
-            # Format the email content
-            email_content = f"Subject: {email_subject}\n\n{email_body}"
-            
-            # Save to S3
-            s3_path = f"{EMAIL_TEMPLATE_PATH}{filename}"
-            success = write_to_s3(BUCKET_NAME, s3_path, email_content)
+            # Templates are stored by content hash, so re-saving a stored template uploads nothing
+            # and only makes it the flight's newest version again
+            store = EmailTemplateStore(get_s3_client(), BUCKET_NAME, EMAIL_TEMPLATE_PATH)
+            saved = store.save(flight_id, email_subject, email_body)
             
-            if success:
-                return {
-                    "status": "success",
-                    "message": "Email template saved successfully",
-                    "filename": filename,
-                    "s3Path": s3_path,
-                    "downloadUrl": f"https://{BUCKET_NAME}.s3.amazonaws.com/{s3_path}"
-                }
-            else:
-                return {
-                    "status": "error",
-                    "message": "Failed to save email template"
-                }
+            return {
+                "status": "success",
+                "message": "Email template saved successfully" if saved['uploaded'] else "Email template was already stored",
+                "filename": saved['key'].rsplit('/', 1)[-1],
+                "s3Path": saved['key'],
+                "downloadUrl": f"https://{BUCKET_NAME}.s3.amazonaws.com/{saved['key']}",
+                "contentHash": saved['sha256'],
+                "uploaded": saved['uploaded']
+            }
         except Exception as e:
             return {
                 "status": "error",
@@ -381,20 +671,30 @@ def lambda_handler(event, context):
     logger.info(f"Processing request: {action_group}::{api_path}")
 
     try:
-        if api_path == '/listAvailableSegments':
-            result = list_available_segments(event)
-        elif api_path == '/generateEmailContent':
-            result = generate_email_content(event)
-        elif api_path == '/generateMultiFlightEmail':
-            result = generate_multi_flight_email(event)
-        elif api_path == '/saveEmailTemplate':
-            result = save_email_template(event)
-        else:
-            response_code = 404
-            result = {
-                "status": "error",
-                "message": f"Unrecognized api path: {action_group}::{api_path}"
-            }
+        with request_metrics.phase('compute'):
+            if api_path == '/listAvailableSegments':
+                result = list_available_segments(event)
+            elif api_path == '/generateEmailContent':
+                result = generate_email_content(event)
+            elif api_path == '/generateEmailContentBatch':
+                result = generate_email_content_batch(event)
+            elif api_path == '/generateMultiFlightEmail':
+                result = generate_multi_flight_email(event)
+            elif api_path == '/saveEmailTemplate':
+                result = save_email_template(event)
+            else:
+                response_code = 404
+                result = {
+                    "status": "error",
+                    "message": f"Unrecognized api path: {action_group}::{api_path}"
+                }
+    except InvalidParameterError as e:
+        logger.error(f"Invalid request parameters: {str(e)}")
+        response_code = 400
+        result = {
+            "status": "error",
+            "message": str(e)
+        }
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         response_code = 500
@@ -418,5 +718,12 @@ def lambda_handler(event, context):
     }
 
     api_response = {'messageVersion': '1.0', 'response': action_response}
-    logger.info(f"Returning response: {json.dumps(api_response)}")
+    
+    # Serialize once to measure the response; full payloads are only logged for sampled requests
+    with request_metrics.phase('serialize'):
+        response_json = json.dumps(api_response, default=str)
+    request_metrics.add('responseBytes', len(response_json))
+    if request_metrics.payload_sampled():
+        logger.info(f"Returning response: {response_json}")
+    request_metrics.emit(response_code)
     return api_response
\ No newline at end of file
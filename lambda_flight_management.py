@@ -1,13 +1,118 @@
 import json
-import boto3
-import pandas as pd
-from io import StringIO
+import math
 import logging
 from datetime import datetime
 
+import travel_data
+import segment_data
+import request_metrics
+from botocore.exceptions import ClientError
+from index_bundle import BundleLoader
+from dataset_cache import DatasetCache, fetch_all, get_s3_client, is_missing_object
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Parsed datasets kept across warm invocations of this container
+dataset_cache = DatasetCache()
+# Prebuilt indexes, mapped at init from a Lambda layer or /tmp
+index_bundles = BundleLoader()
+
+
+def read_index_bundle(bucket):
+    """Return the prebuilt index bundle when it is the version the S3 pointer names, else None"""
+    try:
+        return index_bundles.current(dataset_cache, bucket)
+    except Exception as e:
+        logger.error(f"Error reading index bundle: {str(e)}")
+        return None
+
+
+def read_flight_index(bucket, key):
+    """Read the promotional-flight facet index, from the index bundle or built once per version of the items table"""
+    # Imported here: it loads pandas, which prepareSegmentInput never needs
+    from flight_index import FlightFacetIndex
+
+    try:
+        bundle = read_index_bundle(bucket)
+        if bundle and bundle.is_current(key, lambda source: dataset_cache.etag(bucket, source)):
+            flight_index = bundle.flight_index(key)
+            if flight_index is not None:
+                return flight_index
+        return travel_data.read_dataset(dataset_cache, bucket, key, travel_data.ITEM_COLUMNS,
+                                        view_name='flight_index', view_builder=FlightFacetIndex.build)
+    except Exception as e:
+        logger.error(f"Error building flight index: {str(e)}")
+        return None
+
+
+def read_segment_item_ids(bucket, key):
+    """Stream the itemId of every segment line from S3 without parsing the user lists"""
+    try:
+        logger.info(f"Streaming segment item IDs from s3://{bucket}/{key}")
+        with request_metrics.phase('s3'):
+            response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        request_metrics.add('s3Gets')
+        with request_metrics.phase('stream'):
+            return list(segment_data.iter_segment_item_ids(response['Body']))
+    except Exception as e:
+        logger.error(f"Error reading segment item IDs from S3: {str(e)}")
+        return None
+
+
+def read_segment_manifest(bucket, key):
+    """Map each segmented flight to its user count, from the manifest when it is current.
+
+    Falls back to streaming the item IDs out of the segment file, in which
+    case the user counts are None.
+    """
+    bundle = read_index_bundle(bucket)
+    manifest = bundle.segment_manifest(key) if bundle else None
+    if manifest is not None and segment_data.manifest_is_fresh(manifest, lambda source: dataset_cache.etag(bucket, source)):
+        return manifest['flights']
+
+    manifest_key = segment_data.segment_manifest_key(key)
+    try:
+        manifest = dataset_cache.get(bucket, manifest_key, segment_data.parse_segment_manifest, 'json')
+        if segment_data.manifest_is_fresh(manifest, lambda source: dataset_cache.etag(bucket, source)):
+            return manifest['flights']
+        logger.warning(f"Ignoring stale segment manifest s3://{bucket}/{manifest_key}")
+    except ClientError as e:
+        if not is_missing_object(e):
+            logger.error(f"Error reading segment manifest: {str(e)}")
+    except segment_data.ARTIFACT_ERRORS as e:
+        logger.error(f"Ignoring unreadable segment manifest s3://{bucket}/{manifest_key}: {str(e)}")
+
+    item_ids = read_segment_item_ids(bucket, key)
+    return dict.fromkeys(item_ids) if item_ids is not None else None
+
+
+def parse_list_parameter(value):
+    """Parse an array parameter, which Bedrock may pass as a list, a JSON string or "a, b" text"""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    value = str(value).strip()
+    try:
+        parsed = json.loads(value)
+        if isinstance(parsed, list):
+            return [str(item) for item in parsed]
+    except ValueError:
+        pass
+    return [item.strip().strip('"\'') for item in value.strip('[]').split(',') if item.strip()]
+
+
+def parse_number_parameter(value):
+    """Parse an optional numeric parameter such as "500" or "$500"; raises ValueError if it is not a number"""
+    if value is None or str(value).strip() == '':
+        return None
+    number = float(str(value).strip().lstrip('$').replace(',', ''))
+    if not math.isfinite(number):
+        raise ValueError(f"{value} is not a finite number")
+    return number
+
+
 def lambda_handler(event, context):
     # ============= CONFIGURATION CONSTANTS =============
     # S3 bucket configuration
@@ -21,12 +126,29 @@ def lambda_handler(event, context):
     # Segment file paths
     SEGMENT_OUTPUT_PATH = 'segments/batch_segment_input_ab3.json.out'
     
+    # Pagination of listPromotionalFlights
+    DEFAULT_PAGE_SIZE = 25
+    MAX_PAGE_SIZE = 100
+    
+    # Response field -> items column for listPromotionalFlights (hasSegment is computed)
+    FLIGHT_FIELDS = {
+        'itemId': 'ITEM_ID',
+        'source': 'SRC_CITY',
+        'destination': 'DST_CITY',
+        'airline': 'AIRLINE',
+        'month': 'MONTH',
+        'price': 'DYNAMIC_PRICE',
+        'duration': 'DURATION_DAYS'
+    }
+    
     # ============= END CONFIGURATION =============
     
-    logger.info(f"Event received: {json.dumps(event)}")
+    request_metrics.begin('FlightManagement', event.get('apiPath', ''))
+    if request_metrics.payload_sampled():
+        logger.info(f"Event received: {json.dumps(event)}")
 
-    # Initialize S3 client
-    s3_client = boto3.client('s3')
+    # Revalidate cached datasets once for this invocation
+    dataset_cache.begin_request()
     
     def get_named_parameter(event, name, default=None):
         """Safely get a named parameter from the event"""
@@ -37,82 +159,103 @@ def lambda_handler(event, context):
             logger.warning(f"Parameter {name} not found in event")
             return default
 
-    def read_s3_csv(bucket, key):
-        """Read CSV data from S3"""
-        try:
-            logger.info(f"Reading CSV from s3://{bucket}/{key}")
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            content = response['Body'].read().decode('utf-8')
-            df = pd.read_csv(StringIO(content))
-            logger.info(f"Successfully read CSV with {len(df)} rows")
-            return df
-        except Exception as e:
-            logger.error(f"Error reading CSV from S3: {str(e)}")
-            return None
-            
-    def read_s3_json(bucket, key):
-        """Read JSONL data from S3"""
-        try:
-            logger.info(f"Reading JSON from s3://{bucket}/{key}")
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            content = response['Body'].read().decode('utf-8')
-            # Split content by lines and parse each line as separate JSON
-            json_objects = []
-            for line in content.strip().split('\n'):
-                if line:  # Skip empty lines
-                    json_objects.append(json.loads(line))
-            logger.info(f"Successfully read {len(json_objects)} JSON objects")
-            return json_objects
-        except Exception as e:
-            logger.error(f"Error reading JSON from S3: {str(e)}")
-            return None
-
     def list_promotional_flights(event):
-        """List all promotional flights available for email campaigns"""
+        """List one page of the promotional flights available for email campaigns"""
         month_filter = get_named_parameter(event, 'month', None)
         destination_filter = get_named_parameter(event, 'destination', None)
+        airline_filter = get_named_parameter(event, 'airline', None)
         
-        items_df = read_s3_csv(BUCKET_NAME, ITEMS_CSV_PATH)
-        if items_df is None:
-            return {"error": "Failed to load flight data"}
+        # Validate the price and duration ranges
+        try:
+            price_range = (parse_number_parameter(get_named_parameter(event, 'minPrice', None)),
+                           parse_number_parameter(get_named_parameter(event, 'maxPrice', None)))
+            duration_range = (parse_number_parameter(get_named_parameter(event, 'minDuration', None)),
+                              parse_number_parameter(get_named_parameter(event, 'maxDuration', None)))
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "minPrice, maxPrice, minDuration and maxDuration must be numbers"
+            }
+        if any(low is not None and high is not None and low > high for low, high in (price_range, duration_range)):
+            return {
+                "status": "error",
+                "message": "minPrice and minDuration must not exceed maxPrice and maxDuration"
+            }
         
-        # Get all promotional flights that are not expired
-        promo_flights = items_df[(items_df['PROMOTION'] == 'Yes') & (items_df['EXPIRED'] != 'Yes')]
+        # Validate paging, projection and sort options
+        try:
+            limit = min(max(int(get_named_parameter(event, 'limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+            offset = max(int(get_named_parameter(event, 'cursor', None) or 0), 0)
+        except (TypeError, ValueError):
+            return {
+                "status": "error",
+                "message": "limit and cursor must be integers"
+            }
         
-        # Apply filters if provided
-        if month_filter:
-            promo_flights = promo_flights[promo_flights['MONTH'].str.lower() == month_filter.lower()]
+        fields = parse_list_parameter(get_named_parameter(event, 'fields', None)) or list(FLIGHT_FIELDS) + ['hasSegment']
+        unknown_fields = [field for field in fields if field not in FLIGHT_FIELDS and field != 'hasSegment']
+        if unknown_fields:
+            return {
+                "status": "error",
+                "message": f"Unknown fields: {', '.join(unknown_fields)}. Valid fields: {', '.join(list(FLIGHT_FIELDS) + ['hasSegment'])}"
+            }
         
-        if destination_filter:
-            promo_flights = promo_flights[promo_flights['DST_CITY'].str.lower() == destination_filter.lower()]
+        sort_by = get_named_parameter(event, 'sortBy', None)
+        sort_order = (get_named_parameter(event, 'sortOrder', None) or 'asc').lower()
+        if (sort_by and sort_by not in FLIGHT_FIELDS) or sort_order not in ('asc', 'desc'):
+            return {
+                "status": "error",
+                "message": f"sortBy must be one of {', '.join(FLIGHT_FIELDS)} and sortOrder asc or desc"
+            }
         
-        # Get segments to show which flights have user segments available
-        segments = read_s3_json(BUCKET_NAME, SEGMENT_OUTPUT_PATH)
-        segment_item_ids = []
+        # The flight index and the segment manifest are independent, so fetch them together
+        flight_index, segment_user_counts = fetch_all(
+            lambda: read_flight_index(BUCKET_NAME, ITEMS_CSV_PATH),
+            lambda: read_segment_manifest(BUCKET_NAME, SEGMENT_OUTPUT_PATH) if 'hasSegment' in fields else None
+        )
+        if flight_index is None:
+            return {"error": "Failed to load flight data"}
         
-        if segments:
-            segment_item_ids = [segment.get('input', {}).get('itemId') for segment in segments]
+        # Promotional, unexpired flights matching the filters (text ones case-insensitive), as one bitmap AND
+        matches = flight_index.select(month=month_filter, destination=destination_filter, airline=airline_filter,
+                                      price=price_range, duration=duration_range)
+        total_count = flight_index.count(matches)
         
-        # Prepare results
-        results = []
-        for _, flight in promo_flights.iterrows():
-            flight_data = {
-                "itemId": flight.get('ITEM_ID'),
-                "source": flight.get('SRC_CITY'),
-                "destination": flight.get('DST_CITY'),
-                "airline": flight.get('AIRLINE'),
-                "month": flight.get('MONTH'),
-                "price": flight.get('DYNAMIC_PRICE'),
-                "duration": flight.get('DURATION_DAYS'),
-                "hasSegment": flight.get('ITEM_ID') in segment_item_ids
-            }
-            results.append(flight_data)
+        if sort_by:
+            # Sort with ITEM_ID as the tie-breaker so pages are stable across calls
+            promo_flights = flight_index.rows(matches)
+            if sort_by != 'itemId':
+                promo_flights = promo_flights.sort_values(
+                    [FLIGHT_FIELDS[sort_by], 'ITEM_ID'], ascending=[sort_order == 'asc', True], kind='stable')
+            else:
+                promo_flights = promo_flights.sort_values('ITEM_ID', ascending=sort_order == 'asc', kind='stable')
+            page = promo_flights.iloc[offset:offset + limit]
+        else:
+            # Items order: only the rows of the page are materialized
+            page = flight_index.items_df.iloc[flight_index.positions(matches)[offset:offset + limit]]
+        
+        # Serialize only the requested columns of the requested page
+        columns = [field for field in fields if field in FLIGHT_FIELDS]
+        page_data = page[[FLIGHT_FIELDS[field] for field in columns]]
+        page_data.columns = columns
+        if 'hasSegment' in fields:
+            # Show which flights have user segments available
+            page_data = page_data.assign(hasSegment=page['ITEM_ID'].isin(list(segment_user_counts or {})).to_numpy())
+        results = page_data.astype(object).where(page_data.notna(), None).to_dict('records')
+        
+        next_offset = offset + len(page)
+        month_counts = flight_index.facet_counts('month', matches)
+        destination_counts = flight_index.facet_counts('destination', matches)
         
         return {
             "flights": results,
-            "totalCount": len(results),
-            "monthOptions": sorted(promo_flights['MONTH'].unique().tolist()),
-            "destinationOptions": sorted(promo_flights['DST_CITY'].unique().tolist())
+            "totalCount": total_count,
+            "returnedCount": len(results),
+            "nextCursor": str(next_offset) if next_offset < total_count else None,
+            "monthOptions": list(month_counts),
+            "destinationOptions": list(destination_counts),
+            "monthCounts": month_counts,
+            "destinationCounts": destination_counts
         }
     
     def prepare_segment_input(event):
@@ -158,16 +301,17 @@ def lambda_handler(event, context):
     logger.info(f"Processing request: {action_group}::{api_path}")
 
     try:
-        if api_path == '/listPromotionalFlights':
-            result = list_promotional_flights(event)
-        elif api_path == '/prepareSegmentInput':
-            result = prepare_segment_input(event)
-        else:
-            response_code = 404
-            result = {
-                "status": "error",
-                "message": f"Unrecognized api path: {action_group}::{api_path}"
-            }
+        with request_metrics.phase('compute'):
+            if api_path == '/listPromotionalFlights':
+                result = list_promotional_flights(event)
+            elif api_path == '/prepareSegmentInput':
+                result = prepare_segment_input(event)
+            else:
+                response_code = 404
+                result = {
+                    "status": "error",
+                    "message": f"Unrecognized api path: {action_group}::{api_path}"
+                }
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         response_code = 500
@@ -191,5 +335,12 @@ def lambda_handler(event, context):
     }
 
     api_response = {'messageVersion': '1.0', 'response': action_response}
-    logger.info(f"Returning response: {json.dumps(api_response)}")
+    
+    # Serialize once to measure the response; full payloads are only logged for sampled requests
+    with request_metrics.phase('serialize'):
+        response_json = json.dumps(api_response, default=str)
+    request_metrics.add('responseBytes', len(response_json))
+    if request_metrics.payload_sampled():
+        logger.info(f"Returning response: {response_json}")
+    request_metrics.emit(response_code)
     return api_response
\ No newline at end of file
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# CloudWatch namespace of the embedded metric format (EMF) records
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', '1Shot/ActionGroups')
+# Share of requests whose full event and response are logged
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get('PAYLOAD_LOG_SAMPLE_RATE', '0.01'))
+# ============= END CONFIGURATION =============
+
+# Units of the counters recorded with add(); phases are always in milliseconds
+COUNTER_UNITS = {
+    's3Bytes': 'Bytes',
+    'responseBytes': 'Bytes',
+    's3Gets': 'Count',
+    's3NotModified': 'Count',
+    's3Heads': 'Count',
+    's3Puts': 'Count'
+}
+
+
+class RequestMetrics:
+    """Phase timings and counters of one Lambda invocation.
+
+    Phases are exclusive: entering a nested phase pauses the enclosing one,
+    so the time spent fetching from S3 inside a compute phase is reported as
+    s3, not compute. Phases entered on worker threads add their own time,
+    so phase totals can exceed the wall-clock total.
+    """
+
+    def __init__(self, service, api_path, sample_payload=False):
+        self.service = service
+        self.api_path = api_path
+        self.sample_payload = sample_payload
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _charge(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Attribute the time spent in the block to a phase"""
+        stack = self._stack()
+        now = time.perf_counter()
+        if stack:
+            parent, parent_start = stack[-1]
+            self._charge(parent, now - parent_start)
+        stack.append((name, now))
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, start = stack.pop()
+            self._charge(name, now - start)
+            if stack:
+                stack[-1] = (stack[-1][0], now)
+
+    def add(self, name, value=1):
+        """Add to a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, status_code):
+        """Build the EMF record for this invocation"""
+        total_ms = (time.perf_counter() - self.started) * 1000
+        values = {f"{name}Ms": round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        values['totalMs'] = round(total_ms, 3)
+        values.update(self.counters)
+
+        units = {name: 'Milliseconds' if name.endswith('Ms') else COUNTER_UNITS.get(name, 'Count') for name in values}
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Service", "ApiPath"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()]
+                }]
+            },
+            "Service": self.service,
+            "ApiPath": self.api_path,
+            "StatusCode": status_code,
+            **values
+        }
+
+
+# Metrics of the invocation in progress; a Lambda container runs one invocation at a time
+_current = None
+
+
+def begin(service, api_path):
+    """Start collecting metrics for an invocation"""
+    global _current
+    _current = RequestMetrics(service, api_path, random.random() < PAYLOAD_LOG_SAMPLE_RATE)
+    return _current
+
+
+@contextmanager
+def phase(name):
+    """Attribute the time spent in the block to a phase of the current invocation"""
+    if _current is None:
+        yield
+        return
+    with _current.phase(name):
+        yield
+
+
+def add(name, value=1):
+    """Add to a counter of the current invocation"""
+    if _current is not None:
+        _current.add(name, value)
+
+
+def payload_sampled():
+    """Whether the current invocation should log its full event and response"""
+    return _current is not None and _current.sample_payload
+
+
+def emit(status_code):
+    """Write the current invocation's metrics as one EMF line on stdout and stop collecting"""
+    global _current
+    if _current is None:
+        return None
+    record = _current.record(status_code)
+    _current = None
+    # EMF records must be bare JSON lines, so they bypass the logging formatter
+    sys.stdout.write(json.dumps(record) + '\n')
+    sys.stdout.flush()
+    return record
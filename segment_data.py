@@ -0,0 +1,505 @@
+import io
+import re
+import json
+import logging
+from bisect import bisect_left
+from datetime import datetime, timezone
+from itertools import chain
+
+import numpy as np
+
+import request_metrics
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# Number of user IDs kept per flight as a sample in the statistics artifact
+STATS_USER_SAMPLE_SIZE = 5
+STATS_FORMAT_VERSION = 1
+MANIFEST_FORMAT_VERSION = 1
+OFFSET_INDEX_FORMAT_VERSION = 1
+
+# Overlap queries sort the chosen flights' members instead of counting into an array
+# over every user when there are fewer than 1/SPARSE_OVERLAP_RATIO as many members as users
+SPARSE_OVERLAP_RATIO = 16
+
+# Bytes pulled from the S3 body stream per read while scanning segment lines
+SEGMENT_STREAM_CHUNK_SIZE = 64 * 1024
+# ============= END CONFIGURATION =============
+
+# What parsing or checking a truncated or corrupt JSON artifact can raise
+ARTIFACT_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+
+# Locates the itemId of a segment line without parsing its usersList
+ITEM_ID_PATTERN = re.compile(rb'"itemId"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def segment_artifact_key(segment_key, suffix):
+    """Map segments/x.json.out to segments/x<suffix>"""
+    base = segment_key[:-len('.json.out')] if segment_key.endswith('.json.out') else segment_key
+    return f"{base}{suffix}"
+
+
+def segment_stats_key(segment_key):
+    """Map segments/x.json.out to segments/x.stats.json"""
+    return segment_artifact_key(segment_key, '.stats.json')
+
+
+def segment_manifest_key(segment_key):
+    """Map segments/x.json.out to segments/x.manifest.json"""
+    return segment_artifact_key(segment_key, '.manifest.json')
+
+
+def segment_offset_index_key(segment_key):
+    """Map segments/x.json.out to segments/x.idx.json"""
+    return segment_artifact_key(segment_key, '.idx.json')
+
+
+def iter_segment_lines(body):
+    """Yield the non-empty raw lines of a segment output stream, closing it when done"""
+    streamed = 0
+    try:
+        for line in body.iter_lines(chunk_size=SEGMENT_STREAM_CHUNK_SIZE):
+            streamed += len(line) + 1
+            if line.strip():
+                yield line
+    finally:
+        body.close()
+        request_metrics.add('s3Bytes', streamed)
+
+
+def iter_segment_spans(body):
+    """Yield (byte offset, raw line) for every non-empty line of a segment output stream, closing it when done"""
+    streamed = 0
+    offset = 0
+    pending = b''
+    try:
+        for chunk in body.iter_chunks(chunk_size=SEGMENT_STREAM_CHUNK_SIZE):
+            streamed += len(chunk)
+            # Only the new chunk can hold the next newline
+            search_from = len(pending)
+            pending += chunk
+            start = 0
+            end = pending.find(b'\n', search_from)
+            while end >= 0:
+                line = pending[start:end]
+                if line.strip():
+                    yield offset + start, line
+                start = end + 1
+                end = pending.find(b'\n', start)
+            offset += start
+            pending = pending[start:]
+        if pending.strip():
+            yield offset, pending
+    finally:
+        body.close()
+        request_metrics.add('s3Bytes', streamed)
+
+
+def line_item_id(line):
+    """Extract the itemId of a raw segment line without decoding the whole line"""
+    match = ITEM_ID_PATTERN.search(line)
+    return json.loads(match.group(1)) if match else None
+
+
+def iter_segments(body):
+    """Parse segment objects one line at a time from an S3 body stream"""
+    for line in iter_segment_lines(body):
+        yield json.loads(line)
+
+
+def iter_segment_item_ids(body):
+    """Yield the itemId of every segment line without parsing the user lists"""
+    for line in iter_segment_lines(body):
+        yield line_item_id(line)
+
+
+def find_segments(body, item_ids):
+    """Yield the segments for item_ids, stopping the stream as soon as all of them are found"""
+    remaining = set(item_ids)
+    lines = iter_segment_lines(body)
+    try:
+        for line in lines:
+            if line_item_id(line) not in remaining:
+                continue
+            segment = json.loads(line)
+            remaining.discard(segment_item_id(segment))
+            yield segment
+            if not remaining:
+                break
+    finally:
+        lines.close()
+
+
+def segment_item_id(segment):
+    """Return the flight ID a segment line was generated for"""
+    return segment.get('input', {}).get('itemId')
+
+
+def segment_users(segment):
+    """Return the user IDs of a segment line"""
+    return segment.get('output', {}).get('usersList', [])
+
+
+def native(value):
+    """Convert numpy scalars to plain Python values for JSON"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+def encode_user_tiers(user_ids, users_df):
+    """Align MEMBER_TIER with a list of user IDs as int8 tier codes, -1 for users not in users_df.
+
+    Returns (tiers, user_tiers) where user_tiers[i] indexes tiers for user_ids[i],
+    so tier counts over any set of user positions are one np.bincount.
+    """
+    import pandas as pd
+
+    users = users_df.drop_duplicates(subset='USER_ID', keep='first')
+    member_tiers = users['MEMBER_TIER'].astype('category')
+    positions = pd.Index(users['USER_ID'].astype(str)).get_indexer(user_ids)
+
+    user_tiers = np.full(len(user_ids), -1, dtype=np.int8)
+    found = positions >= 0
+    user_tiers[found] = member_tiers.cat.codes.to_numpy()[positions[found]]
+    return [native(tier) for tier in member_tiers.cat.categories], user_tiers
+
+
+def count_tiers(tiers, user_tiers, positions=None):
+    """Count the tiers of the users at positions (all users when None), most common first"""
+    selected = user_tiers if positions is None else user_tiers[positions]
+    counts = np.bincount(selected[selected >= 0], minlength=len(tiers))
+    return {tiers[i]: int(counts[i]) for i in np.argsort(-counts, kind='stable') if counts[i] > 0}
+
+
+def normalize_tier_distribution(tier_distribution):
+    """Key tier counts by tier name, most common first and ties by name, as they read back from JSON"""
+    counts = {str(tier): int(count) for tier, count in (tier_distribution or {}).items()}
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+def compute_segment_stats(segments, interactions_df, users_df):
+    """Compute per-flight segment statistics for many flights with one pass of groupbys.
+
+    interactions_df needs USER_ID, ITEM_ID, EVENT_VALUE and CABIN_TYPE;
+    users_df needs USER_ID and MEMBER_TIER (it may be None).
+    """
+    import pandas as pd
+
+    flight_users = {}
+    for segment in segments:
+        flight_users.setdefault(segment_item_id(segment), segment_users(segment))
+
+    membership = pd.DataFrame({
+        'ITEM_ID': list(chain.from_iterable([item_id] * len(users) for item_id, users in flight_users.items())),
+        'USER_ID': list(chain.from_iterable(flight_users.values()))
+    }).drop_duplicates()
+
+    # Interactions of segment users with the flight they were segmented for
+    segment_interactions = interactions_df.merge(membership, on=['ITEM_ID', 'USER_ID'])
+    insights = compute_interaction_insights(segment_interactions)
+
+    # Tiers are joined once per distinct user, then counted per flight on int codes
+    index = SegmentMembershipIndex.build(segments)
+    if users_df is not None:
+        index.attach_tiers(users_df)
+
+    flights = {}
+    for item_id, users in flight_users.items():
+        flight_insights = insights.get(item_id, {})
+        flights[item_id] = {
+            "userCount": len(users),
+            "userSample": users[:STATS_USER_SAMPLE_SIZE],
+            "tierDistribution": index.tier_distribution(index.flight_codes(item_id)) or {},
+            "cabinRatings": flight_insights.get("cabinRatings", {}),
+            "interactionInsights": flight_insights.get("interactionInsights")
+        }
+
+    return flights
+
+
+def compute_interaction_insights(interactions_df):
+    """Compute rating insights and cabin ratings for every ITEM_ID in interactions_df at once"""
+    by_flight = interactions_df.groupby('ITEM_ID', observed=True)['EVENT_VALUE']
+    averages = by_flight.mean()
+    totals = by_flight.size()
+    by_cabin = interactions_df.groupby(['ITEM_ID', 'CABIN_TYPE'], observed=True)['EVENT_VALUE']
+    cabin_counts = by_cabin.size()
+    cabin_ratings = by_cabin.mean()
+    rating_counts = interactions_df.groupby(['ITEM_ID', 'EVENT_VALUE'], observed=True).size()
+
+    insights = {}
+    for item_id, total in totals.items():
+        insights[item_id] = {
+            "cabinRatings": {},
+            "interactionInsights": {
+                "averageRating": native(averages[item_id]),
+                "cabinTypeDistribution": {},
+                "ratingDistribution": {},
+                "totalInteractions": native(total)
+            }
+        }
+    for (item_id, cabin), count in cabin_counts.items():
+        insights[item_id]["interactionInsights"]["cabinTypeDistribution"][native(cabin)] = native(count)
+        insights[item_id]["cabinRatings"][native(cabin)] = native(cabin_ratings[(item_id, cabin)])
+    for (item_id, rating), count in rating_counts.items():
+        insights[item_id]["interactionInsights"]["ratingDistribution"][native(rating)] = native(count)
+
+    return insights
+
+
+def build_segment_stats(segments, interactions_df, users_df, sources):
+    """Build the statistics artifact; sources maps each input S3 key to the ETag it was read at"""
+    return {
+        "version": STATS_FORMAT_VERSION,
+        "builtAt": datetime.now(timezone.utc).isoformat(),
+        "sources": sources,
+        "flights": compute_segment_stats(segments, interactions_df, users_df)
+    }
+
+
+def parse_segment_stats(body):
+    """Parse a statistics artifact, restoring the integer keys of rating distributions"""
+    stats = json.loads(body)
+    for flight in stats.get('flights', {}).values():
+        insights = flight.get('interactionInsights')
+        if insights:
+            insights['ratingDistribution'] = {
+                int(float(rating)) if float(rating).is_integer() else float(rating): count
+                for rating, count in insights['ratingDistribution'].items()
+            }
+    return stats
+
+
+def sources_are_fresh(sources, current_etag):
+    """Check that every input of an artifact still has the ETag it was built from"""
+    for key, etag in sources.items():
+        try:
+            if current_etag(key) != etag:
+                logger.info(f"Segment artifact is stale: {key} changed")
+                return False
+        except Exception as e:
+            logger.warning(f"Could not check {key} for segment artifact freshness: {str(e)}")
+            return False
+    return True
+
+
+def stats_are_fresh(stats, current_etag):
+    """Check that a statistics artifact is current for every input it was built from"""
+    if not stats or stats.get('version') != STATS_FORMAT_VERSION:
+        return False
+    return sources_are_fresh(stats.get('sources', {}), current_etag)
+
+
+def build_segment_manifest(segments, sources):
+    """Build the manifest mapping each segmented flight to its user count, in segment file order"""
+    flights = {}
+    for segment in segments:
+        flights.setdefault(segment_item_id(segment), len(segment_users(segment)))
+    return {
+        "version": MANIFEST_FORMAT_VERSION,
+        "builtAt": datetime.now(timezone.utc).isoformat(),
+        "sources": sources,
+        "flights": flights
+    }
+
+
+def parse_segment_manifest(body):
+    """Parse a segment manifest"""
+    return json.loads(body)
+
+
+def manifest_is_fresh(manifest, current_etag):
+    """Check that a segment manifest is current for the segment file it was built from"""
+    if not manifest or manifest.get('version') != MANIFEST_FORMAT_VERSION:
+        return False
+    return sources_are_fresh(manifest.get('sources', {}), current_etag)
+
+
+def build_segment_offset_index(spans, sources):
+    """Build the offset index mapping each itemId to the [offset, length] of its first line.
+
+    spans are (offset, raw line) pairs from iter_segment_spans; the index lets
+    a single flight's segment be read with one ranged GET.
+    """
+    lines = {}
+    for offset, line in spans:
+        lines.setdefault(line_item_id(line), [offset, len(line)])
+    return {
+        "version": OFFSET_INDEX_FORMAT_VERSION,
+        "builtAt": datetime.now(timezone.utc).isoformat(),
+        "sources": sources,
+        "lines": lines
+    }
+
+
+def parse_segment_offset_index(body):
+    """Parse a segment offset index"""
+    return json.loads(body)
+
+
+def offset_index_is_fresh(index, current_etag):
+    """Check that a segment offset index is current for the segment file it was built from"""
+    if not index or index.get('version') != OFFSET_INDEX_FORMAT_VERSION:
+        return False
+    return sources_are_fresh(index.get('sources', {}), current_etag)
+
+
+def segment_line_range(span):
+    """HTTP Range header value for an [offset, length] span of the offset index"""
+    offset, length = span
+    return f"bytes={offset}-{offset + length - 1}"
+
+
+def parse_segment_line(body, item_id):
+    """Parse a segment line read by byte range, or None when it is not the line for item_id"""
+    try:
+        segment = json.loads(body)
+    except ValueError:
+        return None
+    return segment if segment_item_id(segment) == item_id else None
+
+
+def segment_membership_key(segment_key):
+    """Map segments/x.json.out to segments/x.membership.npz"""
+    return segment_artifact_key(segment_key, '.membership.npz')
+
+
+class SegmentMembershipIndex:
+    """Segment membership stored as sorted int32 user codes, in both directions.
+
+    Users are dictionary-encoded to dense codes (their position in the sorted
+    user_ids list). flight_members[flight_offsets[i]:flight_offsets[i + 1]]
+    holds the sorted codes of the users in segment i, and
+    user_flights[user_offsets[u]:user_offsets[u + 1]] the segments user u
+    belongs to. Overlap queries over any subset of flights count memberships
+    with np.bincount, in O(members of the chosen flights + users), or with
+    np.unique, in O(m log m) for m members, when m is small next to the users.
+    When tiers are attached, user_tiers[u] indexes the MEMBER_TIER of user u
+    in tiers, so tier distributions are also a bincount.
+    """
+
+    def __init__(self, user_ids, item_ids, flight_offsets, flight_members, user_offsets, user_flights, sources=None,
+                 tiers=None, user_tiers=None):
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self.flight_offsets = flight_offsets
+        self.flight_members = flight_members
+        self.user_offsets = user_offsets
+        self.user_flights = user_flights
+        self.sources = sources or {}
+        self.tiers = tiers
+        self.user_tiers = user_tiers
+        self._flight_positions = {item_id: i for i, item_id in enumerate(item_ids)}
+
+    @classmethod
+    def build(cls, segments, sources=None):
+        """Build the index from parsed segment lines"""
+        flight_users = {}
+        for segment in segments:
+            flight_users.setdefault(segment_item_id(segment), segment_users(segment))
+
+        user_ids = sorted(set(chain.from_iterable(flight_users.values())))
+        codes = {user_id: code for code, user_id in enumerate(user_ids)}
+
+        item_ids = list(flight_users)
+        members = [np.unique(np.fromiter((codes[u] for u in users), dtype=np.int32, count=len(users)))
+                   for users in flight_users.values()]
+        flight_offsets = np.zeros(len(members) + 1, dtype=np.int64)
+        np.cumsum([len(m) for m in members], out=flight_offsets[1:])
+        flight_members = np.concatenate(members) if members else np.zeros(0, dtype=np.int32)
+
+        # Transpose: stable sort by user code keeps each user's flights in flight order
+        flight_of_member = np.repeat(np.arange(len(item_ids), dtype=np.int32), np.diff(flight_offsets))
+        order = np.argsort(flight_members, kind='stable')
+        user_flights = flight_of_member[order]
+        user_offsets = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(flight_members, minlength=len(user_ids)), out=user_offsets[1:])
+
+        return cls(user_ids, item_ids, flight_offsets, flight_members, user_offsets, user_flights, sources)
+
+    @classmethod
+    def load(cls, body):
+        """Load an index written by to_bytes"""
+        with np.load(io.BytesIO(body), allow_pickle=False) as arrays:
+            meta = json.loads(arrays['meta'].tobytes())
+            user_ids = arrays['user_ids'].tobytes().decode('utf-8').split('\n') if arrays['user_ids'].size else []
+            user_tiers = arrays['user_tiers'] if 'user_tiers' in arrays.files else None
+            return cls(user_ids, meta['itemIds'], arrays['flight_offsets'], arrays['flight_members'],
+                       arrays['user_offsets'], arrays['user_flights'], meta.get('sources'),
+                       meta.get('tiers'), user_tiers)
+
+    def to_bytes(self):
+        """Serialize the index as an uncompressed .npz archive"""
+        meta = json.dumps({"itemIds": self.item_ids, "sources": self.sources, "tiers": self.tiers}).encode('utf-8')
+        tier_arrays = {} if self.user_tiers is None else {'user_tiers': self.user_tiers}
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            **tier_arrays,
+            meta=np.frombuffer(meta, dtype=np.uint8),
+            user_ids=np.frombuffer('\n'.join(self.user_ids).encode('utf-8'), dtype=np.uint8),
+            flight_offsets=self.flight_offsets,
+            flight_members=self.flight_members,
+            user_offsets=self.user_offsets,
+            user_flights=self.user_flights
+        )
+        return buffer.getvalue()
+
+    def attach_tiers(self, users_df, sources=None):
+        """Encode every indexed user's MEMBER_TIER; sources records the users table's key and ETag"""
+        self.tiers, self.user_tiers = encode_user_tiers(self.user_ids, users_df)
+        self.sources.update(sources or {})
+        return self
+
+    def tier_distribution(self, codes):
+        """Tier counts of the given user codes, most common first, or None when no tiers are attached"""
+        if self.user_tiers is None:
+            return None
+        return count_tiers(self.tiers, self.user_tiers, codes)
+
+    def flight_codes(self, item_id):
+        """Sorted user codes of one flight's segment (empty when it has none)"""
+        position = self._flight_positions.get(item_id)
+        if position is None:
+            return self.flight_members[:0]
+        return self.flight_members[self.flight_offsets[position]:self.flight_offsets[position + 1]]
+
+    def membership_counts(self, item_ids):
+        """Number of the given flights' segments each user code belongs to"""
+        selected = [self.flight_codes(item_id) for item_id in dict.fromkeys(item_ids)]
+        if not selected:
+            return np.zeros(len(self.user_ids), dtype=np.int64)
+        return np.bincount(np.concatenate(selected), minlength=len(self.user_ids))
+
+    def at_least(self, item_ids, k):
+        """Codes of users who are in at least k (>= 1) of the given flights' segments"""
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        selected = [self.flight_codes(item_id) for item_id in dict.fromkeys(item_ids)]
+        member_count = sum(len(codes) for codes in selected)
+        if member_count * SPARSE_OVERLAP_RATIO < len(self.user_ids):
+            if not member_count:
+                return np.zeros(0, dtype=np.int64)
+            codes, counts = np.unique(np.concatenate(selected), return_counts=True)
+            return codes[counts >= k].astype(np.int64)
+        return np.flatnonzero(self.membership_counts(item_ids) >= k)
+
+    def union(self, item_ids):
+        """Codes of users in any of the given flights' segments"""
+        return self.at_least(item_ids, 1)
+
+    def intersection(self, item_ids):
+        """Codes of users in every one of the given flights' segments"""
+        return self.at_least(item_ids, max(len(dict.fromkeys(item_ids)), 1))
+
+    def decode(self, codes):
+        """Map user codes back to user IDs"""
+        return [self.user_ids[code] for code in codes]
+
+    def flights_for_user(self, user_id):
+        """Item IDs of every segment a user belongs to"""
+        code = bisect_left(self.user_ids, user_id)
+        if code == len(self.user_ids) or self.user_ids[code] != user_id:
+            return []
+        flights = self.user_flights[self.user_offsets[code]:self.user_offsets[code + 1]]
+        return [self.item_ids[flight] for flight in flights]
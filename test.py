@@ -2,11 +2,20 @@ import streamlit as st
 import boto3
 import pandas as pd
 import json
-import time
 import os
-from io import StringIO
+import hashlib
+import codecs
 from datetime import datetime
 import re
+import uuid
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import travel_data
+import segment_data
+import interaction_partitions
+from dataset_cache import is_missing_object
+from flight_index import FlightFacetIndex
 
 # Set up page config
 st.set_page_config(
@@ -29,6 +38,10 @@ if 'selected_flights' not in st.session_state:
 if 'email_templates' not in st.session_state:
     st.session_state.email_templates = {}
 
+# One agent session per browser session, so the agent keeps its memory across turns
+if 'agent_session_id' not in st.session_state:
+    st.session_state.agent_session_id = f"session-{uuid.uuid4().hex}"
+
 if 'active_section' not in st.session_state:
     st.session_state.active_section = "flights"
 
@@ -46,6 +59,24 @@ INTERACTIONS_CSV_PATH = 'data/travel_interactions.csv'
 SEGMENTS_OUTPUT_PATH = 'segments/batch_segment_input_ab3.json.out'
 EMAIL_TEMPLATES_PATH = 'email_templates/'
 
+# Data caching - ETags are re-checked with a HEAD after ETAG_CHECK_TTL_SECONDS;
+# parsed data is keyed by ETag and kept for DATA_CACHE_TTL_SECONDS
+ETAG_CHECK_TTL_SECONDS = 60
+DATA_CACHE_TTL_SECONDS = 3600
+DATA_CACHE_MAX_ENTRIES = 64
+# Lookups of up to this many segments read only their lines, by byte range through the offset index
+SEGMENT_RANGE_READ_MAX_LINES = 16
+
+# Bedrock agent client - connections kept open, and attempts per call with adaptive
+# (throttling-aware) backoff; agent turns that run several tools can take minutes
+AGENT_MAX_POOL_CONNECTIONS = 10
+AGENT_MAX_ATTEMPTS = 5
+AGENT_READ_TIMEOUT_SECONDS = 300
+# Have the agent stream its final answer in chunks instead of one chunk at the end of the turn;
+# with guardrails on the alias, they are applied every AGENT_GUARDRAIL_INTERVAL characters (0 = not set)
+AGENT_STREAM_FINAL_RESPONSE = True
+AGENT_GUARDRAIL_INTERVAL = int(os.environ.get('AGENT_GUARDRAIL_INTERVAL', '0'))
+
 # Helper functions
 
 
@@ -60,7 +91,13 @@ def get_aws_clients():
 
         bedrock_agent_client = boto3.client(
             'bedrock-agent-runtime',
-            region_name=bedrock_region
+            region_name=bedrock_region,
+            config=Config(
+                max_pool_connections=AGENT_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': AGENT_MAX_ATTEMPTS, 'mode': 'adaptive'},
+                read_timeout=AGENT_READ_TIMEOUT_SECONDS,
+                tcp_keepalive=True
+            )
         )
 
         return s3_client, bedrock_agent_client
@@ -69,36 +106,168 @@ def get_aws_clients():
         return None, None
 
 
-def read_s3_csv(bucket, key):
-    """Read CSV data from S3"""
+@st.cache_data(ttl=ETAG_CHECK_TTL_SECONDS, show_spinner=False)
+def get_s3_etag(bucket, key):
+    """Return the current ETag of an S3 object, or None if it does not exist"""
+    s3_client, _ = get_aws_clients()
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key).get('ETag')
+    except ClientError as e:
+        if is_missing_object(e):
+            return None
+        raise
+
+
+@st.cache_data(ttl=ETAG_CHECK_TTL_SECONDS, show_spinner=False)
+def get_s3_metadata(bucket, key):
+    """Return the ETag and user metadata of an S3 object, or (None, {}) if it does not exist"""
+    s3_client, _ = get_aws_clients()
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if is_missing_object(e):
+            return None, {}
+        raise
+    return response.get('ETag'), response.get('Metadata') or {}
+
+
+def filter_cache_key(filters):
+    """Compact, hashable stand-in for filters: value lists are reduced to their size and a digest"""
+    key = []
+    for column, op, value in filters or []:
+        if isinstance(value, (list, tuple, set, frozenset)):
+            values = sorted(str(item) for item in value)
+            value = (len(values), hashlib.sha1('\n'.join(values).encode('utf-8')).hexdigest())
+        key.append((column, op, value))
+    return tuple(key)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_dataset(bucket, key, etag, columns=None, filter_key=(), _filters=None):
+    """Parse a snapshot or CSV object at a given ETag; _filters is unhashed and keyed by filter_key instead"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    if key.endswith('.parquet'):
+        return travel_data.parse_snapshot(response['Body'].read(), columns, _filters, travel_data.dataset_dtypes(key))
+    df = travel_data.parse_csv(response['Body'].read(), columns, travel_data.dataset_dtypes(key))
+    return travel_data.apply_filters(df, _filters)
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segments(bucket, key, etag, item_ids=None):
+    """Parse the segment lines of a JSONL object at a given ETag, optionally only those for item_ids"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    if item_ids is None:
+        return list(segment_data.iter_segments(response['Body']))
+    # Stops reading the stream as soon as every requested segment is found
+    return list(segment_data.find_segments(response['Body'], item_ids))
+
+
+def current_dataset_object(bucket, key):
+    """Return the (key, ETag) to read a travel dataset from: its Parquet snapshot if built from the current CSV, else the CSV"""
+    csv_etag = get_s3_etag(bucket, key)
+    if travel_data.SNAPSHOTS_SUPPORTED:
+        snapshot_key = travel_data.snapshot_key(key)
+        snapshot_etag, snapshot_metadata = get_s3_metadata(bucket, snapshot_key)
+        if snapshot_etag and travel_data.snapshot_is_current(snapshot_metadata, csv_etag):
+            return snapshot_key, snapshot_etag
+    return key, csv_etag
+
+
+def read_s3_csv(bucket, key, columns=None, filters=None):
+    """Read a travel dataset from S3, preferring its Parquet snapshot over the CSV"""
     try:
         s3_client, _ = get_aws_clients()
         if not s3_client:
             return None
 
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(content))
-        return df
+        object_key, etag = current_dataset_object(bucket, key)
+        if not etag:
+            st.error(f"Error reading CSV from S3: s3://{bucket}/{key} does not exist")
+            return None
+        return load_s3_dataset(bucket, object_key, etag, columns, filter_cache_key(filters), filters)
     except Exception as e:
         st.error(f"Error reading CSV from S3: {str(e)}")
         return None
 
 
-def read_s3_json(bucket, key):
-    """Read JSONL data from S3"""
+@st.cache_resource(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_flight_index(bucket, key, etag):
+    """Build the promotional-flight facet index of an items object at a given ETag"""
+    return FlightFacetIndex.build(load_s3_dataset(bucket, key, etag, travel_data.ITEM_COLUMNS))
+
+
+def read_flight_index(bucket, key):
+    """Read the promotional-flight facet index of the items table, rebuilt only when the table changes"""
     try:
         s3_client, _ = get_aws_clients()
         if not s3_client:
             return None
 
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        json_objects = []
-        for line in content.strip().split('\n'):
-            if line:  # Skip empty lines
-                json_objects.append(json.loads(line))
-        return json_objects
+        object_key, etag = current_dataset_object(bucket, key)
+        if not etag:
+            st.error(f"Error reading CSV from S3: s3://{bucket}/{key} does not exist")
+            return None
+        return load_s3_flight_index(bucket, object_key, etag)
+    except Exception as e:
+        st.error(f"Error reading CSV from S3: {str(e)}")
+        return None
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_offset_index(bucket, key, etag):
+    """Parse a segment offset index at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return segment_data.parse_segment_offset_index(response['Body'].read())
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_line(bucket, key, etag, item_id, span):
+    """Read one segment line by byte range from a JSONL object at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=segment_data.segment_line_range(span), IfMatch=etag)
+    return segment_data.parse_segment_line(response['Body'].read(), item_id)
+
+
+def read_indexed_segments(bucket, key, item_ids):
+    """Read the segments of item_ids with one ranged GET each, or None when the offset index cannot be used"""
+    index_key = segment_data.segment_offset_index_key(key)
+    index_etag = get_s3_etag(bucket, index_key)
+    if not index_etag:
+        return None
+    index = load_s3_segment_offset_index(bucket, index_key, index_etag)
+    if not segment_data.offset_index_is_fresh(index, lambda source: get_s3_etag(bucket, source)):
+        return None
+
+    etag = index['sources'][key]
+    try:
+        segments = [load_s3_segment_line(bucket, key, etag, item_id, tuple(index['lines'][item_id]))
+                    for item_id in dict.fromkeys(item_ids) if item_id in index['lines']]
+    except ClientError:
+        # The segment file changed since the HEAD; scan the new version instead
+        return None
+    return None if any(segment is None for segment in segments) else segments
+
+
+def read_s3_json(bucket, key, item_ids=None):
+    """Read JSONL segment data from S3 line by line, optionally only the lines for item_ids"""
+    try:
+        s3_client, _ = get_aws_clients()
+        if not s3_client:
+            return None
+
+        # Small lookups fetch kilobytes through the offset index instead of scanning the file
+        if item_ids is not None and len(item_ids) <= SEGMENT_RANGE_READ_MAX_LINES:
+            segments = read_indexed_segments(bucket, key, item_ids)
+            if segments is not None:
+                return segments
+
+        etag = get_s3_etag(bucket, key)
+        if not etag:
+            return None
+        return load_s3_segments(bucket, key, etag, tuple(item_ids) if item_ids is not None else None)
     except Exception as e:
         st.error(f"Error reading JSON from S3: {str(e)}")
         return None
@@ -167,9 +336,9 @@ def create_segment_json(flight_ids):
 
 
 def invoke_agent(prompt, session_id=None):
-    """Invoke the Bedrock Agent with a prompt and return the response"""
-    if not session_id:
-        session_id = f"session-{int(time.time())}"
+    """Invoke the Bedrock Agent with a prompt and yield the response text as it streams in"""
+    # Reuse the browser session's agent session, so the agent remembers earlier turns and tool results
+    session_id = session_id or st.session_state.agent_session_id
 
     _, bedrock_agent_client = get_aws_clients()
 
@@ -180,7 +349,7 @@ def invoke_agent(prompt, session_id=None):
 
         # Return a response that indicates this is a placeholder
         if "generate email" in prompt.lower() or "email template" in prompt.lower():
-            return f"""
+            yield f"""
 [This would invoke your Bedrock Agent in production]
 
 Based on the prompt: "{prompt}"
@@ -214,41 +383,47 @@ Best regards,
 The PandaPaw Express Team
 """
         else:
-            return f"This would connect to your Bedrock Agent in production. Your prompt was: {prompt}"
+            yield f"This would connect to your Bedrock Agent in production. Your prompt was: {prompt}"
+        return
 
     try:
+        streaming_configurations = {'streamFinalResponse': AGENT_STREAM_FINAL_RESPONSE}
+        if AGENT_GUARDRAIL_INTERVAL:
+            streaming_configurations['applyGuardrailInterval'] = AGENT_GUARDRAIL_INTERVAL
+
         # Make the actual call to Bedrock Agent
         response = bedrock_agent_client.invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
             sessionId=session_id,
             inputText=prompt,
-            enableTrace=True
+            enableTrace=True,
+            streamingConfigurations=streaming_configurations
         )
 
         # Process the response
         if 'completion' in response:
             event_stream = response['completion']
-            full_response = ""
+            # One decoder for the whole stream, so a character split across chunks is not garbled
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
 
-            # Extract content from event stream
+            # Hand each chunk to the caller as soon as it arrives
             for event in event_stream:
                 if 'chunk' in event and 'bytes' in event['chunk']:
-                    try:
-                        content_bytes = event['chunk']['bytes']
-                        if isinstance(content_bytes, bytes):
-                            decoded = content_bytes.decode('utf-8')
-                            full_response += decoded
-                    except Exception as e:
-                        st.error(f"Error processing agent response: {e}")
-
-            return full_response
+                    content_bytes = event['chunk']['bytes']
+                    if isinstance(content_bytes, bytes):
+                        text = decoder.decode(content_bytes)
+                        if text:
+                            yield text
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
         else:
-            return "Sorry, I couldn't generate a response. Please try again."
+            yield "Sorry, I couldn't generate a response. Please try again."
     except Exception as e:
         st.error(f"Error connecting to Bedrock Agent: {str(e)}")
         # Provide fallback response
-        return f"""
+        yield f"""
 [Fallback response due to agent connection error]
 
 Subject: Special October Offer: Singapore to Hong Kong
@@ -267,7 +442,7 @@ The PandaPaw Express Team
 def get_segment_users(flight_id):
     """Get segment users for a flight"""
     try:
-        segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH)
+        segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH, [flight_id])
         if not segments:
             return []
 
@@ -282,9 +457,103 @@ def get_segment_users(flight_id):
         return []
 
 
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_segment_stats(bucket, key, etag):
+    """Parse a segment statistics artifact at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return segment_data.parse_segment_stats(response['Body'].read())
+
+
+@st.cache_data(ttl=DATA_CACHE_TTL_SECONDS, max_entries=DATA_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_s3_partition_manifest(bucket, key, etag):
+    """Parse an interaction partition manifest at a given ETag"""
+    s3_client, _ = get_aws_clients()
+    response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+    return interaction_partitions.parse_partition_manifest(response['Body'].read())
+
+
+def clear_data_caches():
+    """Drop the cached S3 ETags and parsed data, leaving other cached functions alone"""
+    for loader in (get_s3_etag, get_s3_metadata, load_s3_dataset, load_s3_segments, load_s3_flight_index,
+                   load_s3_segment_offset_index, load_s3_segment_line, load_s3_segment_stats,
+                   load_s3_partition_manifest):
+        loader.clear()
+
+
+def read_flight_interactions(bucket, key, item_ids, filters=None):
+    """Read the interactions of item_ids from their ITEM_ID partitions, falling back to the whole dataset"""
+    columns = travel_data.INTERACTION_COLUMNS
+    try:
+        manifest_key = interaction_partitions.partition_manifest_key(key)
+        manifest_etag = get_s3_etag(bucket, manifest_key)
+        if manifest_etag:
+            manifest = load_s3_partition_manifest(bucket, manifest_key, manifest_etag)
+
+            def current_etag(source_key):
+                return get_s3_etag(bucket, source_key)
+
+            if (interaction_partitions.partitions_are_fresh(manifest, current_etag)
+                    and (manifest['format'] != 'parquet' or travel_data.SNAPSHOTS_SUPPORTED)):
+                # Partition ETags are recorded in the manifest, so they need no HEAD of their own
+                frames = [load_s3_dataset(bucket, entry['key'], entry['etag'], columns)
+                          for entry in interaction_partitions.partition_entries(manifest, item_ids)]
+                return interaction_partitions.combine_partitions(
+                    frames, item_ids, columns, filters, travel_data.dataset_dtypes(key))
+    except ClientError as e:
+        if not is_missing_object(e):
+            st.error(f"Error reading interaction partitions: {str(e)}")
+    return read_s3_csv(bucket, key, columns, [('ITEM_ID', 'in', list(item_ids))] + list(filters or []))
+
+
+def load_segment_stats():
+    """Load the precomputed per-flight segment statistics, or None when missing or stale"""
+    try:
+        s3_client, _ = get_aws_clients()
+        if not s3_client:
+            return None
+
+        stats_key = segment_data.segment_stats_key(SEGMENTS_OUTPUT_PATH)
+        etag = get_s3_etag(BUCKET_NAME, stats_key)
+        if not etag:
+            return None
+        stats = load_s3_segment_stats(BUCKET_NAME, stats_key, etag)
+
+        def current_etag(key):
+            return get_s3_etag(BUCKET_NAME, key)
+
+        return stats if segment_data.stats_are_fresh(stats, current_etag) else None
+    except ClientError as e:
+        if not is_missing_object(e):
+            st.error(f"Error reading segment statistics: {str(e)}")
+        return None
+    except segment_data.ARTIFACT_ERRORS:
+        # A corrupt artifact is ignored, and the statistics are computed from the data
+        return None
+
+
 def analyze_segment_patterns(flight_id):
     """Analyze segment patterns including rating trends"""
-    segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH)
+    # Serve from the precomputed statistics when they are current
+    segment_stats = load_segment_stats()
+    flight_stats = segment_stats['flights'].get(flight_id) if segment_stats else None
+    if flight_stats:
+        # A segment with an empty usersList has nothing to analyze, as on the path below
+        if not flight_stats['userCount']:
+            return None
+        insights = flight_stats['interactionInsights'] or {}
+        return {
+            "user_count": flight_stats['userCount'],
+            "avg_rating": round(insights['averageRating'], 2) if insights else None,
+            "cabin_ratings": flight_stats['cabinRatings'],
+            "cabin_counts": insights.get('cabinTypeDistribution', {}),
+            "rating_distribution": insights.get('ratingDistribution', {}),
+            # Like the path below, a segment without interactions reports no tiers
+            "tier_distribution": segment_data.normalize_tier_distribution(
+                flight_stats['tierDistribution'] if insights else {})
+        }
+
+    segments = read_s3_json(BUCKET_NAME, SEGMENTS_OUTPUT_PATH, [flight_id])
     segment_users = []
 
     if segments:
@@ -296,19 +565,14 @@ def analyze_segment_patterns(flight_id):
     if not segment_users:
         return None
 
-    # Load interactions data
-    interactions_df = read_s3_csv(BUCKET_NAME, INTERACTIONS_CSV_PATH)
-    if interactions_df is None:
+    # Load interactions for this flight and these users only, from the flight's partition
+    relevant_interactions = read_flight_interactions(
+        BUCKET_NAME, INTERACTIONS_CSV_PATH, [flight_id], [('USER_ID', 'in', segment_users)])
+    if relevant_interactions is None:
         return None
 
     # Load users data for tier information
-    users_df = read_s3_csv(BUCKET_NAME, USERS_CSV_PATH)
-
-    # Filter for this flight and these users
-    relevant_interactions = interactions_df[
-        (interactions_df['ITEM_ID'] == flight_id) &
-        (interactions_df['USER_ID'].isin(segment_users))
-    ]
+    users_df = read_s3_csv(BUCKET_NAME, USERS_CSV_PATH, travel_data.USER_COLUMNS)
 
     if relevant_interactions.empty:
         return {
@@ -325,8 +589,9 @@ def analyze_segment_patterns(flight_id):
 
     # Analyze by cabin type
     cabin_ratings = relevant_interactions.groupby(
-        'CABIN_TYPE')['EVENT_VALUE'].mean().to_dict()
-    cabin_counts = relevant_interactions.groupby('CABIN_TYPE').size().to_dict()
+        'CABIN_TYPE', observed=True)['EVENT_VALUE'].mean().to_dict()
+    cabin_counts = relevant_interactions.groupby(
+        'CABIN_TYPE', observed=True).size().to_dict()
 
     # Get rating distribution
     rating_distribution = relevant_interactions['EVENT_VALUE'].value_counts(
@@ -335,10 +600,9 @@ def analyze_segment_patterns(flight_id):
     # Get tier distribution if users_df is available
     tier_distribution = {}
     if users_df is not None:
-        tier_data = users_df[users_df['USER_ID'].isin(segment_users)]
-        if not tier_data.empty:
-            tier_distribution = tier_data['MEMBER_TIER'].value_counts(
-            ).to_dict()
+        # Each segment user is looked up once; tiers are then counted on int codes
+        tiers, user_tiers = segment_data.encode_user_tiers(list(dict.fromkeys(segment_users)), users_df)
+        tier_distribution = segment_data.normalize_tier_distribution(segment_data.count_tiers(tiers, user_tiers))
 
     return {
         "user_count": len(segment_users),
@@ -398,6 +662,16 @@ with st.sidebar:
         st.session_state.selected_flights = []
         st.experimental_rerun()
 
+    # Cached data is refreshed on its own once S3 changes; this forces it right away
+    if st.button("🔄 Refresh Data", help="Reload flights, segments and statistics from S3"):
+        clear_data_caches()
+        st.experimental_rerun()
+
+    # The agent remembers earlier turns of its session; a new session starts from scratch
+    if st.button("🆕 New Agent Session", help="Start a new conversation with the agent"):
+        st.session_state.agent_session_id = f"session-{uuid.uuid4().hex}"
+        st.experimental_rerun()
+
     st.markdown("---")
 
     # Help & Info
@@ -419,15 +693,13 @@ st.markdown("# 1Shot Email Marketing Platform")
 if st.session_state.active_section == "flights":
     st.markdown("## Select Promotional Flights")
 
-    # Load flight data
-    flight_df = read_s3_csv(BUCKET_NAME, ITEMS_CSV_PATH)
+    # Load the flight facet index (promotional, unexpired flights and per-value bitmaps)
+    flight_index = read_flight_index(BUCKET_NAME, ITEMS_CSV_PATH)
 
-    if flight_df is not None:
-        # Filter to show promotional flights
-        promo_flights = flight_df[(flight_df['PROMOTION'] == 'Yes') & (
-            flight_df['EXPIRED'] != 'Yes')]
+    if flight_index is not None:
+        promo_mask = flight_index.select()
 
-        if promo_flights.empty:
+        if flight_index.count(promo_mask) == 0:
             st.warning("No promotional flights found.")
         else:
             # Display info message
@@ -436,24 +708,21 @@ if st.session_state.active_section == "flights":
             # Add filters in two columns
             col1, col2 = st.columns(2)
             with col1:
-                month_options = ["All"] + \
-                    sorted(promo_flights['MONTH'].unique().tolist())
-                selected_month = st.selectbox("Filter by Month", month_options)
+                month_counts = flight_index.facet_counts('month', promo_mask)
+                selected_month = st.selectbox(
+                    "Filter by Month", ["All"] + list(month_counts),
+                    format_func=lambda m: m if m == "All" else f"{m} ({month_counts[m]})")
 
             with col2:
-                dest_options = ["All"] + \
-                    sorted(promo_flights['DST_CITY'].unique().tolist())
+                dest_counts = flight_index.facet_counts('destination', promo_mask)
                 selected_dest = st.selectbox(
-                    "Filter by Destination", dest_options)
+                    "Filter by Destination", ["All"] + list(dest_counts),
+                    format_func=lambda d: d if d == "All" else f"{d} ({dest_counts[d]})")
 
-            # Apply filters
-            filtered_flights = promo_flights.copy()
-            if selected_month != "All":
-                filtered_flights = filtered_flights[filtered_flights['MONTH']
-                                                    == selected_month]
-            if selected_dest != "All":
-                filtered_flights = filtered_flights[filtered_flights['DST_CITY']
-                                                    == selected_dest]
+            # Apply filters as a bitmap AND, then materialize only the matching rows
+            filtered_flights = flight_index.rows(flight_index.select(
+                month=None if selected_month == "All" else selected_month,
+                destination=None if selected_dest == "All" else selected_dest))
 
             # Display flights as selectable cards
             st.markdown("### Available Flights")
@@ -709,8 +978,14 @@ Include:"""
 
                 prompt += "\n\nFormat the response with a clear subject line that starts with 'Subject:' followed by two line breaks and then the email body."
 
-                # Invoke agent or process locally
-                response = invoke_agent(prompt)
+                # Render the template as it streams in, in this browser session's agent session
+                response_placeholder = st.empty()
+                response_parts = []
+                for chunk in invoke_agent(prompt, st.session_state.agent_session_id):
+                    response_parts.append(chunk)
+                    response_placeholder.text("".join(response_parts))
+                response_placeholder.empty()
+                response = "".join(response_parts)
 
                 # Process the response
                 email_content = extract_email_content(response)
@@ -0,0 +1,225 @@
+import io
+import csv
+import logging
+import importlib.util
+
+from botocore.exceptions import ClientError
+
+import request_metrics
+from dataset_cache import fetch_all, is_missing_object
+
+# pandas and pyarrow are imported by the functions that use them, so the
+# Lambda endpoints that never parse a DataFrame do not load them on cold start
+
+logger = logging.getLogger()
+
+# ============= CONFIGURATION CONSTANTS =============
+# Typed Parquet snapshots of data/travel_*.csv live under this prefix
+SNAPSHOT_PREFIX = 'data/snapshots/'
+# S3 user metadata key holding the ETag (without quotes) of the CSV a snapshot was built from
+SNAPSHOT_SOURCE_METADATA = 'source-etag'
+
+# Declared schema of the travel datasets, applied by every CSV and snapshot reader.
+# IDs are strings, to match the IDs in segment files and requests; they are only
+# categorical in the interactions table, where each ID repeats many times
+DATASET_DTYPES = {
+    'travel_items': {
+        'ITEM_ID': str, 'SRC_CITY': 'category', 'DST_CITY': 'category', 'AIRLINE': 'category',
+        'MONTH': 'category', 'PROMOTION': 'category', 'EXPIRED': 'category'
+    },
+    'travel_users': {
+        'USER_ID': str, 'MEMBER_TIER': 'category'
+    },
+    'travel_interactions': {
+        'USER_ID': 'category', 'ITEM_ID': 'category', 'EVENT_TYPE': 'category', 'CABIN_TYPE': 'category'
+    }
+}
+# Used for any other CSV
+DEFAULT_DTYPES = {'USER_ID': str, 'ITEM_ID': str}
+
+# Whole-number columns narrowed to the smallest integer type that holds their values
+# (EVENT_VALUE and DURATION_DAYS fit in int8); left as parsed if they hold fractions or gaps
+INTEGER_COLUMNS = ['EVENT_VALUE', 'DURATION_DAYS', 'DYNAMIC_PRICE']
+
+# Snapshot rows are sorted by this column so filters on it can skip row groups
+SNAPSHOT_SORT_COLUMNS = {
+    'data/travel_interactions.csv': 'ITEM_ID',
+    'data/travel_items.csv': 'ITEM_ID',
+    'data/travel_users.csv': 'USER_ID'
+}
+SNAPSHOT_ROW_GROUP_SIZE = 64 * 1024
+
+# Columns each consumer actually reads
+ITEM_COLUMNS = ['ITEM_ID', 'SRC_CITY', 'DST_CITY', 'AIRLINE', 'MONTH',
+                'DYNAMIC_PRICE', 'DURATION_DAYS', 'PROMOTION', 'EXPIRED']
+USER_COLUMNS = ['USER_ID', 'MEMBER_TIER']
+INTERACTION_COLUMNS = ['USER_ID', 'ITEM_ID', 'EVENT_VALUE', 'CABIN_TYPE']
+# ============= END CONFIGURATION =============
+
+# Snapshots are optional; every reader falls back to the CSV
+SNAPSHOTS_SUPPORTED = importlib.util.find_spec('pyarrow') is not None
+
+
+def snapshot_key(csv_key):
+    """Map data/travel_items.csv to data/snapshots/travel_items.parquet"""
+    filename = csv_key.rsplit('/', 1)[-1]
+    if filename.endswith('.csv'):
+        filename = filename[:-len('.csv')]
+    return f"{SNAPSHOT_PREFIX}{filename}.parquet"
+
+
+def dataset_dtypes(key):
+    """Return the declared column dtypes of a dataset from its CSV or snapshot key"""
+    name = key.rsplit('/', 1)[-1].split('.', 1)[0]
+    return DATASET_DTYPES.get(name, DEFAULT_DTYPES)
+
+
+def apply_schema(df, dtypes=None):
+    """Give a parsed frame the declared dtypes (categoricals and compact integers)"""
+    import pandas as pd
+
+    dtypes = dtypes or DEFAULT_DTYPES
+    for column in df.columns:
+        if dtypes.get(column) == 'category':
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        elif dtypes.get(column) is str:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(str)
+        elif column in INTEGER_COLUMNS and pd.api.types.is_numeric_dtype(df[column].dtype):
+            values = df[column]
+            if pd.api.types.is_integer_dtype(values.dtype) or (values.notna().all() and (values % 1 == 0).all()):
+                df[column] = pd.to_numeric(values, downcast='integer')
+    return df
+
+
+def parse_csv(body, columns=None, dtypes=None):
+    """Parse a CSV object body with the declared dtypes, keeping only the requested columns"""
+    import pandas as pd
+
+    usecols = (lambda column: column in columns) if columns else None
+    dtypes = dtypes or DEFAULT_DTYPES
+    return apply_schema(pd.read_csv(io.BytesIO(body), usecols=usecols, dtype=dtypes), dtypes)
+
+
+def parse_snapshot(body, columns=None, filters=None, dtypes=None):
+    """Parse a Parquet snapshot body with column projection and predicate pushdown"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(pa.BufferReader(body), columns=columns, filters=filters or None)
+    return apply_schema(table.to_pandas(), dtypes)
+
+
+def apply_filters(df, filters):
+    """Apply pyarrow-style (column, op, value) filters to a DataFrame"""
+    for column, op, value in filters or []:
+        if op in ('=', '=='):
+            df = df[df[column] == value]
+        elif op == '!=':
+            df = df[df[column] != value]
+        elif op == 'in':
+            df = df[df[column].isin(value)]
+        elif op == 'not in':
+            df = df[~df[column].isin(value)]
+        else:
+            raise ValueError(f"Unsupported filter operator: {op}")
+    return df
+
+
+def snapshot_is_current(snapshot_metadata, csv_etag):
+    """Check that a snapshot was built from the current version of its CSV"""
+    return bool(csv_etag) and (snapshot_metadata or {}).get(SNAPSHOT_SOURCE_METADATA) == csv_etag.strip('"')
+
+
+def csv_to_snapshot(body, sort_by=None, dtypes=None):
+    """Convert a CSV object body into typed Parquet snapshot bytes"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = parse_csv(body, dtypes=dtypes)
+    if sort_by and sort_by in df.columns:
+        df = df.sort_values(sort_by, kind='stable')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, row_group_size=SNAPSHOT_ROW_GROUP_SIZE, compression='zstd')
+    return sink.getvalue().to_pybytes()
+
+
+def parse_record_value(column, value):
+    """Convert a CSV field as pandas would for the declared schema: numbers for INTEGER_COLUMNS, None for gaps"""
+    if value is None or value == '':
+        return None
+    if column in INTEGER_COLUMNS:
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+    return value
+
+
+def parse_records(body, key_column, columns=None):
+    """Parse a CSV object body into key -> row dict with the csv module, keeping the first row of duplicate keys.
+
+    For single-row lookups on endpoints that should not pay for importing
+    pandas; rows carry only the requested columns.
+    """
+    records = {}
+    for row in csv.DictReader(io.StringIO(body.decode('utf-8-sig'))):
+        key = row.get(key_column)
+        if key and key not in records:
+            records[key] = {column: parse_record_value(column, row.get(column)) for column in columns or row}
+    return records
+
+
+def read_records(cache, bucket, key, key_column, columns=None):
+    """Read a travel dataset's CSV through a DatasetCache as key -> row dicts, without pandas"""
+    projection = ','.join(columns) if columns else '*'
+    return cache.get(bucket, key, lambda body: parse_records(body, key_column, columns),
+                     f'records:{key_column}:{projection}')
+
+
+def raw_body(body):
+    """Keep an object body as raw bytes"""
+    return body
+
+
+def read_dataset(cache, bucket, key, columns=None, filters=None, view_name=None, view_builder=None):
+    """Read a travel dataset through a DatasetCache, preferring its Parquet snapshot while it matches the CSV"""
+    projection = ','.join(columns) if columns else '*'
+    dtypes = dataset_dtypes(key)
+    name = view_name or f'frame:{projection}'
+
+    def build(df):
+        return view_builder(df) if view_builder else df
+
+    if SNAPSHOTS_SUPPORTED:
+        try:
+            snapshot = snapshot_key(key)
+            # Revalidate the snapshot and look up the CSV's ETag at the same time
+            body, csv_etag = fetch_all(
+                lambda: cache.get(bucket, snapshot, raw_body, 'snapshot'),
+                lambda: cache.etag(bucket, key)
+            )
+            if snapshot_is_current(cache.metadata(bucket, snapshot), csv_etag):
+                if filters:
+                    with request_metrics.phase('parse'):
+                        return parse_snapshot(body, columns, filters, dtypes)
+                return cache.get_derived(bucket, snapshot, raw_body, 'snapshot', name,
+                                         lambda body: build(parse_snapshot(body, columns, dtypes=dtypes)))
+            logger.info(f"Snapshot of s3://{bucket}/{key} is older than the CSV, reading CSV")
+        except ClientError as e:
+            if not is_missing_object(e):
+                raise
+            logger.info(f"No snapshot for s3://{bucket}/{key}, reading CSV")
+
+    def parse(body):
+        return parse_csv(body, columns, dtypes)
+
+    if filters:
+        return apply_filters(cache.get(bucket, key, parse, f'csv:{projection}'), filters)
+    if view_builder:
+        return cache.get_derived(bucket, key, parse, f'csv:{projection}', name, build)
+    return cache.get(bucket, key, parse, f'csv:{projection}')